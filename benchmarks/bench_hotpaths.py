@@ -0,0 +1,360 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Benchmarks of the signing, encoding and parsing hot paths
+
+    python benchmarks/bench_hotpaths.py [-o result.json] [--compare base.json]
+                                        [--filter sign] [--sizes 10000,1000000]
+
+Results are written as json, one entry per benchmark with seconds per
+call, so two commits can be compared with --compare, which exits 1 when
+a benchmark got slower than --threshold.
+'''
+
+import argparse
+import collections
+import gc
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from unionpay.client import UnionpayClient  # noqa
+from unionpay.metrics import Registry  # noqa
+from unionpay.signer import Signer  # noqa
+from unionpay.tests.support import (  # noqa
+    PASSWORD, PFX_FILEPATH, iter_settlement_lines, make_file_content, make_request, make_self_x509,
+    make_settlement_zip)
+from unionpay.util.helper import LineObject, ObjectDict, make_submit_form  # noqa
+
+
+MERCHANT_ID = '777290058110836'
+SETTLE_DATE = '1216'
+# sizes ingested through the disk, larger ones only run in stream mode
+EXTRACT_MAX_LINES = 100000
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name, heavy=False):
+    '''
+    @heavy: the setup returns a function timed once per round
+    '''
+    def decorator(setup):
+        BENCHMARKS[name] = (setup, heavy)
+        return setup
+    return decorator
+
+
+def make_signed_request(signer):
+    data = make_request()
+    signer.sign(data)
+    data['signature'] = data['signature'].decode('utf-8')
+    return data
+
+
+@benchmark('signer.sign')
+def bench_sign(context):
+    signer = context.signer
+    return lambda: signer.sign(make_request())
+
+
+@benchmark('signer.validate')
+def bench_validate(context):
+    signer = context.signer
+    signed = make_signed_request(signer)
+    return lambda: signer.validate(dict(signed))
+
+
+@benchmark('signer.simple_urlencode')
+def bench_simple_urlencode(context):
+    signed = make_signed_request(context.signer)
+    return lambda: Signer.simple_urlencode(signed)
+
+
+@benchmark('signer.filter_params')
+def bench_filter_params(context):
+    data = make_request()
+    return lambda: Signer.filter_params(data)
+
+
+@benchmark('signer.parse_arguments')
+def bench_parse_arguments(context):
+    raw = UnionpayClient.encode_request(make_signed_request(context.signer)).decode('utf-8')
+    return lambda: Signer.parse_arguments(raw)
+
+
+@benchmark('signer.parse_response')
+def bench_parse_response(context):
+    raw = UnionpayClient.encode_request(make_signed_request(context.signer))
+    return lambda: Signer.parse_response(raw)
+
+
+@benchmark('client.query_packet.generic')
+def bench_query_generic(context):
+    client = context.client
+
+    def run():
+        _, data, _ = client.query_packet('ORDER1', '20151216103000')
+        data = dict(data)
+        client.sign_data(data)
+        return client.encode_request(data)
+    return run
+
+
+@benchmark('client.query_packet.template')
+def bench_query_template(context):
+    client = context.client
+
+    def run():
+        _, data, _ = client.query_packet('ORDER1', '20151216103000')
+        client.sign_data(data)
+        return client.encode_request(data)
+    return run
+
+
+@benchmark('helper.make_submit_form')
+def bench_make_submit_form(context):
+    signed = make_signed_request(context.signer)
+    return lambda: make_submit_form(signed, 'https://101.231.204.80:5000/gateway/api/frontTransReq.do')
+
+
+@benchmark('record.make_params')
+def bench_make_params(context):
+    lines = list(iter_settlement_lines(1000, MERCHANT_ID, SETTLE_DATE))
+
+    def run():
+        for line in lines:
+            Signer.make_params(SETTLE_DATE, line, LineObject)
+    run.per_call = len(lines)
+    return run
+
+
+@benchmark('record.to_dict')
+def bench_to_dict(context):
+    lines = list(iter_settlement_lines(1000, MERCHANT_ID, SETTLE_DATE))
+
+    def run():
+        for line in lines:
+            LineObject(line).to_dict()
+    run.per_call = len(lines)
+    return run
+
+
+class FakeResponse(object):
+
+    status_code = 200
+    reason = 'OK'
+
+    def __init__(self, content):
+        self.content = content
+
+
+def make_file_transfer(context, lines, stream, processes=None):
+    '''
+    The whole file_transfer path but the network: sign the request, parse
+    and validate the signed response, decode fileContent and read every
+    record
+    '''
+    client = context.client
+    response = {
+        'version': '5.0.0', 'encoding': 'UTF-8', 'signMethod': '01', 'txnType': '76',
+        'txnSubType': '01', 'bizType': '000000', 'accessType': '0', 'merId': MERCHANT_ID,
+        'txnTime': '20151216103000', 'settleDate': SETTLE_DATE, 'fileType': '00', 'respCode': '00',
+        'respMsg': 'success', 'fileName': 'INN%s88ZM_%s.zip' % (SETTLE_DATE, MERCHANT_ID),
+        'fileContent': make_file_content(make_settlement_zip(lines, MERCHANT_ID, SETTLE_DATE)),
+    }
+    context.signer.sign(response)
+    response['signature'] = response['signature'].decode('utf-8')
+    raw = UnionpayClient.encode_request(response)
+    client.session_pool.post = lambda addr, data, **kwargs: FakeResponse(raw)
+
+    def run():
+        records = client.file_transfer(
+            '00', SETTLE_DATE, filepath=context.workdir, stream=stream, processes=processes)
+        count = sum(1 for _ in records)
+        assert count == lines, count
+    run.per_call = lines
+    return run
+
+
+def make_parse(context, lines, processes=None):
+    '''
+    reader_file_data against reader_file_data_parallel on the same
+    extracted files, the parse pool is started before timing
+    '''
+    path = tempfile.mkdtemp(dir=context.workdir)
+    files = Signer.save_file_data(
+        SETTLE_DATE, make_settlement_zip(lines, MERCHANT_ID, SETTLE_DATE), path, MERCHANT_ID, year=2015)
+
+    def run():
+        if processes:
+            records = context.signer.reader_file_data_parallel(files, SETTLE_DATE, processes, min_size=0)
+        else:
+            records = Signer.reader_file_data(files, SETTLE_DATE)
+        assert len(records) == lines, len(records)
+    if processes:
+        run()
+    run.per_call = lines
+    return run
+
+
+def add_file_transfer_benchmarks(sizes, processes):
+    for lines in sizes:
+        def stream_setup(context, lines=lines):
+            return make_file_transfer(context, lines, stream=True)
+        benchmark('file_transfer.stream[%d]' % lines, heavy=True)(stream_setup)
+        if lines > EXTRACT_MAX_LINES:
+            continue
+
+        def extract_setup(context, lines=lines):
+            return make_file_transfer(context, lines, stream=False)
+        benchmark('file_transfer.extract[%d]' % lines, heavy=True)(extract_setup)
+
+        def parallel_setup(context, lines=lines):
+            return make_file_transfer(context, lines, stream=False, processes=0)
+        benchmark('file_transfer.extract_parallel[%d]' % lines, heavy=True)(parallel_setup)
+
+        def parse_setup(context, lines=lines):
+            return make_parse(context, lines)
+        benchmark('parse.serial[%d]' % lines, heavy=True)(parse_setup)
+
+        def parse_parallel_setup(context, lines=lines):
+            return make_parse(context, lines, processes)
+        benchmark('parse.parallel[%d]x%d' % (lines, processes), heavy=True)(parse_parallel_setup)
+
+
+def make_context(workdir):
+    x509_filepath = make_self_x509()
+    config = ObjectDict(
+        pfx_filepath=PFX_FILEPATH,
+        password=PASSWORD,
+        x509_filepath=x509_filepath,
+        digest_method='sha1',
+        merchant_id=MERCHANT_ID,
+        backend_url='http://127.0.0.1/notify',
+        back_trans_url='http://127.0.0.1/gateway/api/backTransReq.do',
+        file_trans_url='http://127.0.0.1/',
+    )
+    try:
+        client = UnionpayClient(config, registry=Registry())
+    finally:
+        os.unlink(x509_filepath)
+    return ObjectDict(signer=client.signer, client=client, workdir=workdir)
+
+
+def measure(func, heavy, rounds, min_time):
+    per_call = getattr(func, 'per_call', 1)
+    timer = timeit.Timer(func)
+    # autorange finds loops taking at least 0.2 seconds
+    number = 1 if heavy else max(1, int(timer.autorange()[0] * min_time / 0.2))
+    times = []
+    gc.collect()
+    for _ in range(rounds):
+        times.append(timer.timeit(number) / number / per_call)
+    return {
+        'unit': 'seconds/item' if per_call > 1 else 'seconds/call',
+        'rounds': rounds,
+        'loops': number,
+        'items_per_call': per_call,
+        'min': min(times),
+        'mean': statistics.mean(times),
+        'median': statistics.median(times),
+        'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'ops': 1 / min(times),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = dict((item['name'], item) for item in json.load(f)['benchmarks'])
+    regressions = []
+    print('%-36s %14s %14s %9s' % ('benchmark', 'base', 'current', 'change'), file=sys.stderr)
+    for item in results:
+        base = baseline.get(item['name'])
+        if base is None:
+            continue
+        change = item['min'] / base['min'] - 1
+        print('%-36s %14.3e %14.3e %+8.1f%%' % (item['name'], base['min'], item['min'], change * 100),
+              file=sys.stderr)
+        if change > threshold:
+            regressions.append(item['name'])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', help='write json here instead of stdout')
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this')
+    parser.add_argument('--sizes', default='10000,1000000', help='file_transfer line counts')
+    parser.add_argument('--processes', type=int, default=max(2, os.cpu_count() or 1),
+                        help='parse.parallel worker count')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per round of fast benchmarks')
+    parser.add_argument('--compare', help='baseline json of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown counted as a regression')
+    args = parser.parse_args()
+
+    add_file_transfer_benchmarks((int(size) for size in args.sizes.split(',') if size), args.processes)
+    workdir = tempfile.mkdtemp(prefix='unionpay_bench_')
+    results = []
+    try:
+        context = make_context(workdir)
+        for name, (setup, heavy) in BENCHMARKS.items():
+            if args.filter and args.filter not in name:
+                continue
+            func = setup(context)
+            rounds = max(1, args.rounds // 2) if heavy else args.rounds
+            result = measure(func, heavy, rounds, args.min_time)
+            result['name'] = name
+            results.append(result)
+            print('%-36s %12.3e %s' % (name, result['min'], result['unit']), file=sys.stderr)
+        context.client.close()
+        context.signer.close()
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'backend': context.signer.backend.name,
+        'benchmarks': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print('regressions: %s' % ', '.join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
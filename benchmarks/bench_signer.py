@@ -0,0 +1,57 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Signs and verifies per second of every available sign backend
+
+    python benchmarks/bench_signer.py [seconds]
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from unionpay.backends import BACKENDS  # noqa
+from unionpay.tests.support import make_request, make_signer  # noqa
+
+
+def rate(func, seconds):
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        func()
+        count += 1
+    return count / (time.time() - start)
+
+
+def bench_backend(name, seconds):
+    signer = make_signer(name)
+    signed = make_request()
+    signer.sign(signed)
+    signed['signature'] = signed['signature'].decode('utf-8')
+
+    def sign():
+        signer.sign(make_request())
+
+    def validate():
+        signer.validate(dict(signed))
+
+    return rate(sign, seconds), rate(validate, seconds)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    print('%-14s %12s %12s' % ('backend', 'signs/s', 'verifies/s'))
+    for name, backend in sorted(BACKENDS.items()):
+        if not backend.available():
+            print('%-14s %12s %12s' % (name, '-', '-'))
+            continue
+        signs, verifies = bench_backend(name, seconds)
+        print('%-14s %12.1f %12.1f' % (name, signs, verifies))
+
+
+if __name__ == '__main__':
+    main()
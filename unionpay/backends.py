@@ -0,0 +1,144 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+RSA signing backends, the PKCS12 and X509 material is loaded once and
+the native key objects are cached for every sign and validate call
+'''
+
+from .error import SignatureValidateError
+
+
+def to_bytes(value, encoding='utf-8'):
+    if isinstance(value, bytes):
+        return value
+    return value.encode(encoding)
+
+
+class SignBackend(object):
+
+    name = None
+
+    def __init__(self, pfx_data, password, x509_data, digest_method='sha1'):
+        '''
+        @pfx_data:      content of the PKCS12 pfx file
+        @password:      pfx pem password
+        @x509_data:     content of the PEM format x509 cert
+        @digest_method: digest method used by RSA sign
+        '''
+        self.digest_method = digest_method
+        self.cert_id = None
+
+    @classmethod
+    def available(cls):
+        return False
+
+    def sign(self, message):
+        '''
+        @message: bytes to sign
+        Return the raw signature bytes
+        '''
+        raise NotImplementedError
+
+    def verify(self, signature, message):
+        '''
+        @signature: the raw signature bytes
+        @message:   bytes signed by unionpay
+        Raise SignatureValidateError if signature mismatch
+        '''
+        raise NotImplementedError
+
+
+class PyOpenSSLBackend(SignBackend):
+
+    name = 'pyopenssl'
+
+    def __init__(self, pfx_data, password, x509_data, digest_method='sha1'):
+        super(PyOpenSSLBackend, self).__init__(
+            pfx_data, password, x509_data, digest_method)
+        from OpenSSL import crypto
+        self.crypto = crypto
+        self.PKCS12 = crypto.load_pkcs12(pfx_data, to_bytes(password))
+        self.X509 = crypto.load_certificate(crypto.FILETYPE_PEM, x509_data)
+        self.private_key = self.PKCS12.get_privatekey()
+        self.cert_id = str(self.PKCS12.get_certificate().get_serial_number())
+
+    @classmethod
+    def available(cls):
+        try:
+            from OpenSSL import crypto
+        except ImportError:
+            return False
+        # load_pkcs12, sign and verify were removed from recent pyOpenSSL
+        return all(hasattr(crypto, name) for name in ('load_pkcs12', 'sign', 'verify'))
+
+    def sign(self, message):
+        return self.crypto.sign(self.private_key, message, self.digest_method)
+
+    def verify(self, signature, message):
+        try:
+            self.crypto.verify(self.X509, signature, message, self.digest_method)
+        except self.crypto.Error as e:
+            raise SignatureValidateError(str(e))
+
+
+class CryptographyBackend(SignBackend):
+
+    name = 'cryptography'
+
+    def __init__(self, pfx_data, password, x509_data, digest_method='sha1'):
+        super(CryptographyBackend, self).__init__(
+            pfx_data, password, x509_data, digest_method)
+        from cryptography import x509
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+        from cryptography.hazmat.primitives.serialization import pkcs12
+        self.InvalidSignature = InvalidSignature
+        self.private_key, certificate, _ = pkcs12.load_key_and_certificates(
+            pfx_data, to_bytes(password))
+        self.public_key = x509.load_pem_x509_certificate(x509_data).public_key()
+        self.cert_id = str(certificate.serial_number)
+        self.padding = padding.PKCS1v15()
+        self.hash = getattr(hashes, digest_method.upper())()
+
+    @classmethod
+    def available(cls):
+        try:
+            from cryptography.hazmat.primitives.serialization import pkcs12  # noqa
+        except ImportError:
+            return False
+        return True
+
+    def sign(self, message):
+        return self.private_key.sign(message, self.padding, self.hash)
+
+    def verify(self, signature, message):
+        try:
+            self.public_key.verify(signature, message, self.padding, self.hash)
+        except self.InvalidSignature:
+            raise SignatureValidateError('bad signature')
+
+
+BACKENDS = {
+    PyOpenSSLBackend.name: PyOpenSSLBackend,
+    CryptographyBackend.name: CryptographyBackend,
+}
+
+
+def get_backend(name='auto'):
+    '''
+    @name: pyopenssl, cryptography or auto for the first available one
+    '''
+    if name == 'auto':
+        for backend in (CryptographyBackend, PyOpenSSLBackend):
+            if backend.available():
+                return backend
+        raise ImportError('[UPACP]neither cryptography nor pyOpenSSL is installed')
+    if name not in BACKENDS:
+        raise ValueError('[UPACP]unknown sign backend: %s' % name)
+    backend = BACKENDS[name]
+    if not backend.available():
+        raise ImportError('[UPACP]sign backend %s is not available' % name)
+    return backend
@@ -0,0 +1,120 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Capture raw notify bodies for replay
+
+A capture file is gzipped text, one notify per line:
+
+    <seconds since the capture started>\\t<raw urlencoded body>
+
+Redacted captures mask card and customer fields, their signatures no
+longer match, replay them with --resign against a server trusting the
+resigning cert.
+'''
+
+import gzip
+import logging
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from urlparse import parse_qsl
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import parse_qsl, urlencode
+
+
+logger = logging.getLogger(__name__)
+
+
+REDACT_FIELDS = ('accNo', 'payCardNo', 'customerInfo', 'customerNm', 'phoneNo', 'certifId', 'reqReserved')
+
+
+def mask(value, keep=4):
+    if len(value) <= keep:
+        return '*' * len(value)
+    return '*' * (len(value) - keep) + value[-keep:]
+
+
+def redact(body, fields=REDACT_FIELDS):
+    '''
+    @body: raw urlencoded notify body, str
+    Return the body with the values of fields masked
+    '''
+    pairs = parse_qsl(body, keep_blank_values=True)
+    if not any(name in fields for name, _ in pairs):
+        return body
+    return urlencode([(name, mask(value) if name in fields else value) for name, value in pairs])
+
+
+class NotifyCapture(object):
+
+    '''
+    Lines are queued by the IOLoop and compressed by a writer thread
+    '''
+
+    def __init__(self, path, redact=False, fields=REDACT_FIELDS, compresslevel=6, max_queue=10000):
+        '''
+        @path:      capture file, gzipped
+        @redact:    mask the card and customer fields
+        @fields:    fields masked by redact
+        @max_queue: notifies waiting for the writer, more are dropped so a
+                    slow disk never piles them up in memory
+        '''
+        self.path = path
+        self.redact = redact
+        self.fields = fields
+        self.start = time.time()
+        self.count = 0
+        self.dropped = 0
+        self.queue = queue.Queue(max_queue)
+        self.file = gzip.open(path, 'wt', compresslevel=compresslevel)
+        self.thread = threading.Thread(target=self.write_loop, name='notify-capture')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, body):
+        '''
+        @body: raw request body, bytes
+        '''
+        try:
+            self.queue.put_nowait((time.time() - self.start, body))
+        except queue.Full:
+            self.dropped += 1
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            offset, body = item
+            try:
+                body = body.decode('utf-8')
+                if self.redact:
+                    body = redact(body, self.fields)
+                self.file.write('%.6f\t%s\n' % (offset, body))
+                self.count += 1
+            except Exception:
+                logger.exception('[CAPTURE]notify not captured')
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        logger.info('[CAPTURE]%d notifies captured to %s, %d dropped' % (self.count, self.path, self.dropped))
+
+
+def read_capture(path):
+    '''
+    Yield (offset seconds, body) from a capture file
+    '''
+    with gzip.open(path, 'rt') as f:
+        for line in f:
+            offset, _, body = line.rstrip('\n').partition('\t')
+            if body:
+                yield float(offset), body
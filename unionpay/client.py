@@ -2,18 +2,28 @@
 # encoding: utf-8
 # @author: ZhouYang
 
-import zlib
-import base64
+import json
 import datetime
+import time
 import requests
 from . import error
+from . import trace
 import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+from .metrics import REGISTRY, ClientMetrics
 from .signer import Signer
+from .template import RequestTemplate, TemplateRequest
 try:
     from urllib import urlencode
 except ImportError:
     from urllib.parse import urlencode
-from .util.helper import make_submit_form
+from .util.cache import SettlementCache
+from .util.helper import ObjectDict, in_settle_window, iter_dates, make_submit_fields, make_submit_form
+from .util.pool import SessionPool
+from .util.stream import MAX_MEMORY, ArchiveRecords, decode_file_content
 
 logger = logging.getLogger(__name__)
 
@@ -54,6 +64,15 @@ class TradeType(object):
     # 94：IC卡脚本通知
 
 
+# txnType metric labels, any other value is counted as "other" so a
+# caller can not grow the metric series
+TXN_TYPES = frozenset(value for name, value in vars(TradeType).items() if not name.startswith('_'))
+
+
+def txn_type_label(txn_type):
+    return txn_type if txn_type in TXN_TYPES else 'other'
+
+
 BizType = {
     '000101': '基金业务之股票基金',
     '000102': '基金业务之货币基金',
@@ -94,22 +113,94 @@ class payCardType(object):
     semi_prepaid_acct = '06'
 
 
+# dynamic fields of the request templates
+PAY_FIELDS = ('orderId', 'txnTime', 'txnAmt', 'payTimeout', 'customerIp', 'orderDesc')
+QUERY_FIELDS = ('txnTime', 'orderId', 'queryId')
+BACK_FIELDS = ('orderId', 'origQryId', 'txnTime', 'txnAmt')
+AUTH_FIELDS = ('orderId', 'txnTime', 'txnAmt', 'customerIp', 'orderDesc')
+AUTH_COMPLETE_FIELDS = AUTH_FIELDS + ('origQryId',)
+FILE_TRANSFER_FIELDS = ('txnTime', 'settleDate', 'fileType')
+
+
 class UnionpayClient(object):
 
     version = "5.0.0"
     encoding = 'UTF-8'
     signMethod = "01"
 
-    def __init__(self, config, timeout=30, verify=False, **kwargs):
+    def __init__(self, config, timeout=30, verify=False, pool_size=10, timeouts=None, session_pool=None,
+                 max_clients=1000, executor=None, executor_workers=4, registry=REGISTRY,
+                 file_max_memory=MAX_MEMORY, **kwargs):
         '''
-        @config:    the unionpay config object
-        @timeout:   request timeout seconds
-        @verify:    should verify ssl certification pem
+        @config:        the unionpay config object
+        @timeout:       request timeout seconds
+        @verify:        should verify ssl certification pem
+        @pool_size:     keep-alive connections per gateway host
+        @timeouts:      per-endpoint timeout seconds, keyed by config url
+                        name (like back_trans_url) or the url itself
+        @session_pool:  share an existing SessionPool between clients
+        @max_clients:   max in-flight requests of the async http client
+        @executor:      executor running sign/validate for async methods
+        @executor_workers: worker count of the default executor
+        @registry:      metrics registry recording stage latencies
+        @file_max_memory: bytes of a file transfer archive kept in memory,
+                        larger archives are spooled to a temp file
         '''
         self.config = config
         self.timeout = timeout
         self.verify = verify
         self.signer = Signer.getSigner(config)
+        self.session_pool = session_pool or SessionPool(
+            pool_size=pool_size,
+            timeout=timeout,
+            timeouts=self.resolve_timeouts(timeouts),
+            verify=verify,
+            **kwargs
+        )
+        self._own_session_pool = session_pool is None
+        self.max_clients = max_clients
+        self.executor_workers = executor_workers
+        self._executor = executor
+        self._own_executor = executor is None
+        self._async_http_client = None
+        self.metrics = ClientMetrics(registry)
+        self.templates = {}
+        self.file_max_memory = file_max_memory
+
+    def get_metrics(self):
+        '''
+        Pull the client metrics: {metric name: {label values: value}}
+        '''
+        snapshot = self.metrics.registry.snapshot()
+        return dict((name, value) for name, value in snapshot.items() if name.startswith('unionpay_client_'))
+
+    def resolve_timeouts(self, timeouts):
+        '''
+        @timeouts: {config url name or url: seconds}
+        '''
+        resolved = {}
+        for name, seconds in (timeouts or {}).items():
+            resolved[getattr(self.config, name, None) or name] = seconds
+        return resolved
+
+    def close(self):
+        '''
+        Close what the client created, a shared session_pool is left open
+        '''
+        if self._own_session_pool:
+            self.session_pool.close()
+        if self._async_http_client is not None:
+            self._async_http_client.close()
+            self._async_http_client = None
+        if self._own_executor and self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     @staticmethod
     def get_txn_time():
@@ -125,38 +216,196 @@ class UnionpayClient(object):
         cur_trade_time += datetime.timedelta(minutes=expire_minutes)
         return cur_trade_time.strftime('%Y%m%d%H%M%S')
 
-    def post(self, addr, data, **kwargs):
+    @property
+    def async_http_client(self):
+        if self._async_http_client is None:
+            self._async_http_client = AsyncHTTPClient(
+                force_instance=True, max_clients=self.max_clients)
+        return self._async_http_client
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.executor_workers)
+        return self._executor
+
+    def run_in_executor(self, func, *args):
+        '''
+        Run CPU bound work like signing off the IOLoop
+        '''
+        return IOLoop.current().run_in_executor(self.executor, trace.wrap(func), *args)
+
+    @staticmethod
+    def encode_request(data):
+        if isinstance(data, TemplateRequest):
+            return data.encode()
         data.update(signature=urlencode({'signature': data['signature']})[10:])
-        request_data = Signer.simple_urlencode(data)
-        print(request_data)
-        response = requests.post(
-            addr,
-            data=request_data,
-            timeout=self.timeout,
-            verify=self.verify,
-            headers={'content-type': 'application/x-www-form-urlencoded'}
-        )
+        return Signer.simple_urlencode(data)
+
+    def get_template(self, key, dynamic, make_constants):
+        '''
+        @key:               cache key, the transaction name and every
+                            argument changing a constant field
+        @dynamic:           fields given per call
+        @make_constants:    return the constant fields, only called once
+                            per key
+        '''
+        template = self.templates.get(key)
+        if template is None:
+            constants = {
+                'version': self.version,
+                'encoding': self.encoding,
+                'signMethod': self.signMethod,
+                'certId': self.signer.cert_id,
+            }
+            constants.update(make_constants())
+            template = self.templates[key] = RequestTemplate(constants, dynamic)
+        return template
+
+    def pay_template(self, biz_type, currency_code, channel_type=ChannelType.Mobile, dynamic=PAY_FIELDS):
+        return self.get_template(
+            ('pay', biz_type, currency_code, channel_type, dynamic), dynamic,
+            lambda: {
+                'txnType': TradeType.pay,
+                'txnSubType': '01',
+                'bizType': biz_type,
+                'channelType': channel_type,
+                'backUrl': self.config.backend_url,
+                'accessType': '0',
+                'merId': self.config.merchant_id,
+                'currencyCode': currency_code,
+            })
+
+    def auth_template(self, dynamic=AUTH_FIELDS):
+        return self.get_template(
+            ('auth', dynamic), dynamic,
+            lambda: {
+                'txnType': TradeType.auth,
+                'txnSubType': '01',
+                'bizType': '000201',
+                'channelType': ChannelType.Mobile,
+                'backUrl': self.config.backend_url,
+                'accessType': '0',
+                'merId': self.config.merchant_id,
+                'currencyCode': '156',
+            })
+
+    def sign_data(self, data):
+        with self.metrics.stage_seconds.time(stage='sign', txnType=data.get('txnType')), \
+                trace.span('sign', data):
+            if isinstance(data, TemplateRequest):
+                sign_result = data.sign(self.signer)
+            else:
+                sign_result = self.signer.sign(data)
+        if not sign_result:
+            raise error.UnionpayError('Sign data error')
+        return data
+
+    def post(self, addr, data, **kwargs):
+        txn_type = data.get('txnType')
+        with self.metrics.stage_seconds.time(stage='urlencode', txnType=txn_type), \
+                trace.span('urlencode', data):
+            request_data = self.encode_request(data)
+        logger.debug('[REQ-DATA]%s' % request_data)
+        with self.metrics.stage_seconds.time(stage='http', txnType=txn_type), \
+                trace.span('http', data):
+            response = self.session_pool.post(addr, request_data)
         if response.status_code != requests.codes.ok:
             msg = "[UPACP]request error: %s, reason: %s" \
                 % (response.status_code, response.reason)
             raise error.UnionpayError(msg)
         return response.content
 
+    @gen.coroutine
     def async_post(self, addr, data, **kwargs):
-        pass
-
-    def send_packet(self, addr, data, **kwargs):
-        raw_content = self.post(addr, data)
-        data = self.signer.parse_arguments(raw_content.decode('utf-8'))
+        txn_type = data.get('txnType')
+        with self.metrics.stage_seconds.time(stage='urlencode', txnType=txn_type), \
+                trace.span('urlencode', data):
+            request_data = self.encode_request(data)
+        with self.metrics.stage_seconds.time(stage='http', txnType=txn_type), \
+                trace.span('http', data):
+            response = yield self.async_http_client.fetch(
+                addr,
+                method='POST',
+                body=request_data,
+                headers={'content-type': SessionPool.content_type},
+                request_timeout=self.session_pool.get_timeout(addr),
+                validate_cert=self.verify,
+                raise_error=False
+            )
+        if response.code != 200:
+            msg = "[UPACP]request error: %s, reason: %s" \
+                % (response.code, response.reason)
+            raise error.UnionpayError(msg)
+        raise gen.Return(response.body)
+
+    def unpack(self, raw_content):
+        start = time.time()
+        with trace.span('parse'):
+            data = self.signer.parse_response(raw_content)
+        txn_type = txn_type_label(data.get('txnType'))
+        self.metrics.stage_seconds.observe(time.time() - start, stage='parse', txnType=txn_type)
         if data['respCode'] != '00':
             logger.error(raw_content)
             msg = '[UPACP]respCode: %s orderid: %s' % (
                 data['respCode'], data.get('orderId'))
-            raise error.UnionpayError(msg)
-        self.signer.validate(data)
+            raise error.UnionpayError(msg, data['respCode'])
+        with self.metrics.stage_seconds.time(stage='validate', txnType=txn_type), \
+                trace.span('validate', data):
+            self.signer.validate_response(data)
         return data
 
-    def pay(self, txnamt, orderid, currency_code='156', biz_type="000201", front_url=None, **kwargs):
+    def record_request(self, txn_type, start, resp=None, e=None):
+        if e is not None:
+            resp_code = getattr(e, 'resp_code', None) or 'error'
+        else:
+            resp_code = resp.get('respCode', '') if isinstance(resp, dict) else '00'
+        self.metrics.requests.inc(txnType=txn_type, respCode=resp_code)
+        self.metrics.request_seconds.observe(
+            time.time() - start, txnType=txn_type, respCode=resp_code)
+
+    def send_packet(self, addr, data, **kwargs):
+        raw_content = self.post(addr, data)
+        return self.unpack(raw_content)
+
+    @gen.coroutine
+    def async_send_packet(self, addr, data, **kwargs):
+        raw_content = yield self.async_post(addr, data)
+        data = yield self.run_in_executor(self.unpack, raw_content)
+        raise gen.Return(data)
+
+    def transaction(self, packet, *args, **kwargs):
+        '''
+        @packet: the method build (addr, data, callback) for a transaction
+        '''
+        addr, data, callback = packet(*args, **kwargs)
+        start = time.time()
+        try:
+            with trace.span('transaction', data):
+                resp = self.send_packet(addr, self.sign_data(data))
+        except Exception as e:
+            self.record_request(data.get('txnType'), start, e=e)
+            raise
+        self.record_request(data.get('txnType'), start, resp)
+        return callback(resp) if callback else resp
+
+    @gen.coroutine
+    def async_transaction(self, packet, *args, **kwargs):
+        addr, data, callback = packet(*args, **kwargs)
+        start = time.time()
+        try:
+            with trace.span('transaction', data):
+                data = yield self.run_in_executor(self.sign_data, data)
+                resp = yield self.async_send_packet(addr, data)
+        except Exception as e:
+            self.record_request(data.get('txnType'), start, e=e)
+            raise
+        self.record_request(data.get('txnType'), start, resp)
+        if callback:
+            resp = yield self.run_in_executor(callback, resp)
+        raise gen.Return(resp)
+
+    def pay_packet(self, txnamt, orderid, currency_code='156', biz_type="000201", front_url=None, **kwargs):
         '''
         @txnamt:            trade money amount
         @orderid:           trade order id
@@ -168,107 +417,82 @@ class UnionpayClient(object):
         '''
         order_time = kwargs.get('order_time')
         expire_minutes = kwargs.get('expire_minutes')
-        data = {
-            'version': self.version,
-            'encoding': self.encoding,
-            'signMethod': self.signMethod,
-            'txnType': TradeType.pay,
-            'txnSubType': '01',
-            'bizType': biz_type,
-            'channelType': ChannelType.Mobile,
-            'backUrl': self.config.backend_url,
-            'accessType': '0',
-            'merId': self.config.merchant_id,
-            'orderId': orderid,
-            'txnTime': kwargs.get('order_time', self.get_txn_time()),
-            'txnAmt': txnamt,
-            'currencyCode': currency_code,
-            'payTimeout': self.get_timeout(order_time, expire_minutes),
-            'customerIp': kwargs.get('customer_ip'),
-            'orderDesc': kwargs.get('order_desc')
-        }
+        data = self.pay_template(biz_type, currency_code).bind(
+            orderId=orderid,
+            txnTime=kwargs.get('order_time', self.get_txn_time()),
+            txnAmt=txnamt,
+            payTimeout=self.get_timeout(order_time, expire_minutes),
+            customerIp=kwargs.get('customer_ip'),
+            orderDesc=kwargs.get('order_desc')
+        )
         logger.debug('[REQ-PAY]%s' % data)
-
-        data = self.signer.filter_params(data)
-        sign_result = self.signer.sign(data)
-        if not sign_result:
-            raise error.UnionpayError('Sign data error')
-        return self.send_packet(self.config.app_trans_url, data)
-
-    def query(self, orderid, order_time, query_id=None, **kwargs):
-        data = {
-            'version': self.version,
-            'encoding': self.encoding,
-            'signMethod': self.signMethod,
-            'txnType': TradeType.query,
-            'txnSubType': "00",
-            'bizType': "000000",
-            'accessType': "0",
-            'merId': self.config.merchant_id,
-            'txnTime': order_time,
-            'orderId': orderid
-        }
+        return self.config.app_trans_url, data, None
+
+    def query_packet(self, orderid, order_time, query_id=None, **kwargs):
+        template = self.get_template(
+            ('query',), QUERY_FIELDS,
+            lambda: {
+                'txnType': TradeType.query,
+                'txnSubType': "00",
+                'bizType': "000000",
+                'accessType': "0",
+                'merId': self.config.merchant_id,
+            })
+        data = template.bind(txnTime=order_time, orderId=orderid, queryId=query_id)
         logger.debug('[REQ-QUERY]%s' % data)
-        if query_id:
-            data['queryId'] = query_id
-        sign_result = self.signer.sign(data)
+        return self.config.back_trans_url, data, self.check_query
 
-        if not sign_result:
-            raise error.UnionpayError('Sign data error')
-        resp = self.send_packet(self.config.back_trans_url, data)
+    @staticmethod
+    def check_query(resp):
         if resp['origRespCode'] != '00':
             raise error.UnionpayError('origRespCode error')
         return resp
 
-    def refund(self, refund_orderid, orig_orderid, order_time, amount, **kwargs):
-        data = {
-            'version': self.version,
-            'encoding': self.encoding,
-            'signMethod': self.signMethod,
-            'txnType': TradeType.refund,
-            'txnSubType': '00',
-            'bizType': "000201",
-            'channelType': kwargs.get('channel_type', '07'),
-            'backUrl': self.config.backend_url,
-            'accessType': "0",
-            'merId': self.config.merchant_id,
-            'orderId': refund_orderid,
-            'origQryId': orig_orderid,
-            'txnTime': order_time,
-            'txnAmt': amount
-        }
+    def refund_packet(self, refund_orderid, orig_orderid, order_time, amount, **kwargs):
+        channel_type = kwargs.get('channel_type', '07')
+        template = self.get_template(
+            ('refund', channel_type), BACK_FIELDS,
+            lambda: {
+                'txnType': TradeType.refund,
+                'txnSubType': '00',
+                'bizType': "000201",
+                'channelType': channel_type,
+                'backUrl': self.config.backend_url,
+                'accessType': "0",
+                'merId': self.config.merchant_id,
+            })
+        data = template.bind(
+            orderId=refund_orderid,
+            origQryId=orig_orderid,
+            txnTime=order_time,
+            txnAmt=amount
+        )
         logger.debug('[REQ-REFUND]%s' % data)
-        sign_result = self.signer.sign(data)
-
-        if not sign_result:
-            raise error.UnionpayError('Sign data error')
-        return self.send_packet(self.config.back_trans_url, data)
-
-    def revoke(self, revoke_orderid, orderid, amount, **kwargs):
-        data = {
-            'version': self.version,
-            'encoding': self.encoding,
-            'signMethod': self.signMethod,
-            'txnType': TradeType.revoke,
-            'txnSubType': '00',
-            'bizType': "000201",
-            'channelType': kwargs.get('channel_type', '07'),
-            'backUrl': self.config.backend_url,
-            'accessType': "0",
-            'merId': self.config.merchant_id,
-            'orderId': revoke_orderid,
-            'origQryId': orderid,
-            'txnTime': self.get_txn_time(),
-            'txnAmt': amount
-        }
+        return self.config.back_trans_url, data, None
+
+    def revoke_packet(self, revoke_orderid, orderid, amount, **kwargs):
+        channel_type = kwargs.get('channel_type', '07')
+        template = self.get_template(
+            ('revoke', channel_type), BACK_FIELDS,
+            lambda: {
+                'txnType': TradeType.revoke,
+                'txnSubType': '00',
+                'bizType': "000201",
+                'channelType': channel_type,
+                'backUrl': self.config.backend_url,
+                'accessType': "0",
+                'merId': self.config.merchant_id,
+            })
+        data = template.bind(
+            orderId=revoke_orderid,
+            origQryId=orderid,
+            txnTime=self.get_txn_time(),
+            txnAmt=amount
+        )
         logger.debug('[REQ-REVOKE]%s' % data)
-        sign_result = self.signer.sign(data)
+        return self.config.back_trans_url, data, None
 
-        if not sign_result:
-            raise error.UnionpayError('Sign data error')
-        return self.send_packet(self.config.back_trans_url, data)
-
-    def auth(self, txnamt, orderid, **kwargs):
+    def auth_packet(self, txnamt, orderid, **kwargs):
         '''
         @txnamt:            trade money amount
         @orderid:           trade order id
@@ -277,212 +501,438 @@ class UnionpayClient(object):
         @channel_type:      trade channel: 07-DESKTOP, 08-MOBILE
         @front_url:         browser jump url
         '''
-        data = {
-            'version': self.version,
-            'encoding': self.encoding,
-            'signMethod': self.signMethod,
-            'txnType': TradeType.auth,
-            'txnSubType': '01',
-            'bizType': '000201',
-            'channelType': ChannelType.Mobile,
-            'backUrl': self.config.backend_url,
-            'accessType': '0',
-            'merId': self.config.merchant_id,
-            'orderId': orderid,
-            'txnTime': self.get_txn_time(),
-            'txnAmt': txnamt,
-            'currencyCode': '156',
-            'customerIp': kwargs.get('customer_ip'),
-            'orderDesc': kwargs.get('order_desc')
-        }
+        data = self.auth_template().bind(
+            orderId=orderid,
+            txnTime=self.get_txn_time(),
+            txnAmt=txnamt,
+            customerIp=kwargs.get('customer_ip'),
+            orderDesc=kwargs.get('order_desc')
+        )
 
         logger.debug('[REQ-AUTH]%s' % data)
-
-        data = self.signer.filter_params(data)
-        sign_result = self.signer.sign(data)
-        if not sign_result:
-            raise error.UnionpayError('Sign data error')
-        return self.send_packet(self.config.app_trans_url, data)
-
-    def auth_revoke(self, amount, revoke_orderid, orderid, **kwargs):
-        data = {
-            'version': self.version,
-            'encoding': self.encoding,
-            'signMethod': self.signMethod,
-            'txnType': TradeType.auth_revoke,
-            'txnSubType': '00',
-            'bizType': "000201",
-            'channelType': kwargs.get('channel_type', '07'),
-            'backUrl': self.config.backend_url,
-            'accessType': "0",
-            'merId': self.config.merchant_id,
-            'orderId': revoke_orderid,
-            'origQryId': orderid,
-            'txnTime': self.get_txn_time(),
-            'txnAmt': amount
-        }
+        return self.config.app_trans_url, data, None
+
+    def auth_revoke_packet(self, amount, revoke_orderid, orderid, **kwargs):
+        channel_type = kwargs.get('channel_type', '07')
+        template = self.get_template(
+            ('auth_revoke', channel_type), BACK_FIELDS,
+            lambda: {
+                'txnType': TradeType.auth_revoke,
+                'txnSubType': '00',
+                'bizType': "000201",
+                'channelType': channel_type,
+                'backUrl': self.config.backend_url,
+                'accessType': "0",
+                'merId': self.config.merchant_id,
+            })
+        data = template.bind(
+            orderId=revoke_orderid,
+            origQryId=orderid,
+            txnTime=self.get_txn_time(),
+            txnAmt=amount
+        )
         logger.debug('[REQ-AUTH-REVOKE]%s' % data)
-        sign_result = self.signer.sign(data)
-
-        if not sign_result:
-            raise error.UnionpayError('Sign data error')
-        return self.send_packet(self.config.back_trans_url, data)
-
-    def auth_complete(self, amount, orderid, orig_orderid, **kwargs):
-        data = {
-            'version': self.version,
-            'encoding': self.encoding,
-            'signMethod': self.signMethod,
-            'txnType': TradeType.auth_complete,
-            'txnSubType': '00',
-            'bizType': '000201',
-            'channelType': ChannelType.Mobile,
-            'backUrl': self.config.backend_url,
-            'accessType': '0',
-            'merId': self.config.merchant_id,
-            'orderId': orderid,
-            'txnTime': self.get_txn_time(),
-            'txnAmt': amount,
-            'currencyCode': '156',
-            'customerIp': kwargs.get('customer_ip'),
-            'orderDesc': kwargs.get('order_desc'),
-            'origQryId': orig_orderid
-        }
+        return self.config.back_trans_url, data, None
+
+    def auth_complete_packet(self, amount, orderid, orig_orderid, **kwargs):
+        template = self.get_template(
+            ('auth_complete',), AUTH_COMPLETE_FIELDS,
+            lambda: {
+                'txnType': TradeType.auth_complete,
+                'txnSubType': '00',
+                'bizType': '000201',
+                'channelType': ChannelType.Mobile,
+                'backUrl': self.config.backend_url,
+                'accessType': '0',
+                'merId': self.config.merchant_id,
+                'currencyCode': '156',
+            })
+        data = template.bind(
+            orderId=orderid,
+            txnTime=self.get_txn_time(),
+            txnAmt=amount,
+            customerIp=kwargs.get('customer_ip'),
+            orderDesc=kwargs.get('order_desc'),
+            origQryId=orig_orderid
+        )
 
         logger.debug('[REQ-AUTH-COMPLETE]%s' % data)
-        data = self.signer.filter_params(data)
-        sign_result = self.signer.sign(data)
-        if not sign_result:
-            raise error.UnionpayError('Sign data error')
-        return self.send_packet(self.config.app_trans_url, data)
-
-    def auth_complete_revoke(self, amount, orderid, orig_orderid, **kwargs):
-        data = {
-            'version': self.version,
-            'encoding': self.encoding,
-            'signMethod': self.signMethod,
-            'txnType': TradeType.auth_complete_revoke,
-            'txnSubType': '00',
-            'bizType': '000201',
-            'channelType': ChannelType.Mobile,
-            'backUrl': self.config.backend_url,
-            'accessType': '0',
-            'merId': self.config.merchant_id,
-            'orderId': orderid,
-            'txnTime': self.get_txn_time(),
-            'txnAmt': amount,
-            'currencyCode': '156',
-            'customerIp': kwargs.get('customer_ip'),
-            'orderDesc': kwargs.get('order_desc'),
-            'origQryId': orig_orderid
-        }
+        return self.config.app_trans_url, data, None
+
+    def auth_complete_revoke_packet(self, amount, orderid, orig_orderid, **kwargs):
+        template = self.get_template(
+            ('auth_complete_revoke',), AUTH_COMPLETE_FIELDS,
+            lambda: {
+                'txnType': TradeType.auth_complete_revoke,
+                'txnSubType': '00',
+                'bizType': '000201',
+                'channelType': ChannelType.Mobile,
+                'backUrl': self.config.backend_url,
+                'accessType': '0',
+                'merId': self.config.merchant_id,
+                'currencyCode': '156',
+            })
+        data = template.bind(
+            orderId=orderid,
+            txnTime=self.get_txn_time(),
+            txnAmt=amount,
+            customerIp=kwargs.get('customer_ip'),
+            orderDesc=kwargs.get('order_desc'),
+            origQryId=orig_orderid
+        )
 
         logger.debug('[REQ-AUTH-COMPLETE-REVOKE]%s' % data)
-        data = self.signer.filter_params(data)
-        sign_result = self.signer.sign(data)
-        if not sign_result:
-            raise error.UnionpayError('Sign data error')
-        return self.send_packet(self.config.app_trans_url, data)
+        return self.config.app_trans_url, data, None
 
-    def file_transfer(self, file_type, settle_date, filepath='.', merchant_id=None, prefix=None, **kwargs):
+    def file_transfer_packet(self, file_type, settle_date, filepath='.', merchant_id=None, prefix=None,
+                             stream=False, sink=None, max_memory=None, year=None, processes=None, **kwargs):
+        '''
+        @file_type:     unionpay file type, 00 for settlement files
+        @settle_date:   like 1216
+        @filepath:      directory the archive is extracted to
+        @merchant_id:   merchant id, default is config merchant id
+        @stream:        return util.stream.ArchiveRecords parsed in memory
+                        instead of extracting the archive to filepath,
+                        close it when stopping before the last record
+        @sink:          directory stream mode also writes files to
+        @max_memory:    archive bytes kept in memory, default is
+                        file_max_memory of the client
+        @year:          settle year, default is inferred from settle_date
+        @processes:     parse the extracted files on the parse pool of
+                        the signer with this many workers, 0 for the
+                        cpu count, see Signer.iter_file_data_parallel
+        '''
         # merchant_id = '700000000000001' for test
         merchant_id = merchant_id or self.config.merchant_id
-        data = {
-            'version': self.version,
-            'encoding': self.encoding,
-            'signMethod': self.signMethod,
-            'txnType': TradeType.file_transfer,
-            'txnSubType': '01',
-            'bizType': '000000',
-            'channelType': ChannelType.Mobile,
-            'backUrl': self.config.backend_url,
-            'accessType': '0',
-            'merId': merchant_id,
-            'txnTime': self.get_txn_time(),
-            'settleDate': settle_date,
-            'fileType': file_type
-        }
+        template = self.get_template(
+            ('file_transfer', merchant_id), FILE_TRANSFER_FIELDS,
+            lambda: {
+                'txnType': TradeType.file_transfer,
+                'txnSubType': '01',
+                'bizType': '000000',
+                'channelType': ChannelType.Mobile,
+                'backUrl': self.config.backend_url,
+                'accessType': '0',
+                'merId': merchant_id,
+            })
+        data = template.bind(txnTime=self.get_txn_time(), settleDate=settle_date, fileType=file_type)
 
         logger.debug('[REQ-FILE-TRANSFER]%s' % data)
-        data = self.signer.filter_params(data)
-        sign_result = self.signer.sign(data)
-        if not sign_result:
-            raise error.UnionpayError('Sign data error')
-        resp = self.send_packet(self.config.file_trans_url, data)
-        file_content = base64.b64decode(resp['fileContent'])
-        files = self.signer.save_file_data(
-            settle_date, zlib.decompress(file_content), filepath, merchant_id=merchant_id)
-        linedata = self.signer.reader_file_data(files, settle_date)
-        return linedata
 
+        def save_files(resp):
+            file_content = resp.raw_value('fileContent') if hasattr(resp, 'raw_value') else resp['fileContent']
+            archive = decode_file_content(file_content, max_memory or self.file_max_memory)
+            if stream:
+                return self.iter_archive(archive, settle_date, merchant_id, sink)
+            try:
+                files = self.signer.save_file_data(
+                    settle_date, archive, filepath, merchant_id=merchant_id, year=year)
+            finally:
+                archive.close()
+            if processes is not None:
+                return self.signer.reader_file_data_parallel(files, settle_date, processes or None)
+            return self.signer.reader_file_data(files, settle_date)
+
+        return self.config.file_trans_url, data, save_files
+
+    def iter_archive(self, archive, settle_date, merchant_id, sink=None):
+        '''
+        Return ArchiveRecords of a decoded archive, see util.stream
+        '''
+        return ArchiveRecords(archive, self.signer.iter_file_data(settle_date, archive, merchant_id, sink=sink))
 
-class UnionpayWapClient(UnionpayClient):
+    def fetch_archive(self, cache, key, file_type, day, merchant_id):
+        '''
+        Download the archive of one settle date into cache, return its
+        manifest entry
+        '''
+        addr, data, _ = self.file_transfer_packet(file_type, day.strftime('%m%d'), merchant_id=merchant_id)
+
+        def store(resp):
+            file_content = resp.raw_value('fileContent') if hasattr(resp, 'raw_value') else resp['fileContent']
+            with decode_file_content(file_content, self.file_max_memory) as archive:
+                return cache.store(key, archive, fileName=resp.get('fileName'))
+
+        return self.transaction(lambda: (addr, data, store))
+
+    def file_transfer_range(self, start, end, file_types=('00',), merchants=None, cache_dir='.', concurrency=4,
+                            today=None):
+        '''
+        @start:         first settle date, date or str like 20151216
+        @end:           last settle date, included
+        @file_types:    unionpay file types
+        @merchants:     merchant ids, default is config merchant id
+        @cache_dir:     SettlementCache directory, dates already in its
+                        manifest are not downloaded again
+        @concurrency:   downloads in flight
+        @today:         default is date.today(), the request only carries
+                        MMDD so every date has to be within the past year
+
+        Return ObjectDict(date, settle_date, year, merchant_id, file_type,
+        path, cached, error) per date, merchant and file type in that
+        order. path is the cached zip, read it with Signer.iter_file_data.
+        A failed download carries the exception and is fetched again by
+        the next call
+        '''
+        days = list(iter_dates(start, end))
+        outside = [day for day in days if not in_settle_window(day, today)]
+        if outside:
+            raise error.UnionpayError(
+                'settle dates %s to %s are outside the past year, the gateway would send another year' % (
+                    outside[0].strftime('%Y%m%d'), outside[-1].strftime('%Y%m%d')))
+        cache = SettlementCache(cache_dir)
+        merchants = merchants or [self.config.merchant_id]
+        tasks = [(day, merchant_id, file_type)
+                 for day in days for merchant_id in merchants for file_type in file_types]
+
+        def fetch(task):
+            day, merchant_id, file_type = task
+            result = ObjectDict(
+                date=day, settle_date=day.strftime('%m%d'), year=day.year, merchant_id=merchant_id,
+                file_type=file_type, path=None, cached=True, error=None)
+            key = cache.key(merchant_id, file_type, day)
+            entry = cache.get(key)
+            if entry is None:
+                result.cached = False
+                try:
+                    entry = self.fetch_archive(cache, key, file_type, day, merchant_id)
+                except Exception as e:
+                    logger.warning('[FILE-RANGE]%s failed: %s' % (key, e))
+                    result.error = e
+                    return result
+            result.path = cache.object_path(entry)
+            return result
+
+        with ThreadPoolExecutor(concurrency) as executor:
+            return list(executor.map(fetch, tasks))
 
     def pay(self, txnamt, orderid, currency_code='156', biz_type="000201", front_url=None, **kwargs):
+        '''
+        Pay through the app gateway, see pay_packet for the params
+        '''
+        return self.transaction(self.pay_packet, txnamt, orderid, currency_code, biz_type, front_url, **kwargs)
+
+    def query(self, orderid, order_time, query_id=None, **kwargs):
+        '''
+        @orderid:       trade order id
+        @order_time:    txnTime of the order
+        @query_id:      queryId of the order if known
+        '''
+        return self.transaction(self.query_packet, orderid, order_time, query_id, **kwargs)
+
+    def query_many(self, orders, concurrency=10):
+        '''
+        @orders:        iterable of (orderId, txnTime[, queryId]) tuples
+        @concurrency:   max in-flight queries, keep it <= pool_size so every
+                        worker gets a keep-alive connection
+
+        Yield ObjectDict(order, result, error) as each query completes,
+        a failed order carries the exception and never aborts the batch
+        '''
+        def query(order):
+            try:
+                return ObjectDict(order=order, result=self.query(*order), error=None)
+            except Exception as e:
+                logger.warning('[QUERY-MANY]order %s failed: %s' % (order[0], e))
+                return ObjectDict(order=order, result=None, error=e)
+
+        executor = ThreadPoolExecutor(concurrency)
+        pending = set()
+        try:
+            for order in orders:
+                pending.add(executor.submit(query, tuple(order)))
+                if len(pending) < concurrency:
+                    continue
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            for future in as_completed(pending):
+                yield future.result()
+        finally:
+            # a caller breaking out does not wait for the queries in flight
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def refund(self, refund_orderid, orig_orderid, order_time, amount, **kwargs):
+        '''
+        @refund_orderid:    order id of the refund
+        @orig_orderid:      queryId of the paid order
+        @order_time:        txnTime of the refund
+        @amount:            refund money amount
+        '''
+        return self.transaction(self.refund_packet, refund_orderid, orig_orderid, order_time, amount, **kwargs)
+
+    def revoke(self, revoke_orderid, orderid, amount, **kwargs):
+        '''
+        @revoke_orderid:    order id of the revoke
+        @orderid:           queryId of the paid order
+        @amount:            revoke money amount
+        '''
+        return self.transaction(self.revoke_packet, revoke_orderid, orderid, amount, **kwargs)
+
+    def auth(self, txnamt, orderid, **kwargs):
+        '''
+        Pre-authorize through the app gateway, see auth_packet for the params
+        '''
+        return self.transaction(self.auth_packet, txnamt, orderid, **kwargs)
+
+    def auth_revoke(self, amount, revoke_orderid, orderid, **kwargs):
+        '''
+        @amount:            revoke money amount
+        @revoke_orderid:    order id of the revoke
+        @orderid:           queryId of the authorized order
+        '''
+        return self.transaction(self.auth_revoke_packet, amount, revoke_orderid, orderid, **kwargs)
+
+    def auth_complete(self, amount, orderid, orig_orderid, **kwargs):
+        '''
+        @amount:        completed money amount
+        @orderid:       order id of the completion
+        @orig_orderid:  queryId of the authorized order
+        '''
+        return self.transaction(self.auth_complete_packet, amount, orderid, orig_orderid, **kwargs)
+
+    def auth_complete_revoke(self, amount, orderid, orig_orderid, **kwargs):
+        '''
+        @amount:        revoked money amount
+        @orderid:       order id of the revoke
+        @orig_orderid:  queryId of the completion
+        '''
+        return self.transaction(self.auth_complete_revoke_packet, amount, orderid, orig_orderid, **kwargs)
+
+    def file_transfer(self, file_type, settle_date, **kwargs):
+        '''
+        Download settlement files, see file_transfer_packet for the params
+        '''
+        return self.transaction(self.file_transfer_packet, file_type, settle_date, **kwargs)
+
+    def async_pay(self, txnamt, orderid, currency_code='156', biz_type="000201", front_url=None, **kwargs):
+        '''
+        Future of pay
+        '''
+        return self.async_transaction(self.pay_packet, txnamt, orderid, currency_code, biz_type, front_url, **kwargs)
+
+    def async_query(self, orderid, order_time, query_id=None, **kwargs):
+        '''
+        Future of query
+        '''
+        return self.async_transaction(self.query_packet, orderid, order_time, query_id, **kwargs)
+
+    def async_refund(self, refund_orderid, orig_orderid, order_time, amount, **kwargs):
+        '''
+        Future of refund
+        '''
+        return self.async_transaction(self.refund_packet, refund_orderid, orig_orderid, order_time, amount, **kwargs)
+
+    def async_revoke(self, revoke_orderid, orderid, amount, **kwargs):
+        '''
+        Future of revoke
+        '''
+        return self.async_transaction(self.revoke_packet, revoke_orderid, orderid, amount, **kwargs)
+
+    def async_auth(self, txnamt, orderid, **kwargs):
+        '''
+        Future of auth
+        '''
+        return self.async_transaction(self.auth_packet, txnamt, orderid, **kwargs)
+
+    def async_auth_revoke(self, amount, revoke_orderid, orderid, **kwargs):
+        '''
+        Future of auth_revoke
+        '''
+        return self.async_transaction(self.auth_revoke_packet, amount, revoke_orderid, orderid, **kwargs)
+
+    def async_auth_complete(self, amount, orderid, orig_orderid, **kwargs):
+        '''
+        Future of auth_complete
+        '''
+        return self.async_transaction(self.auth_complete_packet, amount, orderid, orig_orderid, **kwargs)
+
+    def async_auth_complete_revoke(self, amount, orderid, orig_orderid, **kwargs):
+        '''
+        Future of auth_complete_revoke
+        '''
+        return self.async_transaction(self.auth_complete_revoke_packet, amount, orderid, orig_orderid, **kwargs)
+
+    def async_file_transfer(self, file_type, settle_date, **kwargs):
+        '''
+        Future of file_transfer
+        '''
+        return self.async_transaction(self.file_transfer_packet, file_type, settle_date, **kwargs)
+
+
+class UnionpayWapClient(UnionpayClient):
+
+    def pay(self, txnamt, orderid, currency_code='156', biz_type="000201", front_url=None, form_format='html',
+            **kwargs):
+        '''
+        @form_format:   html - the auto-submit page
+                        fields - {action, method, fields: [(name, value)]}
+                        json - the fields dict as json
+        '''
         order_time = kwargs.get('order_time')
         expire_minutes = kwargs.get('expire_minutes')
-        data = {
-            'version': self.version,
-            'encoding': self.encoding,
-            'signMethod': self.signMethod,
-            'txnType': TradeType.pay,
-            'txnSubType': '01',
-            'bizType': biz_type,
-            'channelType': ChannelType.Desktop,
-            'backUrl': self.config.backend_url,
-            'accessType': '0',
-            'merId': self.config.merchant_id,
-            'orderId': orderid,
-            'txnTime': self.get_txn_time(),
-            'txnAmt': txnamt,
-            'currencyCode': currency_code,
-            'payTimeout': self.get_timeout(order_time, expire_minutes),
-            'customerIp': kwargs.get('customer_ip'),
-            'orderDesc': kwargs.get('order_desc')
-        }
+        template = self.pay_template(biz_type, currency_code, ChannelType.Desktop, PAY_FIELDS + ('frontUrl',))
+        data = template.bind(
+            orderId=orderid,
+            txnTime=self.get_txn_time(),
+            txnAmt=txnamt,
+            payTimeout=self.get_timeout(order_time, expire_minutes),
+            customerIp=kwargs.get('customer_ip'),
+            orderDesc=kwargs.get('order_desc')
+        )
         logger.debug('[REQ-PAY]%s' % data)
 
         if not front_url:
             raise error.UnionpayError('must set front_url when desktop')
 
         data.update(frontUrl=front_url)
-        data = self.signer.filter_params(data)
-        sign_result = self.signer.sign(data)
-        if not sign_result:
-            raise error.UnionpayError('Sign data error')
-        data['signature'] = data['signature'].decode('utf-8')
-        return make_submit_form(data, self.config.front_trans_url)
-
-    def auth(self, txnamt, orderid, front_url=None, **kwargs):
-        data = {
-            'version': self.version,
-            'encoding': self.encoding,
-            'signMethod': self.signMethod,
-            'txnType': TradeType.auth,
-            'txnSubType': '01',
-            'bizType': '000201',
-            'channelType': ChannelType.Mobile,
-            'backUrl': self.config.backend_url,
-            'accessType': '0',
-            'merId': self.config.merchant_id,
-            'orderId': orderid,
-            'txnTime': self.get_txn_time(),
-            'txnAmt': txnamt,
-            'currencyCode': '156',
-            'customerIp': kwargs.get('customer_ip'),
-            'orderDesc': kwargs.get('order_desc')
-        }
+        return self.submit_form(data, form_format)
+
+    def auth(self, txnamt, orderid, front_url=None, form_format='html', **kwargs):
+        data = self.auth_template(AUTH_FIELDS + ('frontUrl',)).bind(
+            orderId=orderid,
+            txnTime=self.get_txn_time(),
+            txnAmt=txnamt,
+            customerIp=kwargs.get('customer_ip'),
+            orderDesc=kwargs.get('order_desc')
+        )
 
         if not front_url:
             raise error.UnionpayError('must set front_url when desktop')
 
         data.update(frontUrl=front_url)
-        data = self.signer.filter_params(data)
-        sign_result = self.signer.sign(data)
+        return self.submit_form(data, form_format)
+
+    def async_pay(self, txnamt, orderid, currency_code='156', biz_type="000201", front_url=None, form_format='html',
+                  **kwargs):
+        '''
+        Future of the submit form of pay, signed in the executor, nothing
+        is posted to the gateway
+        '''
+        return self.run_in_executor(
+            lambda: self.pay(txnamt, orderid, currency_code, biz_type, front_url, form_format, **kwargs))
+
+    def async_auth(self, txnamt, orderid, front_url=None, form_format='html', **kwargs):
+        '''
+        Future of the submit form of auth, signed in the executor, nothing
+        is posted to the gateway
+        '''
+        return self.run_in_executor(lambda: self.auth(txnamt, orderid, front_url, form_format, **kwargs))
+
+    def submit_form(self, data, form_format='html'):
+        sign_result = data.sign(self.signer)
         if not sign_result:
             raise error.UnionpayError('Sign data error')
         data['signature'] = data['signature'].decode('utf-8')
-        return make_submit_form(data, self.config.front_trans_url)
+        if form_format == 'html':
+            return make_submit_form(data, self.config.front_trans_url)
+        if form_format == 'fields':
+            return make_submit_fields(data, self.config.front_trans_url)
+        if form_format == 'json':
+            return json.dumps(make_submit_fields(data, self.config.front_trans_url))
+        raise error.UnionpayError('unknown form format %s' % form_format)
 
 
 def main():
@@ -0,0 +1,248 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Columnar NumPy representation of upacp settlement files
+
+The fixed-width lines are mapped straight onto a structured dtype with
+np.frombuffer, then converted column by column: amounts to int64 fen,
+txnTime to datetime64 and ids to fixed-width bytes. numpy is optional
+and only needed by this module.
+'''
+
+import os.path
+from datetime import datetime
+
+import numpy as np
+from numpy.lib import recfunctions
+
+from .signer import get_record_type
+from .util.helper import settle_year
+from .util.record import NormalRecord
+
+
+# amounts are digits in fen, the 13 width ones carry a C/D sign prefix
+AMOUNT_FIELDS = (
+    'txnAmt', 'origTxnAmt', 'merFee', 'settleAmt', 'subMerAmt',
+    'netAmt', 'discountAmt', 'invoiceAmt', 'installmentFee',
+)
+TIME_FIELDS = ('txnTime',)
+DEFAULT_FIELDS = (
+    'txnType', 'txnSubType', 'txnTime', 'txnAmt', 'merFee', 'settleAmt',
+    'merId', 'orderId', 'queryId', 'origQryId',
+)
+
+# TradeType pay and auth_complete move money in, refund, revoke and
+# auth_complete_revoke move it back out
+PAYMENT_TYPES = (b'01', b'03')
+REVERSAL_TYPES = (b'04', b'31', b'33')
+
+
+def _raw_dtype(record_type, fields, itemsize):
+    names, formats, offsets = [], [], []
+
+    def add(name, width, offset):
+        names.append(name)
+        formats.append('S%d' % width)
+        offsets.append(offset)
+
+    specs = dict((spec.name, spec) for spec in record_type.schema)
+    for name in fields:
+        spec = specs[name]
+        width = spec.stop - spec.start
+        if name in TIME_FIELDS:
+            for i, part in enumerate(('MM', 'DD', 'hh', 'mm', 'ss')):
+                add('%s_%s' % (name, part), 2, spec.start + i * 2)
+        elif name in AMOUNT_FIELDS and width == 13:
+            add(name, width, spec.start)
+            add(name + '_sign', 1, spec.start)
+            add(name + '_digits', 12, spec.start + 1)
+        else:
+            add(name, width, spec.start)
+    return np.dtype({
+        'names': names,
+        'formats': formats,
+        'offsets': offsets,
+        'itemsize': itemsize,
+    })
+
+
+def _frame(data, width):
+    '''
+    @data:  raw file content
+    @width: minimal bytes of a line
+    Return (buffer, itemsize), short or ragged lines are padded to width
+    '''
+    itemsize = data.find(b'\n') + 1
+    if itemsize > width and len(data) % itemsize == 0:
+        rows = np.frombuffer(data, np.uint8).reshape(-1, itemsize)
+        if (rows[:, -1] == 10).all():
+            return data, itemsize
+    lines = [line.ljust(width)[:width] for line in data.splitlines() if line.strip()]
+    return b''.join(lines), width
+
+
+def _to_int(column):
+    column = np.char.strip(column)
+    column[column == b''] = b'0'
+    return column.astype(np.int64)
+
+
+def _to_amount(raw, name):
+    if name + '_sign' not in raw.dtype.names:
+        return _to_int(raw[name])
+    sign = raw[name + '_sign']
+    signed = (sign == b'C') | (sign == b'D')
+    plain = raw[name].copy()
+    plain[signed] = b'0'
+    value = _to_int(plain)
+    digits = _to_int(raw[name + '_digits'])
+    value[signed] = digits[signed]
+    value[sign == b'D'] *= -1
+    return value
+
+
+def _to_datetime(raw, name, settle_date, year):
+    parts = [_to_int(raw['%s_%s' % (name, part)]) for part in ('MM', 'DD', 'hh', 'mm', 'ss')]
+    month, day, hour, minute, second = parts
+    years = np.full(len(raw), year, np.int64)
+    if settle_date:
+        # a december transaction settled in january belongs to last year
+        years[month > int(settle_date[:2])] -= 1
+    months = ((years - 1970) * 12 + month - 1).astype('datetime64[M]')
+    days = months.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+    seconds = hour * 3600 + minute * 60 + second
+    value = days.astype('datetime64[s]') + seconds.astype('timedelta64[s]')
+    value[month == 0] = np.datetime64('NaT')
+    return value
+
+
+def load_bytes(data, record_type=NormalRecord, settle_date=None, year=None, fields=None):
+    '''
+    @data:          content of one settlement file
+    @record_type:   layout of the file, see unionpay.util.record
+    @settle_date:   like 1216, added as the settleDate column
+    @year:          settle year, default is inferred from settle_date
+    @fields:        fields to load, default is DEFAULT_FIELDS
+    Return a numpy structured array
+    '''
+    year = year or (settle_year(settle_date) if settle_date else datetime.now().year)
+    fields = [name for name in (fields or DEFAULT_FIELDS) if name in record_type.fields]
+    width = max(spec.stop for spec in record_type.schema if spec.name in fields)
+    buf, itemsize = _frame(data, width)
+    raw = np.frombuffer(buf, dtype=_raw_dtype(record_type, fields, itemsize))
+
+    specs = dict((spec.name, spec) for spec in record_type.schema)
+    dtype = []
+    for name in fields:
+        if name in AMOUNT_FIELDS:
+            dtype.append((name, np.int64))
+        elif name in TIME_FIELDS:
+            dtype.append((name, 'datetime64[s]'))
+        else:
+            dtype.append((name, 'S%d' % (specs[name].stop - specs[name].start)))
+    dtype.append(('settleDate', 'datetime64[D]'))
+
+    records = np.empty(len(raw), dtype=dtype)
+    for name in fields:
+        if name in AMOUNT_FIELDS:
+            records[name] = _to_amount(raw, name)
+        elif name in TIME_FIELDS:
+            records[name] = _to_datetime(raw, name, settle_date, year)
+        else:
+            records[name] = np.char.strip(raw[name])
+    if settle_date:
+        records['settleDate'] = np.datetime64(
+            '%04d-%s-%s' % (year, settle_date[:2], settle_date[2:4]), 'D')
+    else:
+        records['settleDate'] = np.datetime64('NaT')
+    return records
+
+
+def load_file(filepath, settle_date=None, year=None, fields=None):
+    '''
+    @filepath: settlement file, the layout is picked by its name
+    '''
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    record_type = get_record_type(os.path.basename(filepath))
+    return load_bytes(data, record_type, settle_date, year, fields)
+
+
+def load_files(files_list, settle_date=None, year=None, fields=None):
+    '''
+    @files_list: files returned by Signer.save_file_data
+    Return {filename: structured array}
+    '''
+    return dict(
+        (os.path.basename(item), load_file(item, settle_date, year, fields))
+        for item in files_list
+    )
+
+
+def group_totals(records, keys, value='txnAmt'):
+    '''
+    @records:   structured array from load_bytes
+    @keys:      field name or names like ('merId', 'txnType')
+    @value:     the amount field to sum
+    Return a structured array of keys, count and total
+    '''
+    keys = [keys] if isinstance(keys, str) else list(keys)
+    groups, inverse = np.unique(
+        recfunctions.repack_fields(records[keys]), return_inverse=True)
+    inverse = inverse.reshape(-1)
+    totals = np.zeros(len(groups), np.int64)
+    np.add.at(totals, inverse, records[value])
+    result = np.empty(len(groups), dtype=groups.dtype.descr + [
+        ('count', np.int64), ('total', np.int64)])
+    for key in keys:
+        result[key] = groups[key]
+    result['count'] = np.bincount(inverse, minlength=len(groups))
+    result['total'] = totals
+    return result
+
+
+def totals_by_txn_type(records, value='txnAmt'):
+    return group_totals(records, 'txnType', value)
+
+
+def totals_by_merchant(records, value='txnAmt'):
+    return group_totals(records, 'merId', value)
+
+
+def totals_by_settle_date(records, value='txnAmt'):
+    return group_totals(records, 'settleDate', value)
+
+
+def signed_amounts(records, value='txnAmt'):
+    '''
+    Payments are positive, refunds and revokes negative, others zero
+    '''
+    sign = np.where(np.isin(records['txnType'], PAYMENT_TYPES), 1, 0)
+    sign[np.isin(records['txnType'], REVERSAL_TYPES)] = -1
+    return records[value] * sign
+
+
+def netting(records, keys='merId', value='txnAmt'):
+    '''
+    @keys: group the netting by these fields
+    Return a structured array of keys, payment, refund and net amounts
+    '''
+    keys = [keys] if isinstance(keys, str) else list(keys)
+    groups, inverse = np.unique(
+        recfunctions.repack_fields(records[keys]), return_inverse=True)
+    inverse = inverse.reshape(-1)
+    signed = signed_amounts(records, value)
+    payment = np.zeros(len(groups), np.int64)
+    refund = np.zeros(len(groups), np.int64)
+    np.add.at(payment, inverse, np.where(signed > 0, signed, 0))
+    np.add.at(refund, inverse, np.where(signed < 0, -signed, 0))
+    result = np.empty(len(groups), dtype=groups.dtype.descr + [
+        ('payment', np.int64), ('refund', np.int64), ('net', np.int64)])
+    for key in keys:
+        result[key] = groups[key]
+    result['payment'] = payment
+    result['refund'] = refund
+    result['net'] = payment - refund
+    return result
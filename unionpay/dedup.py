@@ -0,0 +1,195 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Dedup cache for unionpay back notifies
+
+Unionpay retries a notify until it gets a response, a retry of a notify
+that was already verified and handled gets the cached response without
+parsing, verifying or handling it again.
+'''
+
+import json
+import threading
+import time
+import sqlite3
+from collections import OrderedDict
+
+
+DEDUP_FIELDS = ('merId', 'orderId', 'queryId', 'txnType', 'respCode')
+
+
+def dedup_key(data, fields=DEDUP_FIELDS):
+    '''
+    @data: notify arguments
+    Return None when the notify can not be identified
+    '''
+    if not data.get('orderId'):
+        return None
+    return '|'.join(data.get(name) or '' for name in fields)
+
+
+class DedupBackend(object):
+
+    # blocking backends are called off the IOLoop
+    blocking = False
+
+    def get(self, key):
+        '''
+        Return the cached response or None
+        '''
+        raise NotImplementedError
+
+    def set(self, key, response):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryDedup(DedupBackend):
+
+    '''
+    In-process LRU with TTL eviction
+    '''
+
+    def __init__(self, max_size=100000, ttl=86400):
+        '''
+        @max_size:  max cached notifies, least recently used are evicted
+        @ttl:       seconds a handled notify is remembered
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            expires, response = item
+            if expires < time.time():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return response
+
+    def set(self, key, response):
+        with self.lock:
+            self.items[key] = (time.time() + self.ttl, response)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class SQLiteDedup(DedupBackend):
+
+    '''
+    A local file shared by the worker processes of one host, stands in
+    for a shared store like redis
+    '''
+
+    blocking = True
+
+    def __init__(self, path, max_size=1000000, ttl=86400, prune_interval=60):
+        '''
+        @path:              sqlite database file
+        @max_size:          rows kept after pruning
+        @ttl:               seconds a handled notify is remembered
+        @prune_interval:    seconds between two prunes
+        '''
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self.last_prune = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS notify_dedup '
+            '(key TEXT PRIMARY KEY, response TEXT, expires REAL)')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS notify_dedup_expires ON notify_dedup (expires)')
+        self.conn.commit()
+
+    @staticmethod
+    def encode(response):
+        '''
+        @response: what handle_notify returned, str, bytes or dict
+        A dict is stored as the json tornado writes for it and read back
+        as that str, bytes stay bytes
+        '''
+        if isinstance(response, dict):
+            return json.dumps(response)
+        if isinstance(response, bytes):
+            return sqlite3.Binary(response)
+        if isinstance(response, str):
+            return response
+        raise TypeError('can not cache a %s response' % type(response).__name__)
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT response FROM notify_dedup WHERE key = ? AND expires >= ?',
+                (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, response):
+        response = self.encode(response)
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO notify_dedup VALUES (?, ?, ?)',
+                (key, response, now + self.ttl))
+            if now - self.last_prune > self.prune_interval:
+                self.prune(now)
+            self.conn.commit()
+
+    def prune(self, now):
+        self.last_prune = now
+        self.conn.execute('DELETE FROM notify_dedup WHERE expires < ?', (now,))
+        self.conn.execute(
+            'DELETE FROM notify_dedup WHERE key IN (SELECT key FROM notify_dedup '
+            'ORDER BY expires DESC LIMIT -1 OFFSET ?)', (self.max_size,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class NotifyDedup(object):
+
+    '''
+    A local LRU in front of an optional shared backend
+    '''
+
+    def __init__(self, max_size=100000, ttl=86400, shared=None):
+        self.local = MemoryDedup(max_size, ttl)
+        self.shared = shared
+
+    def get(self, key):
+        response = self.local.get(key)
+        if response is None and self.shared is not None:
+            response = self.shared.get(key)
+            if response is not None:
+                self.local.set(key, response)
+        return response
+
+    def set(self, key, response):
+        self.local.set(key, response)
+        if self.shared is not None:
+            self.shared.set(key, response)
+
+    @property
+    def blocking(self):
+        return self.shared is not None and self.shared.blocking
+
+    def close(self):
+        if self.shared is not None:
+            self.shared.close()
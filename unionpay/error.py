@@ -4,7 +4,14 @@
 
 
 class UnionpayError(Exception):
-    pass
+
+    def __init__(self, message='', resp_code=None):
+        '''
+        @message:   error message
+        @resp_code: respCode of the gateway response if there is one
+        '''
+        super(UnionpayError, self).__init__(message)
+        self.resp_code = resp_code
 
 
 class ParseArgsError(Exception):
@@ -0,0 +1,311 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+A local stand-in of the unionpay gateway for end-to-end load tests
+
+It verifies the signature of every request and answers with a signed
+response, file transfers get a synthetic settlement zip as fileContent:
+a zip of ZM_/ZME_ files, zlib deflated and base64 encoded.
+
+    python -m unionpay.gateway --port=8090 --export_cert=/tmp/gateway.cer
+
+The gateway signs with --pfx_filepath, point x509_filepath of the client
+config at the exported cert so the client trusts its responses.
+'''
+
+import base64
+import io
+import itertools
+import logging
+import os
+import random
+import tempfile
+import time
+import zlib
+import tornado.httpserver
+import tornado.ioloop
+import tornado.log
+import tornado.web
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.options import OptionParser
+from zipfile import ZIP_DEFLATED, ZipFile
+from .error import SignatureValidateError
+from .signer import Signer
+from .util.record import ErrorRecord, NormalRecord
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+
+PEM_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pem')
+
+options = OptionParser()
+options.define("port", default=8090, help="run on the given port", type=int)
+options.define("pfx_filepath", default=os.path.join(PEM_PATH, 'PM_700000000000001_acp.pfx'),
+               help="pfx signing gateway responses", type=str)
+options.define("password", default='000000', help="pfx password", type=str)
+options.define("x509_filepath", default=None, help="cert verifying requests, default is the cert of the pfx", type=str)
+options.define("export_cert", default=None, help="write the cert of the gateway pfx here for the client config", type=str)
+options.define("latency", default=0.0, help="mean seconds added to every response", type=float)
+options.define("jitter", default=0.0, help="uniform +/- seconds around latency", type=float)
+options.define("error_rate", default=0.0, help="share of requests answered with http 500", type=float)
+options.define("fail_rate", default=0.0, help="share of requests answered with a failed respCode", type=float)
+options.define("file_lines", default=1000, help="lines of the settlement file of a file transfer", type=int)
+options.define("workers", default=4, help="threads verifying and signing", type=int)
+
+
+# acp respCode values
+RESP_SUCCESS = '00'
+RESP_FAILED = '03'
+RESP_BAD_SIGNATURE = '11'
+
+# echoed from the request into the response
+ECHO_FIELDS = (
+    'version', 'encoding', 'signMethod', 'txnType', 'txnSubType', 'bizType', 'accessType',
+    'merId', 'orderId', 'txnTime', 'txnAmt', 'currencyCode', 'reqReserved', 'settleDate', 'fileType',
+)
+
+# txnType of the generated lines, in turn
+SETTLEMENT_TXN_TYPES = ('01', '01', '01', '04', '31')
+
+
+def iter_settlement_lines(count, merchant_id, settle_date='1216', record_type=NormalRecord):
+    '''
+    @count:         lines to generate
+    @merchant_id:   merId of every line
+    @settle_date:   MMDD, the txnTime of every line
+
+    Only the template lines are packed field by field, the orderId and
+    queryId of every line are spliced in, so millions of lines are cheap
+    '''
+    spec = dict((field.name, field) for field in record_type.schema)
+    templates = []
+    for i, txn_type in enumerate(SETTLEMENT_TXN_TYPES):
+        templates.append(record_type.pack({
+            'txnTime': '%s%06d' % (settle_date, 103000 + i),
+            'txnAmt': '%012d' % (100 * (i + 1)),
+            'txnType': txn_type,
+            'txnSubType': '01',
+            'bizType': '000201',
+            'merId': merchant_id,
+            'merFee': 'D%012d' % (i + 1),
+            'settleAmt': 'C%012d' % (100 * (i + 1)),
+            'orderId': '',
+            'queryId': '',
+        }))
+    # error files carry no orderId
+    order, query = spec.get('orderId'), spec.get('queryId')
+    for i in range(count):
+        line = templates[i % len(templates)]
+        if order is not None:
+            line = line[:order.start] + (b'ORDER%027d' % i) + line[order.stop:]
+        if query is not None:
+            line = line[:query.start] + (b'%021d' % i) + line[query.stop:]
+        yield line
+
+
+def make_settlement_zip(count, merchant_id, settle_date='1216', error_count=0, chunk_lines=4096):
+    '''
+    @count:         lines of the ZM_ file
+    @error_count:   lines of the ZME_ file, none is written when 0
+    Return the zip archive bytes
+    '''
+    buf = io.BytesIO()
+    members = [('INN%s88ZM_%s' % (settle_date, merchant_id), count, NormalRecord)]
+    if error_count:
+        members.append(('INN%s88ZME_%s' % (settle_date, merchant_id), error_count, ErrorRecord))
+    with ZipFile(buf, 'w', ZIP_DEFLATED) as zfile:
+        for name, lines, record_type in members:
+            with zfile.open(name, 'w', force_zip64=True) as member:
+                chunk = []
+                for line in iter_settlement_lines(lines, merchant_id, settle_date, record_type):
+                    chunk.append(line)
+                    if len(chunk) >= chunk_lines:
+                        member.write(b''.join(chunk))
+                        chunk = []
+                member.write(b''.join(chunk))
+    return buf.getvalue()
+
+
+def make_file_content(archive):
+    '''
+    @archive: zip bytes
+    Return the fileContent field of a file transfer response
+    '''
+    return base64.b64encode(zlib.compress(archive)).decode('ascii')
+
+
+def export_cert(pfx_filepath, password, filepath):
+    '''
+    Write the PEM cert of a pfx, needs cryptography
+    '''
+    from cryptography.hazmat.primitives.serialization import Encoding, pkcs12
+    with open(pfx_filepath, 'rb') as f:
+        _, cert, _ = pkcs12.load_key_and_certificates(f.read(), password.encode('utf-8'))
+    with open(filepath, 'wb') as f:
+        f.write(cert.public_bytes(Encoding.PEM))
+    return filepath
+
+
+class GatewayHandler(tornado.web.RequestHandler):
+
+    '''
+    Every endpoint dispatches on txnType, like the real gateway does
+    '''
+
+    def get_all_arguments(self):
+        return dict((name, self.get_argument(name)) for name in self.request.arguments.keys())
+
+    @gen.coroutine
+    def post(self):
+        app = self.application
+        data = self.get_all_arguments()
+        delay = app.get_delay()
+        if delay:
+            yield gen.sleep(delay)
+        if app.error_rate and random.random() < app.error_rate:
+            raise tornado.web.HTTPError(500)
+        body = yield app.run(app.respond, data)
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.write(body)
+
+
+class Gateway(tornado.web.Application):
+
+    def __init__(self, signer, verifier=None, latency=0, jitter=0, error_rate=0, fail_rate=0,
+                 file_lines=1000, workers=4):
+        '''
+        @signer:        Signer of the gateway, signs responses
+        @verifier:      Signer whose cert verifies requests, default is signer
+        @latency:       mean seconds added to every response
+        @jitter:        uniform +/- seconds around latency
+        @error_rate:    share of requests answered with http 500
+        @fail_rate:     share of requests answered with respCode 03
+        @file_lines:    lines of the settlement file of a file transfer
+        @workers:       threads verifying and signing
+        '''
+        handlers = [
+            (r"/gateway/api/(?:appTransReq|backTransReq|queryTrans|frontTransReq)\.do$", GatewayHandler),
+            # file_trans_url is the root of its own port
+            (r"/(?:gateway/api/fileTransReq\.do)?$", GatewayHandler),
+        ]
+        tornado.web.Application.__init__(self, handlers)
+        self.signer = signer
+        self.verifier = verifier or signer
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.fail_rate = fail_rate
+        self.file_lines = file_lines
+        self.executor = ThreadPoolExecutor(workers)
+        self.file_contents = {}
+        self.query_ids = itertools.count(1)
+
+    def get_delay(self):
+        if not self.latency and not self.jitter:
+            return 0
+        return max(0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def run(self, func, *args):
+        return tornado.ioloop.IOLoop.current().run_in_executor(self.executor, func, *args)
+
+    def next_query_id(self):
+        return '%s%07d' % (time.strftime('%Y%m%d%H%M%S'), next(self.query_ids) % 10000000)
+
+    def file_content(self, merchant_id, settle_date):
+        '''
+        Archives are cached, building one is much slower than serving it
+        '''
+        key = (merchant_id, settle_date)
+        if key not in self.file_contents:
+            archive = make_settlement_zip(self.file_lines, merchant_id, settle_date)
+            self.file_contents[key] = make_file_content(archive)
+        return self.file_contents[key]
+
+    def respond(self, data):
+        '''
+        @data: request arguments
+        Return the signed, urlencoded response body
+        '''
+        response = dict((name, data[name]) for name in ECHO_FIELDS if data.get(name))
+        try:
+            self.verifier.validate(dict(data))
+        except (SignatureValidateError, KeyError, ValueError, TypeError):
+            response.update(respCode=RESP_BAD_SIGNATURE, respMsg='signature invalid')
+            return self.pack(response)
+
+        if self.fail_rate and random.random() < self.fail_rate:
+            response.update(respCode=RESP_FAILED, respMsg='failed by the mock gateway')
+            return self.pack(response)
+
+        response.update(respCode=RESP_SUCCESS, respMsg='success')
+        txn_type = data.get('txnType')
+        if txn_type == '00':
+            response.update(
+                queryId=data.get('queryId') or self.next_query_id(),
+                origRespCode=RESP_SUCCESS,
+                origRespMsg='success',
+                settleAmt=data.get('txnAmt') or '1',
+                settleDate=time.strftime('%m%d'),
+            )
+        elif txn_type == '76':
+            settle_date = data.get('settleDate') or time.strftime('%m%d')
+            response.update(
+                fileContent=self.file_content(data.get('merId', ''), settle_date),
+                fileName='INN%s88ZM_%s.zip' % (settle_date, data.get('merId', '')),
+            )
+        elif txn_type in ('01', '02'):
+            response.update(tn='%021d' % random.randint(0, 10 ** 21 - 1))
+        else:
+            response.update(queryId=self.next_query_id())
+        return self.pack(response)
+
+    def pack(self, response):
+        '''
+        Like the real gateway only the signature is urlencoded, clients
+        turn the spaces back into "+" in fileContent
+        '''
+        signature = self.signer.sign(response).decode('utf-8')
+        response['signature'] = urlencode({'signature': signature})[10:]
+        return Signer.simple_urlencode(response)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def main():
+    options.parse_command_line()
+    tornado.log.enable_pretty_logging()
+    x509_filepath = options.x509_filepath
+    if options.export_cert:
+        export_cert(options.pfx_filepath, options.password, options.export_cert)
+    if x509_filepath is None:
+        # trust the own cert, clients use the same test pfx
+        if options.export_cert:
+            x509_filepath = options.export_cert
+        else:
+            fd, x509_filepath = tempfile.mkstemp(suffix='.cer')
+            os.close(fd)
+            export_cert(options.pfx_filepath, options.password, x509_filepath)
+    signer = Signer(options.pfx_filepath, options.password, x509_filepath)
+    application = Gateway(
+        signer,
+        latency=options.latency,
+        jitter=options.jitter,
+        error_rate=options.error_rate,
+        fail_rate=options.fail_rate,
+        file_lines=options.file_lines,
+        workers=options.workers,
+    )
+    http_server = tornado.httpserver.HTTPServer(application)
+    http_server.listen(options.port)
+    logging.info('[GATEWAY]mock gateway listening on %d' % options.port)
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Write-ahead journal for verified notifies
+
+A verified notify is appended to the journal and fsynced together with
+the other notifies of the same batch, then unionpay is answered right
+away. Background consumers replay the journal into handle_notify with
+at-least-once semantics, every handled entry is acked and unacked ones
+are replayed again after a restart. An entry handled right before a
+crash may be replayed once more, handle_notify has to be idempotent.
+
+Layout of the journal directory:
+
+    00000001.log    one json entry per line: {"id": 1, "data": {...}}
+    00000001.ack    ids of handled entries, one per line
+
+A segment is rotated when it grows past segment_size and removed once
+every entry in it is acked.
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+logger = logging.getLogger(__name__)
+
+
+class NotifyJournal(object):
+
+    def __init__(self, path, workers=2, segment_size=64 << 20, batch_size=512, fsync=True,
+                 retry_delay=1, max_retry_delay=60):
+        '''
+        @path:              journal directory, one per server process
+        @workers:           background consumer threads
+        @segment_size:      bytes before rotating to a new segment
+        @batch_size:        max entries written by one fsync
+        @fsync:             fsync every batch and ack, only disable for tests
+        @retry_delay:       first delay before retrying a failed entry
+        @max_retry_delay:   delays double up to this many seconds
+        '''
+        self.path = path
+        self.workers = workers
+        self.segment_size = segment_size
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.handler = None
+        self.lock = threading.Lock()
+        self.incoming = queue.Queue()
+        self.pending = queue.Queue()
+        self.outstanding = {}
+        self.ack_files = {}
+        self.timers = set()
+        self.threads = []
+        self.closing = False
+        self.next_id = 1
+        self.segment = 0
+        self.segment_file = None
+
+    def segment_path(self, segment, ext='log'):
+        return os.path.join(self.path, '%08d.%s' % (segment, ext))
+
+    def start(self, handler):
+        '''
+        @handler: called with the notify data by consumer threads
+        '''
+        self.handler = handler
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.recover()
+        self.open_segment(self.segment + 1)
+        self.threads.append(self.start_thread(self.write_loop, 'journal-writer'))
+        for i in range(self.workers):
+            self.threads.append(self.start_thread(self.consume_loop, 'journal-consumer-%d' % i))
+
+    @staticmethod
+    def start_thread(target, name):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def recover(self):
+        segments = sorted(
+            int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.log'))
+        recovered = 0
+        for segment in segments:
+            acked = self.read_acks(segment)
+            count = 0
+            with open(self.segment_path(segment)) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a torn write at the tail, it was never acknowledged
+                        logger.warning('[JOURNAL]skip broken entry in segment %d' % segment)
+                        continue
+                    self.next_id = max(self.next_id, entry['id'] + 1)
+                    if entry['id'] in acked:
+                        continue
+                    self.pending.put((entry['id'], segment, entry['data'], 0))
+                    count += 1
+            self.segment = max(self.segment, segment)
+            if count:
+                self.outstanding[segment] = count
+                recovered += count
+            else:
+                self.remove_segment(segment)
+        if recovered:
+            logger.info('[JOURNAL]%d pending notifies recovered' % recovered)
+
+    def read_acks(self, segment):
+        '''
+        Return the acked ids of a segment. A torn ack at the tail is cut
+        off so the next ack starts on a new line, its entry is replayed
+        '''
+        acked = set()
+        path = self.segment_path(segment, 'ack')
+        if not os.path.exists(path):
+            return acked
+        with open(path, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                logger.warning('[JOURNAL]cut torn ack in segment %d' % segment)
+                f.truncate(end)
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                acked.add(int(line))
+            except ValueError:
+                logger.warning('[JOURNAL]skip broken ack in segment %d' % segment)
+        return acked
+
+    def open_segment(self, segment):
+        if self.segment_file is not None:
+            self.segment_file.close()
+        self.segment = segment
+        self.segment_file = open(self.segment_path(segment), 'ab')
+        self.outstanding.setdefault(segment, 0)
+
+    def remove_segment(self, segment):
+        ack_file = self.ack_files.pop(segment, None)
+        if ack_file is not None:
+            ack_file.close()
+        for ext in ('log', 'ack'):
+            if os.path.exists(self.segment_path(segment, ext)):
+                os.unlink(self.segment_path(segment, ext))
+        self.outstanding.pop(segment, None)
+
+    def append(self, data):
+        '''
+        @data: a verified notify
+        Return a concurrent Future resolved with the entry id once the
+        entry is on disk
+        '''
+        future = Future()
+        if self.closing:
+            future.set_exception(IOError('[JOURNAL]journal is closed'))
+        else:
+            self.incoming.put((data, future))
+        return future
+
+    def write_loop(self):
+        while True:
+            item = self.incoming.get()
+            if item is None:
+                break
+            batch = [item]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.incoming.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self.write_batch(batch)
+            if stop:
+                break
+
+    def write_batch(self, batch):
+        lines = []
+        entries = []
+        for data, future in batch:
+            entry_id = self.next_id
+            self.next_id += 1
+            lines.append(json.dumps({'id': entry_id, 'data': data}))
+            entries.append((entry_id, data, future))
+        segment = self.segment
+        try:
+            self.segment_file.write(('\n'.join(lines) + '\n').encode('utf-8'))
+            self.segment_file.flush()
+            if self.fsync:
+                os.fsync(self.segment_file.fileno())
+        except Exception as e:
+            logger.exception('[JOURNAL]write failed')
+            for _, _, future in entries:
+                future.set_exception(e)
+            return
+        with self.lock:
+            self.outstanding[segment] = self.outstanding.get(segment, 0) + len(entries)
+            if self.segment_file.tell() >= self.segment_size:
+                self.open_segment(segment + 1)
+        for entry_id, data, future in entries:
+            self.pending.put((entry_id, segment, data, 0))
+            future.set_result(entry_id)
+
+    def consume_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None or self.closing:
+                break
+            entry_id, segment, data, attempts = item
+            try:
+                self.handler(data)
+            except Exception:
+                logger.exception('[JOURNAL]entry %d failed, attempt %d' % (entry_id, attempts + 1))
+                self.retry(item)
+            else:
+                self.ack(entry_id, segment)
+
+    def retry(self, item):
+        entry_id, segment, data, attempts = item
+        delay = min(self.retry_delay * (2 ** attempts), self.max_retry_delay)
+
+        def requeue():
+            self.timers.discard(timer)
+            if not self.closing:
+                self.pending.put((entry_id, segment, data, attempts + 1))
+
+        timer = threading.Timer(delay, requeue)
+        timer.daemon = True
+        self.timers.add(timer)
+        timer.start()
+
+    def ack(self, entry_id, segment):
+        with self.lock:
+            ack_file = self.ack_files.get(segment)
+            if ack_file is None:
+                ack_file = self.ack_files[segment] = open(self.segment_path(segment, 'ack'), 'a')
+            ack_file.write('%d\n' % entry_id)
+            ack_file.flush()
+            if self.fsync:
+                os.fsync(ack_file.fileno())
+            self.outstanding[segment] -= 1
+            if not self.outstanding[segment] and segment != self.segment:
+                self.remove_segment(segment)
+
+    def close(self, timeout=10):
+        '''
+        Flush appended entries and stop consumers, unacked entries are
+        replayed by the next start
+        '''
+        self.incoming.put(None)
+        self.closing = True
+        if self.threads:
+            self.threads[0].join(timeout)
+        for timer in list(self.timers):
+            timer.cancel()
+        for _ in range(self.workers):
+            self.pending.put(None)
+        deadline = time.time() + timeout
+        for thread in self.threads[1:]:
+            thread.join(max(0, deadline - time.time()))
+        with self.lock:
+            for ack_file in self.ack_files.values():
+                ack_file.close()
+            self.ack_files.clear()
+            if self.segment_file is not None:
+                self.segment_file.close()
+                self.segment_file = None
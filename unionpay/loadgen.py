@@ -0,0 +1,216 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Drive UnionpayClient at a target rate and report throughput and latency
+
+    python -m unionpay.gateway --port=8090 --export_cert=/tmp/gateway.cer
+    python -m unionpay.loadgen --gateway=http://127.0.0.1:8090 \\
+        --x509_filepath=/tmp/gateway.cer --txn=query --qps=500 --duration=30
+
+Requests are started on a fixed schedule (open loop), so a slow gateway
+shows up as latency instead of a lower request rate. Requests that would
+exceed --concurrency in flight are counted as dropped.
+'''
+
+import inspect
+import json
+import logging
+import math
+import sys
+import time
+import tornado.ioloop
+import tornado.log
+from collections import Counter
+from tornado import gen
+from tornado.options import OptionParser
+from .client import UnionpayClient
+from .util.helper import load_config
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+
+
+options = OptionParser()
+options.define("config", default="settings.yaml", help="config path", type=str)
+options.define("gateway", default=None, help="base url replacing the host of every gateway url, like http://127.0.0.1:8090",
+               type=str)
+options.define("x509_filepath", default=None, help="cert verifying gateway responses", type=str)
+options.define("txn", default="query", help="transaction: query, pay, refund, revoke or file_transfer", type=str)
+options.define("qps", default=100.0, help="target requests per second", type=float)
+options.define("duration", default=10.0, help="seconds to send requests", type=float)
+options.define("concurrency", default=200, help="max requests in flight", type=int)
+options.define("timeout", default=30.0, help="request timeout seconds", type=float)
+options.define("json", default=False, help="print the report as json", type=bool)
+
+
+GATEWAY_URLS = ('app_trans_url', 'front_trans_url', 'back_trans_url', 'card_back_trade',
+                'single_query_url', 'batch_trans_url', 'file_trans_url')
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def point_config(config, gateway):
+    '''
+    Keep the paths of the config urls, take scheme, host and port from
+    gateway
+    '''
+    gateway = gateway.rstrip('/')
+    for name in GATEWAY_URLS:
+        url = config.get(name)
+        if url:
+            parts = urlsplit(url)
+            config[name] = gateway + (parts.path or '/')
+    return config
+
+
+def percentile(values, q):
+    '''
+    @values: sorted values
+    Nearest rank percentile
+    '''
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(q / 100.0 * len(values))) - 1)]
+
+
+def latency_summary(latencies):
+    '''
+    @latencies: sorted seconds
+    '''
+    summary = dict(('p%s' % q, percentile(latencies, q)) for q in PERCENTILES)
+    summary.update(
+        mean=sum(latencies) / len(latencies) if latencies else None,
+        max=latencies[-1] if latencies else None)
+    return summary
+
+
+def make_args(txn, i):
+    txn_time = time.strftime('%Y%m%d%H%M%S')
+    order_id = 'LOAD%s%08d' % (txn_time, i)
+    if txn == 'pay':
+        return (1, order_id), {}
+    if txn == 'query':
+        return (order_id, txn_time), {}
+    if txn == 'refund':
+        return (order_id, '201512161030001234567', txn_time, 1), {}
+    if txn == 'revoke':
+        return (order_id, '201512161030001234567', 1), {}
+    if txn == 'file_transfer':
+        return ('00', time.strftime('%m%d')), {'stream': True}
+    raise ValueError('unknown transaction %s' % txn)
+
+
+class LoadGenerator(object):
+
+    def __init__(self, client, txn='query', qps=100, duration=10, concurrency=200):
+        '''
+        @client:        UnionpayClient pointed at the gateway
+        @txn:           transaction name, the async_<txn> method is called
+        @qps:           target requests per second
+        @duration:      seconds to send requests
+        @concurrency:   max requests in flight
+        '''
+        self.client = client
+        self.txn = txn
+        self.method = getattr(client, 'async_%s' % txn)
+        # a wrong argument list fails here instead of counting as errors
+        args, kwargs = make_args(txn, 0)
+        inspect.signature(self.method).bind(*args, **kwargs)
+        self.qps = qps
+        self.duration = duration
+        self.concurrency = concurrency
+        self.latencies = []
+        self.errors = Counter()
+        self.dropped = 0
+        self.in_flight = 0
+
+    @gen.coroutine
+    def request(self, i):
+        args, kwargs = make_args(self.txn, i)
+        start = time.time()
+        try:
+            result = yield self.method(*args, **kwargs)
+            if self.txn == 'file_transfer':
+                # read the whole file like a real ingestion
+                for _ in result:
+                    pass
+        except Exception as e:
+            self.errors[getattr(e, 'resp_code', None) or e.__class__.__name__] += 1
+        else:
+            self.latencies.append(time.time() - start)
+        finally:
+            self.in_flight -= 1
+
+    @gen.coroutine
+    def run(self):
+        start = time.time()
+        total = int(self.qps * self.duration)
+        for i in range(total):
+            delay = start + i / self.qps - time.time()
+            if delay > 0:
+                yield gen.sleep(delay)
+            if self.in_flight >= self.concurrency:
+                self.dropped += 1
+                continue
+            self.in_flight += 1
+            tornado.ioloop.IOLoop.current().spawn_callback(self.request, i)
+        while self.in_flight:
+            yield gen.sleep(0.01)
+        raise gen.Return(self.report(total, time.time() - start))
+
+    def report(self, total, elapsed):
+        latencies = sorted(self.latencies)
+        completed = len(latencies)
+        return {
+            'txn': self.txn,
+            'target_qps': self.qps,
+            'scheduled': total,
+            'completed': completed,
+            'errors': dict(self.errors),
+            'dropped': self.dropped,
+            'elapsed': elapsed,
+            'throughput': completed / elapsed if elapsed else 0,
+            'latency': latency_summary(latencies),
+        }
+
+
+def format_report(report):
+    lines = [
+        'txn %(txn)s, target %(target_qps).1f qps, %(elapsed).2fs' % report,
+        'completed %(completed)d of %(scheduled)d, dropped %(dropped)d, throughput %(throughput).1f/s' % report,
+        'errors %s' % (', '.join('%s: %d' % item for item in sorted(report['errors'].items())) or 'none'),
+    ]
+    latency = report['latency']
+    if latency['max'] is not None:
+        lines.append('latency ms ' + ' '.join(
+            '%s=%.2f' % (name, latency[name] * 1000)
+            for name in ['p%s' % q for q in PERCENTILES] + ['mean', 'max']))
+    return '\n'.join(lines)
+
+
+def main():
+    options.parse_command_line()
+    tornado.log.enable_pretty_logging()
+    config = load_config(options.config)
+    if options.gateway:
+        point_config(config, options.gateway)
+    if options.x509_filepath:
+        config.x509_filepath = options.x509_filepath
+    client = UnionpayClient(
+        config, timeout=options.timeout, max_clients=options.concurrency, pool_size=options.concurrency)
+    generator = LoadGenerator(client, options.txn, options.qps, options.duration, options.concurrency)
+    report = tornado.ioloop.IOLoop.current().run_sync(generator.run)
+    client.close()
+    if options.json:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        logging.info('[LOADGEN]done')
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
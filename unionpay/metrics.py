@@ -0,0 +1,264 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Counters and latency histograms rendered in the Prometheus text format
+
+No client library is needed, a Registry keeps labelled series in memory
+and renders them for a /metrics route or returns them as a dict.
+'''
+
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'),
+)
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def label_values(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s %s' % (self.name, self.kind),
+        ]
+        with self.lock:
+            for values in sorted(self.series):
+                lines.extend(self.render_series(values, self.series[values]))
+        return lines
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        values = self.label_values(labels)
+        with self.lock:
+            self.series[values] = self.series.get(values, 0) + amount
+
+    def render_series(self, values, count):
+        return ['%s%s %s' % (self.name, format_labels(self.labelnames, values), format_value(count))]
+
+    def snapshot(self):
+        with self.lock:
+            return dict((values, count) for values, count in self.series.items())
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        values = self.label_values(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(values)
+            if series is None:
+                series = self.series[values] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def render_series(self, values, series):
+        counts, total, count = series
+        lines = []
+        cumulative = 0
+        for bucket, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append('%s_bucket%s %d' % (
+                self.name,
+                format_labels(self.labelnames, values, ('le', format_value(bucket))),
+                cumulative))
+        labels = format_labels(self.labelnames, values)
+        lines.append('%s_sum%s %s' % (self.name, labels, format_value(total)))
+        lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return dict(
+                (values, {'buckets': dict(zip(self.buckets, counts)), 'sum': total, 'count': count})
+                for values, (counts, total, count) in self.series.items())
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, cls, name, documentation, labelnames=(), **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, documentation, labelnames, **kwargs)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        '''
+        Return all metrics in the Prometheus text exposition format
+        '''
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        '''
+        Return {metric name: {label values: value}} for pull style access
+        '''
+        return dict((name, metric.snapshot()) for name, metric in self.metrics.items())
+
+
+REGISTRY = Registry()
+
+
+SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)')
+LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+ESCAPE_RE = re.compile(r'\\(.)')
+
+
+def unescape(value):
+    '''
+    Decode escapes in one left to right pass, so an escaped backslash
+    followed by n stays a backslash and n
+    '''
+    return ESCAPE_RE.sub(lambda match: '\n' if match.group(1) == 'n' else match.group(1), value)
+
+
+def parse(text):
+    '''
+    Parse the Prometheus text format, like a scraped /metrics
+    Return {(sample name, ((label, value), ...)): value}
+    '''
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        match = SAMPLE_RE.match(line)
+        if match is None:
+            continue
+        name, labels, value = match.groups()
+        labels = tuple(sorted(
+            (label, unescape(label_value)) for label, label_value in LABEL_RE.findall(labels or '')))
+        samples[(name, labels)] = float(value)
+    return samples
+
+
+def bucket_quantile(buckets, q):
+    '''
+    @buckets:   [(upper bound, cumulative count)] sorted by bound
+    @q:         quantile between 0 and 1
+    Estimate a quantile by linear interpolation inside the bucket, like
+    histogram_quantile of Prometheus
+    '''
+    if not buckets or not buckets[-1][1]:
+        return None
+    rank = q * buckets[-1][1]
+    lower, lower_count = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float('inf'):
+                return lower
+            if count == lower_count:
+                return bound
+            return lower + (bound - lower) * (rank - lower_count) / (count - lower_count)
+        lower, lower_count = bound, count
+    return lower
+
+
+class ClientMetrics(object):
+
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+        self.stage_seconds = registry.histogram(
+            'unionpay_client_stage_seconds',
+            'Seconds spent in a transaction stage: sign, urlencode, http, parse, validate',
+            ('stage', 'txnType'))
+        self.request_seconds = registry.histogram(
+            'unionpay_client_request_seconds',
+            'Seconds of a whole gateway transaction',
+            ('txnType', 'respCode'))
+        self.requests = registry.counter(
+            'unionpay_client_requests_total',
+            'Gateway transactions by response code',
+            ('txnType', 'respCode'))
+
+
+class NotifyMetrics(object):
+
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+        self.requests = registry.counter(
+            'unionpay_notify_requests_total',
+            'Notifies by outcome: ok, cached, rejected, invalid, error',
+            ('status', 'txnType'))
+        self.validate_failures = registry.counter(
+            'unionpay_notify_validate_failures_total',
+            'Notifies failing signature validation',
+            ('txnType',))
+        self.stage_seconds = registry.histogram(
+            'unionpay_notify_stage_seconds',
+            'Seconds spent in a notify stage: validate, handle, journal',
+            ('stage', 'txnType'))
+        self.request_seconds = registry.histogram(
+            'unionpay_notify_request_seconds',
+            'Seconds from receiving a notify to answering it',
+            ('status',))
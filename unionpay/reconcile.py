@@ -0,0 +1,145 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Reconcile settlement records against the merchant order ledger
+
+The settlement side (one settle date) is indexed by orderId and queryId,
+then the ledger is streamed once, so memory is bounded by the settlement
+file whatever the size of the ledger.
+'''
+
+import logging
+from collections import Counter
+from .util.helper import ObjectDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReconcileStatus(object):
+    matched = 'matched'
+    # in the settlement file but not in our ledger
+    missing_local = 'missing_local'
+    # in our ledger but not in the settlement file
+    missing_unionpay = 'missing_unionpay'
+    amount_mismatch = 'amount_mismatch'
+
+
+def get_field(item, name):
+    '''
+    @item: dict, Record or tuple row
+    @name: key, attribute name or index
+    '''
+    if name is None:
+        return None
+    try:
+        return item[name]
+    except (KeyError, IndexError, TypeError):
+        getter = getattr(item, 'get', None)
+        return getter(name) if getter else None
+
+
+def to_amount(value):
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+class Reconciler(object):
+
+    '''
+    Yield one ObjectDict(status, key, record, row) per settlement record
+    or ledger row, and count them in summary
+    '''
+
+    def __init__(self, records, ledger_fields=None, record_fields=None):
+        '''
+        @records:       settlement records, dicts from Signer.iter_file_data
+                        or Record objects
+        @ledger_fields: {orderId, queryId, txnAmt: key or index in a
+                        ledger row}, amounts are fen
+        @record_fields: same mapping for settlement records
+        '''
+        names = ('orderId', 'queryId', 'txnAmt')
+        self.ledger_fields = dict(zip(names, names))
+        self.ledger_fields.update(ledger_fields or {})
+        self.record_fields = dict(zip(names, names))
+        self.record_fields.update(record_fields or {})
+        self.summary = Counter()
+        self.amounts = Counter()
+        self.entries = {}
+        self.by_order = {}
+        self.by_query = {}
+        self.build_index(records)
+
+    def build_index(self, records):
+        fields = self.record_fields
+        for entry_id, record in enumerate(records):
+            self.entries[entry_id] = record
+            order_id = get_field(record, fields['orderId'])
+            query_id = get_field(record, fields['queryId'])
+            if order_id:
+                self.by_order.setdefault(order_id, []).append(entry_id)
+            if query_id:
+                self.by_query.setdefault(query_id, []).append(entry_id)
+        logger.debug('[RECONCILE]%d settlement records indexed' % len(self.entries))
+
+    def take(self, index, key):
+        entry_ids = index.get(key)
+        while entry_ids:
+            entry_id = entry_ids.pop(0)
+            if entry_id in self.entries:
+                return self.entries.pop(entry_id)
+        return None
+
+    def match(self, row):
+        query_id = get_field(row, self.ledger_fields['queryId'])
+        record = self.take(self.by_query, query_id) if query_id else None
+        if record is None:
+            order_id = get_field(row, self.ledger_fields['orderId'])
+            record = self.take(self.by_order, order_id) if order_id else None
+        return record
+
+    def result(self, status, record=None, row=None):
+        self.summary[status] += 1
+        source, fields = (row, self.ledger_fields) if row is not None else (record, self.record_fields)
+        amount = to_amount(get_field(source, fields['txnAmt']))
+        self.amounts[status] += amount or 0
+        key = get_field(source, fields['orderId']) or get_field(source, fields['queryId'])
+        return ObjectDict(status=status, key=key, record=record, row=row)
+
+    def reconcile(self, ledger_rows):
+        '''
+        @ledger_rows: an iterator of ledger rows, consumed once
+        '''
+        for row in ledger_rows:
+            record = self.match(row)
+            if record is None:
+                yield self.result(ReconcileStatus.missing_unionpay, row=row)
+                continue
+            ledger_amount = to_amount(get_field(row, self.ledger_fields['txnAmt']))
+            record_amount = to_amount(get_field(record, self.record_fields['txnAmt']))
+            if ledger_amount != record_amount:
+                yield self.result(ReconcileStatus.amount_mismatch, record, row)
+            else:
+                yield self.result(ReconcileStatus.matched, record, row)
+
+        for entry_id in sorted(self.entries):
+            yield self.result(ReconcileStatus.missing_local, record=self.entries[entry_id])
+        self.entries.clear()
+        self.by_order.clear()
+        self.by_query.clear()
+
+
+def reconcile(records, ledger_rows, ledger_fields=None, record_fields=None, statuses=None):
+    '''
+    @records:       settlement records
+    @ledger_rows:   iterator of our ledger rows
+    @statuses:      only yield these statuses, like skip matched ones
+    '''
+    reconciler = Reconciler(records, ledger_fields, record_fields)
+    for item in reconciler.reconcile(ledger_rows):
+        if statuses is None or item.status in statuses:
+            yield item
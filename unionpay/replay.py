@@ -0,0 +1,328 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Replay captured notifies against a unionpay_notify instance
+
+    python -m unionpay.replay --capture=notify.gz --url=http://127.0.0.1:8080/notify --speed=10
+    python -m unionpay.replay --capture=notify.gz --url=... --concurrency=64
+
+--speed replays at N times the captured rate, --concurrency keeps that
+many notifies in flight as fast as the server answers. The server
+/metrics is scraped before and after the run, the report breaks latency
+and outcomes down by notify stage.
+
+Redacted captures must be replayed with --resign_pfx, the server has to
+trust the cert of that pfx. --unique gives every replayed notify a new
+orderId, so the dedup cache does not answer them.
+'''
+
+import json
+import os
+import sys
+import tempfile
+import time
+import tornado.ioloop
+import tornado.log
+from collections import Counter
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.options import OptionParser
+from .capture import read_capture
+from .loadgen import latency_summary
+from .metrics import bucket_quantile, parse
+from .signer import Signer
+try:
+    from urlparse import parse_qsl, urlsplit, urlunsplit
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+options = OptionParser()
+options.define("capture", default=None, help="capture file written by unionpay_notify --capture_path", type=str)
+options.define("url", default="http://127.0.0.1:8080/notify", help="notify url to replay to", type=str)
+options.define("metrics_url", default=None, help="server metrics url, default is /metrics on the notify host",
+               type=str)
+options.define("speed", default=1.0, help="replay at this multiple of the captured rate", type=float)
+options.define("concurrency", default=0, help="fixed in-flight notifies instead of the captured timing", type=int)
+options.define("max_in_flight", default=1000, help="notifies in flight before dropping in rate mode", type=int)
+options.define("limit", default=0, help="replay at most this many notifies", type=int)
+options.define("loops", default=1, help="replay the capture this many times", type=int)
+options.define("resign_pfx", default=None, help="pfx resigning every notify", type=str)
+options.define("resign_password", default='000000', help="password of the resigning pfx", type=str)
+options.define("unique", default=False, help="give every notify a new orderId, needs --resign_pfx", type=bool)
+options.define("timeout", default=30.0, help="request timeout seconds", type=float)
+options.define("json", default=False, help="print the report as json", type=bool)
+
+
+class Resigner(object):
+
+    def __init__(self, signer, unique=False):
+        self.signer = signer
+        self.unique = unique
+        self.count = 0
+
+    def __call__(self, body):
+        data = dict(parse_qsl(body, keep_blank_values=True))
+        data.pop('signature', None)
+        if self.unique and data.get('orderId'):
+            self.count += 1
+            data['orderId'] = '%s-%d' % (data['orderId'], self.count)
+        signature = self.signer.sign(data)
+        data['signature'] = signature.decode('utf-8')
+        return urlencode(data)
+
+
+def load_signer(pfx_filepath, password):
+    from .gateway import export_cert
+    fd, x509_filepath = tempfile.mkstemp(suffix='.cer')
+    os.close(fd)
+    try:
+        export_cert(pfx_filepath, password, x509_filepath)
+        return Signer(pfx_filepath, password, x509_filepath)
+    finally:
+        os.unlink(x509_filepath)
+
+
+def default_metrics_url(url):
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme, parts.netloc, '/metrics', '', ''))
+
+
+class Replayer(object):
+
+    def __init__(self, url, notifies, speed=1.0, concurrency=0, max_in_flight=1000, transform=None,
+                 timeout=30, metrics_url=None):
+        '''
+        @url:           notify url
+        @notifies:      iterable of (offset seconds, body)
+        @speed:         multiple of the captured rate
+        @concurrency:   fixed in-flight notifies, 0 keeps the captured timing
+        @max_in_flight: notifies in flight before dropping in rate mode
+        @transform:     called with every body before sending, like Resigner
+        @metrics_url:   server metrics, None skips the stage breakdown
+        '''
+        self.url = url
+        self.notifies = notifies
+        self.speed = speed
+        self.concurrency = concurrency
+        self.max_in_flight = max_in_flight
+        self.transform = transform
+        self.timeout = timeout
+        self.metrics_url = metrics_url
+        self.http_client = AsyncHTTPClient(force_instance=True, max_clients=max(concurrency, max_in_flight))
+        self.latencies = []
+        self.statuses = Counter()
+        self.sent = 0
+        self.dropped = 0
+        self.in_flight = 0
+
+    @gen.coroutine
+    def send(self, body):
+        if self.transform is not None:
+            body = self.transform(body)
+        request = HTTPRequest(
+            self.url, method='POST', body=body, request_timeout=self.timeout,
+            headers={'content-type': 'application/x-www-form-urlencoded'})
+        start = time.time()
+        self.sent += 1
+        try:
+            response = yield self.http_client.fetch(request, raise_error=False)
+            status = response.code
+        except Exception as e:
+            status = e.__class__.__name__
+        self.statuses[status] += 1
+        if status == 200:
+            self.latencies.append(time.time() - start)
+
+    @gen.coroutine
+    def send_tracked(self, body):
+        try:
+            yield self.send(body)
+        finally:
+            self.in_flight -= 1
+
+    @gen.coroutine
+    def run_rate(self):
+        start = time.time()
+        for offset, body in self.notifies:
+            delay = start + offset / self.speed - time.time()
+            if delay > 0:
+                yield gen.sleep(delay)
+            if self.in_flight >= self.max_in_flight:
+                self.dropped += 1
+                continue
+            self.in_flight += 1
+            tornado.ioloop.IOLoop.current().spawn_callback(self.send_tracked, body)
+        while self.in_flight:
+            yield gen.sleep(0.01)
+
+    @gen.coroutine
+    def run_concurrency(self):
+        notifies = iter(self.notifies)
+
+        @gen.coroutine
+        def worker():
+            for _, body in notifies:
+                yield self.send(body)
+        yield [worker() for _ in range(self.concurrency)]
+
+    @gen.coroutine
+    def scrape(self):
+        if not self.metrics_url:
+            raise gen.Return(None)
+        response = yield self.http_client.fetch(self.metrics_url, raise_error=False)
+        if response.code != 200:
+            raise gen.Return(None)
+        raise gen.Return(parse(response.body.decode('utf-8')))
+
+    @gen.coroutine
+    def run(self):
+        before = yield self.scrape()
+        start = time.time()
+        if self.concurrency:
+            yield self.run_concurrency()
+        else:
+            yield self.run_rate()
+        elapsed = time.time() - start
+        after = yield self.scrape()
+        self.http_client.close()
+        report = self.report(elapsed)
+        if before is not None and after is not None:
+            report['server'] = server_report(before, after)
+        raise gen.Return(report)
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        ok = self.statuses.get(200, 0)
+        return {
+            'mode': 'concurrency %d' % self.concurrency if self.concurrency else 'speed %gx' % self.speed,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'elapsed': elapsed,
+            'throughput': ok / elapsed if elapsed else 0,
+            'statuses': dict((str(status), count) for status, count in self.statuses.items()),
+            'error_rate': 1 - ok / float(self.sent) if self.sent else 0,
+            'latency': latency_summary(latencies),
+        }
+
+
+def delta(before, after, name):
+    '''
+    Return {labels: increase} of one sample name between two scrapes
+    '''
+    result = {}
+    for (sample, labels), value in after.items():
+        if sample == name:
+            result[labels] = value - before.get((sample, labels), 0)
+    return result
+
+
+def server_report(before, after):
+    '''
+    Per stage count, mean and estimated quantiles from the increase of
+    unionpay_notify_stage_seconds, plus notifies by outcome
+    '''
+    stages = {}
+    counts = delta(before, after, 'unionpay_notify_stage_seconds_count')
+    sums = delta(before, after, 'unionpay_notify_stage_seconds_sum')
+    buckets = delta(before, after, 'unionpay_notify_stage_seconds_bucket')
+    for labels, count in counts.items():
+        if not count:
+            continue
+        key = dict(labels)
+        name = '%s[%s]' % (key.get('stage'), key.get('txnType'))
+        stage_buckets = sorted(
+            (float(dict(bucket_labels)['le']), value) for bucket_labels, value in buckets.items()
+            if tuple(item for item in bucket_labels if item[0] != 'le') == labels)
+        stages[name] = {
+            'count': int(count),
+            'mean': sums.get(labels, 0) / count,
+            'p50': bucket_quantile(stage_buckets, 0.5),
+            'p99': bucket_quantile(stage_buckets, 0.99),
+        }
+    outcomes = Counter()
+    for labels, count in delta(before, after, 'unionpay_notify_requests_total').items():
+        if count:
+            outcomes[dict(labels).get('status')] += int(count)
+    total = sum(outcomes.values())
+    return {
+        'stages': stages,
+        'outcomes': dict(outcomes),
+        'outcome_rates': dict((status, count / float(total)) for status, count in outcomes.items()) if total else {},
+        'validate_failures': int(sum(delta(before, after, 'unionpay_notify_validate_failures_total').values())),
+    }
+
+
+def ms(value):
+    return '-' if value is None else '%.2f' % (value * 1000)
+
+
+def format_report(report):
+    lines = [
+        'mode %(mode)s, %(elapsed).2fs, sent %(sent)d, dropped %(dropped)d, '
+        'throughput %(throughput).1f/s, error rate %(error_rate).2f%%' % dict(
+            report, error_rate=report['error_rate'] * 100),
+        'statuses %s' % ', '.join('%s: %d' % item for item in sorted(report['statuses'].items())),
+        'latency ms ' + ' '.join('%s=%s' % (name, ms(value)) for name, value in sorted(report['latency'].items())),
+    ]
+    server = report.get('server')
+    if server:
+        lines.append('server outcomes %s, validate failures %d' % (
+            ', '.join('%s: %d' % item for item in sorted(server['outcomes'].items())),
+            server['validate_failures']))
+        lines.append('%-24s %8s %10s %10s %10s' % ('stage', 'count', 'mean ms', 'p50 ms', 'p99 ms'))
+        for name, stage in sorted(server['stages'].items()):
+            lines.append('%-24s %8d %10s %10s %10s' % (
+                name, stage['count'], ms(stage['mean']), ms(stage['p50']), ms(stage['p99'])))
+    return '\n'.join(lines)
+
+
+def iter_notifies(path, loops=1, limit=0):
+    '''
+    Offsets keep growing over loops, so looped captures keep their rate
+    '''
+    count = 0
+    base = 0.0
+    for _ in range(loops):
+        offset = 0.0
+        for offset, body in read_capture(path):
+            if limit and count >= limit:
+                return
+            count += 1
+            yield base + offset, body
+        base += offset
+
+
+def main():
+    options.parse_command_line()
+    tornado.log.enable_pretty_logging()
+    if not options.capture:
+        sys.exit('--capture is required')
+    transform = None
+    if options.resign_pfx:
+        transform = Resigner(load_signer(options.resign_pfx, options.resign_password), options.unique)
+    elif options.unique:
+        sys.exit('--unique needs --resign_pfx')
+    replayer = Replayer(
+        options.url,
+        iter_notifies(options.capture, options.loops, options.limit),
+        speed=options.speed,
+        concurrency=options.concurrency,
+        max_in_flight=options.max_in_flight,
+        transform=transform,
+        timeout=options.timeout,
+        metrics_url=options.metrics_url or default_metrics_url(options.url),
+    )
+    report = tornado.ioloop.IOLoop.current().run_sync(replayer.run)
+    if options.json:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
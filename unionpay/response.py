@@ -0,0 +1,241 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Gateway response parser
+
+The gateway answers with "name=value&..." where only the signature is
+urlencoded. parse_response reads such a body in one pass over the bytes:
+large values like fileContent stay memoryview slices of the body until
+read, and when the body is already in canonical order (sorted, no empty
+or escaped values) the signing string is the body minus the signature
+pair, so verification hashes slices of the body instead of rebuilding it.
+Bodies shorter than LAZY_SIZE hold no such value and are parsed by
+parse_qs, which is faster on them.
+'''
+
+try:
+    from urllib import unquote_plus
+    from urlparse import parse_qs
+except ImportError:
+    from urllib.parse import parse_qs, unquote_plus
+
+
+# values at least this long are kept as slices until read
+LAZY_SIZE = 4096
+
+# base64 values whose "+" is literal, spaces parse_qs made of them are
+# turned back into "+"
+RAW_FIELDS = ('fileContent',)
+
+
+class GatewayResponse(dict):
+
+    '''
+    A parsed response, a dict of str values. Large values are decoded on
+    first read by name, reading the whole dict (keys(), items(), len(),
+    iteration, copy(), dict(response), json.dumps) decodes them all first
+    '''
+
+    __slots__ = ('raw', 'lazy', 'parts')
+
+    def __init__(self, raw=b''):
+        dict.__init__(self)
+        self.raw = raw
+        # {name: memoryview of the raw value}
+        self.lazy = {}
+        # slices of raw forming the signing string, None if not canonical
+        self.parts = None
+
+    def __missing__(self, name):
+        if name not in self.lazy:
+            raise KeyError(name)
+        value = self.lazy.pop(name).tobytes().decode('utf-8')
+        dict.__setitem__(self, name, value)
+        return value
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in self.lazy
+
+    def __setitem__(self, name, value):
+        self.lazy.pop(name, None)
+        dict.__setitem__(self, name, value)
+
+    def __delitem__(self, name):
+        if self.lazy.pop(name, None) is None:
+            dict.__delitem__(self, name)
+
+    def pop(self, name, *default):
+        if name in self.lazy:
+            self[name]
+        return dict.pop(self, name, *default)
+
+    def popitem(self):
+        self.load()
+        return dict.popitem(self)
+
+    def setdefault(self, name, default=None):
+        if name not in self:
+            self[name] = default
+        return self[name]
+
+    def update(self, *args, **kwargs):
+        for name, value in dict(*args, **kwargs).items():
+            self[name] = value
+
+    def clear(self):
+        self.lazy.clear()
+        dict.clear(self)
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.lazy)
+
+    def __iter__(self):
+        return iter(self.load().keys())
+
+    def __eq__(self, other):
+        return dict.__eq__(self.load(), other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return dict.__repr__(self.load())
+
+    def __reduce__(self):
+        return dict, (dict(self.load().items()),)
+
+    def keys(self):
+        return dict.keys(self.load())
+
+    def values(self):
+        return dict.values(self.load())
+
+    def items(self):
+        return dict.items(self.load())
+
+    def copy(self):
+        return dict(self.items())
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def raw_value(self, name):
+        '''
+        Return the value as bytes or a memoryview of the body, without
+        decoding lazy values
+        '''
+        if name in self.lazy:
+            return self.lazy[name]
+        return self[name].encode('utf-8')
+
+    def raw_items(self):
+        '''
+        Return [(name, value)] with lazy values as memoryviews
+        '''
+        return list(dict.items(self)) + list(self.lazy.items())
+
+    def load(self):
+        '''
+        Decode every lazy value
+        '''
+        for name in list(self.lazy):
+            value = self.lazy.pop(name).tobytes().decode('utf-8')
+            dict.__setitem__(self, name, value)
+        return self
+
+    def signing_parts(self):
+        '''
+        Return the slices of the body whose concatenation is the signing
+        string, None when it has to be rebuilt from the values
+        '''
+        return self.parts
+
+
+def decode_value(name, value):
+    value = unquote_plus(value.decode('utf-8'))
+    if name in RAW_FIELDS:
+        value = value.replace(' ', '+')
+    return value
+
+
+def parse_response(raw, lazy_size=LAZY_SIZE):
+    '''
+    @raw:       response body, bytes
+    @lazy_size: values at least this long are kept as slices
+
+    Values are decoded like parse_qs does and the last of repeated names
+    wins, so the result equals Signer.parse_arguments
+    '''
+    if not isinstance(raw, bytes):
+        raw = raw.encode('utf-8')
+    response = GatewayResponse(raw)
+    if len(raw) < lazy_size:
+        # no value to keep as a slice
+        for name, values in parse_qs(raw.decode('utf-8')).items():
+            value = values[-1]
+            if name in RAW_FIELDS:
+                value = value.replace(' ', '+')
+            dict.__setitem__(response, name, value)
+        return response
+    view = memoryview(raw)
+    size = len(raw)
+    canonical = True
+    last = None
+    signature = None
+    pos = 0
+    while pos < size:
+        end = raw.find(b'&', pos)
+        if end < 0:
+            end = size
+        eq = raw.find(b'=', pos, end)
+        if eq < 0 or eq + 1 == end:
+            # empty pairs and values are dropped, the body is not canonical
+            canonical = False
+            pos = end + 1
+            continue
+        name = raw[pos:eq]
+        if b'%' in name or b'+' in name:
+            canonical = False
+            name = unquote_plus(name.decode('utf-8'))
+        else:
+            name = name.decode('utf-8')
+        start = eq + 1
+        if name == 'signature':
+            signature = (pos, end)
+            response.lazy.pop(name, None)
+            dict.__setitem__(response, name, unquote_plus(raw[start:end].decode('utf-8')))
+            pos = end + 1
+            continue
+
+        if name in RAW_FIELDS:
+            plain = raw.find(b'%', start, end) < 0 and raw.find(b' ', start, end) < 0
+        else:
+            plain = raw.find(b'%', start, end) < 0 and raw.find(b'+', start, end) < 0
+        if not plain or (last is not None and name <= last):
+            canonical = False
+        last = name
+        if plain and end - start >= lazy_size:
+            dict.pop(response, name, None)
+            response.lazy[name] = view[start:end]
+        else:
+            response.lazy.pop(name, None)
+            value = raw[start:end].decode('utf-8') if plain else decode_value(name, raw[start:end])
+            dict.__setitem__(response, name, value)
+        pos = end + 1
+
+    if canonical and signature is not None and raw[-1:] != b'&':
+        sig_start, sig_end = signature
+        parts = []
+        if sig_start > 0:
+            parts.append(view[:sig_start - 1])
+        if sig_end < size:
+            if parts:
+                parts.append(b'&')
+            parts.append(view[sig_end + 1:])
+        response.parts = parts
+    return response
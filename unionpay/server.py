@@ -4,19 +4,77 @@
 
 import json
 import logging
+import os
+import signal
+import time
 import tornado.auth
 import tornado.httpserver
+import tornado.httputil
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.web
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
 from tornado.options import define, options
-from .signer import Signer
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+from .capture import NotifyCapture
+from .client import txn_type_label
+from .dedup import DEDUP_FIELDS, NotifyDedup, SQLiteDedup, dedup_key
+from .error import SignatureValidateError
+from .journal import NotifyJournal
+from .metrics import REGISTRY, NotifyMetrics
+from .signer import Signer, validate_one
 from .util.helper import load_config
 
 
+# the global tornado options, unionpay.gateway, unionpay.loadgen and
+# unionpay.replay reuse names like port and config and define theirs on
+# their own OptionParser
 define("port", default=8080, help="run on the given port", type=int)
 define("notify_url", default="/notify", help="notify url", type=str)
+define("metrics_url", default="/metrics", help="prometheus metrics url, empty disables it", type=str)
 define("config", default="settings.yaml", help="config path", type=str)
+define("executor", default="thread", help="validate executor: thread or process", type=str)
+define("executor_workers", default=4, help="validate executor workers", type=int)
+define("max_pending", default=1000, help="max notifies waiting for validation", type=int)
+define("offload_notify", default=False, help="run handle_notify on a thread pool", type=bool)
+define("dedup_size", default=100000, help="notifies kept by the dedup cache, 0 disables it", type=int)
+define("dedup_ttl", default=86400, help="seconds a handled notify is deduplicated", type=int)
+define("dedup_path", default=None, help="sqlite file sharing the dedup cache between workers", type=str)
+define("journal_path", default=None, help="journal directory, answer notifies once journaled", type=str)
+define("journal_workers", default=2, help="threads replaying the journal into handle_notify", type=int)
+define("capture_path", default=None, help="record raw notify bodies to this gzipped file", type=str)
+define("capture_redact", default=False, help="mask card and customer fields of captured notifies", type=bool)
+define("capture_queue", default=10000, help="notifies waiting to be captured, more are dropped", type=int)
+define("processes", default=1, help="worker processes, 0 for one per cpu", type=int)
+define("reuse_port", default=False, help="bind every worker with SO_REUSEPORT", type=bool)
+define("debug", default=False, help="tornado debug mode, single process only", type=bool)
+define("drain_timeout", default=10, help="seconds to drain notifies on shutdown", type=float)
+
+
+class ReplayConnection(tornado.httputil.HTTPConnection):
+
+    '''
+    Connection of a notify replayed from the journal, unionpay was
+    answered long ago so whatever the handler writes is dropped
+    '''
+
+    def set_close_callback(self, callback):
+        pass
+
+    def write_headers(self, start_line, headers, chunk=None):
+        return gen.maybe_future(None)
+
+    def write(self, chunk):
+        return gen.maybe_future(None)
+
+    def finish(self):
+        pass
 
 
 class NotifyHandler(tornado.web.RequestHandler):
@@ -32,48 +90,330 @@ class NotifyHandler(tornado.web.RequestHandler):
             arguments[name] = self.get_argument(name)
         return arguments
 
+    def get_dedup_key(self):
+        return dedup_key(dict(
+            (name, self.get_argument(name, None)) for name in DEDUP_FIELDS))
+
     def handle_notify(self, data):
         logging.info(data)
+        return self.ok_response()
+
+    def ok_response(self):
         return json.dumps({'status': 'ok', 'code': 0})
 
+    @classmethod
+    def make_replay_handler(cls, application, data):
+        '''
+        Build a handler for a journaled notify, its request is a POST of
+        data to the notify url so get_argument works as in post
+        '''
+        body = urlencode(data).encode('utf-8')
+        headers = tornado.httputil.HTTPHeaders({'Content-Type': 'application/x-www-form-urlencoded'})
+        request = tornado.httputil.HTTPServerRequest(
+            method='POST', uri=application.notify_url, headers=headers, body=body,
+            connection=ReplayConnection())
+        tornado.httputil.parse_body_arguments(
+            headers['Content-Type'], body, request.body_arguments, request.files, headers)
+        for name, values in request.body_arguments.items():
+            request.arguments.setdefault(name, []).extend(values)
+        return cls(application, request)
+
+    @classmethod
+    def replay_notify(cls, application, data):
+        '''
+        Journal consumers call handle_notify outside of a request
+        '''
+        return cls.make_replay_handler(application, data).handle_notify(data)
+
+    @gen.coroutine
     def post(self):
-        data = self.get_all_arguments()
-        self.signer.validate(data)
-        response = self.handle_notify(data)
-        self.write(response)
+        start = time.time()
+        if self.application.capture is not None:
+            self.application.capture.record(self.request.body)
+        metrics = self.application.metrics
+        # label of unauthenticated input, only known values are kept
+        txn_type = txn_type_label(self.get_argument('txnType', None))
+        status = 'error'
+        try:
+            key = None
+            if self.application.dedup is not None:
+                key = self.get_dedup_key()
+                cached = yield self.application.dedup_get(key)
+                if cached is not None:
+                    status = 'cached'
+                    self.write(cached)
+                    return
+            if not self.application.acquire():
+                # unionpay retries the notify later
+                status = 'rejected'
+                self.set_status(503)
+                self.finish()
+                return
+            try:
+                data = self.get_all_arguments()
+                with metrics.stage_seconds.time(stage='validate', txnType=txn_type):
+                    try:
+                        yield self.application.validate(data)
+                    except SignatureValidateError:
+                        status = 'invalid'
+                        metrics.validate_failures.inc(txnType=txn_type)
+                        raise
+                if self.application.journal is not None:
+                    with metrics.stage_seconds.time(stage='journal', txnType=txn_type):
+                        yield self.application.journal.append(data)
+                    response = self.ok_response()
+                elif self.settings['offload_notify']:
+                    with metrics.stage_seconds.time(stage='handle', txnType=txn_type):
+                        response = yield self.application.run_notify(self.handle_notify, data)
+                else:
+                    with metrics.stage_seconds.time(stage='handle', txnType=txn_type):
+                        response = self.handle_notify(data)
+            finally:
+                self.application.release()
+            if key is not None:
+                yield self.application.dedup_set(key, response)
+            status = 'ok'
+            self.write(response)
+        finally:
+            metrics.requests.inc(status=status, txnType=txn_type)
+            metrics.request_seconds.observe(time.time() - start, status=status)
 
     def get(self):
         self.finish()
 
 
+class MetricsHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self.application.metrics.registry.render())
+
+
 class Application(tornado.web.Application):
 
-    def __init__(self, config, notify_url='/notify'):
+    def __init__(self, config, notify_url='/notify', executor='thread', executor_workers=4,
+                 max_pending=1000, offload_notify=False, debug=False, dedup=None, journal=None,
+                 handler_class=NotifyHandler, metrics_url='/metrics', registry=REGISTRY, capture=None):
+        '''
+        @config:            the unionpay config object
+        @notify_url:        notify url path
+        @executor:          run validation on a thread or process pool
+        @executor_workers:  validation workers
+        @max_pending:       notifies in validation before answering 503
+        @offload_notify:    run handle_notify on a thread pool
+        @debug:             tornado debug mode with autoreload
+        @dedup:             NotifyDedup answering retried notifies
+        @journal:           NotifyJournal, answer once the notify is journaled
+                            and replay it into handle_notify in background
+        @handler_class:     NotifyHandler subclass implementing handle_notify
+        @metrics_url:       prometheus metrics path, None disables it
+        @registry:          metrics registry to record into and render
+        @capture:           NotifyCapture recording raw notify bodies
+        '''
         notify_url = notify_url or config.notify_url
         handlers = [
-            (r"%s$" % notify_url, NotifyHandler),
+            (r"%s$" % notify_url, handler_class),
         ]
+        if metrics_url:
+            handlers.append((r"%s$" % metrics_url, MetricsHandler))
         settings = dict(
-            debug=True,
+            debug=debug,
             config=config,
-            signer=self.get_signer(config)
+            signer=self.get_signer(config),
+            offload_notify=offload_notify
         )
         tornado.web.Application.__init__(self, handlers, **settings)
+        self.notify_url = notify_url
+        self.executor_type = executor
+        self.executor_workers = executor_workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._validate_executor = None
+        self._notify_executor = None
+        self.dedup = dedup
+        self.journal = journal
+        self.metrics = NotifyMetrics(registry)
+        self.capture = capture
+        if journal is not None:
+            journal.start(lambda data: handler_class.replay_notify(self, data))
 
     def get_signer(self, config):
         return Signer.getSigner(config)
 
+    def acquire(self):
+        '''
+        Only called on the IOLoop thread, no lock needed
+        '''
+        if self.pending >= self.max_pending:
+            return False
+        self.pending += 1
+        return True
+
+    def release(self):
+        self.pending -= 1
+
+    @property
+    def validate_executor(self):
+        if self._validate_executor is None:
+            if self.executor_type == 'process':
+                # owned by the application, the signer pools may be resized by batch callers
+                self._validate_executor = self.settings['signer'].make_pool(self.executor_workers)
+            else:
+                self._validate_executor = ThreadPoolExecutor(self.executor_workers)
+        return self._validate_executor
+
+    @property
+    def notify_executor(self):
+        if self._notify_executor is None:
+            self._notify_executor = ThreadPoolExecutor(self.executor_workers)
+        return self._notify_executor
+
+    @gen.coroutine
+    def validate(self, data):
+        loop = tornado.ioloop.IOLoop.current()
+        if self.executor_type == 'process':
+            result = yield loop.run_in_executor(self.validate_executor, validate_one, data)
+            if result.error:
+                raise result.error
+            data.pop('signature', None)
+        else:
+            yield loop.run_in_executor(
+                self.validate_executor, self.settings['signer'].validate, data)
+
+    @gen.coroutine
+    def dedup_get(self, key):
+        if key is None:
+            raise gen.Return(None)
+        if self.dedup.blocking:
+            response = yield self.run_notify(self.dedup.get, key)
+        else:
+            response = self.dedup.get(key)
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def dedup_set(self, key, response):
+        if self.dedup.blocking:
+            yield self.run_notify(self.dedup.set, key, response)
+        else:
+            self.dedup.set(key, response)
+
+    def run_notify(self, func, *args):
+        return tornado.ioloop.IOLoop.current().run_in_executor(
+            self.notify_executor, func, *args)
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.dedup is not None:
+            self.dedup.close()
+        if self._notify_executor is not None:
+            self._notify_executor.shutdown(wait=False)
+        if self._validate_executor is not None:
+            self._validate_executor.shutdown(wait=False)
+
+
+@gen.coroutine
+def shutdown(http_server, application, drain_timeout=10):
+    '''
+    Stop accepting, wait for in-flight notifies then stop the IOLoop
+    '''
+    logging.info('[NOTIFY]worker %s shutting down' % os.getpid())
+    http_server.stop()
+    deadline = time.time() + drain_timeout
+    while application.pending and time.time() < deadline:
+        yield gen.sleep(0.05)
+    yield http_server.close_all_connections()
+    application.close()
+    tornado.ioloop.IOLoop.current().stop()
+
+
+def forward_signals():
+    '''
+    The prefork parent forwards SIGTERM/SIGINT to its workers and waits
+    for them, workers exiting cleanly are not restarted
+    '''
+    try:
+        os.setpgid(0, 0)
+    except OSError:
+        pass
+
+    parent = os.getpid()
+
+    def forward(signum, frame):
+        if os.getpid() != parent:
+            # a worker inherited the handler and got the signal before
+            # reset_signals, act as the default one
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+            return
+        signal.signal(signum, signal.SIG_IGN)
+        os.killpg(os.getpgrp(), signum)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+
+def reset_signals():
+    '''
+    Workers drop the forwarding handlers inherited from the parent
+    '''
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
 
 def main():
     tornado.options.parse_command_line()
+    sockets = None
+    if not options.reuse_port:
+        sockets = tornado.netutil.bind_sockets(options.port)
+    if options.processes != 1:
+        forward_signals()
+        tornado.process.fork_processes(options.processes)
+        reset_signals()
+    if sockets is None:
+        # every worker binds its own socket, the kernel balances them
+        sockets = tornado.netutil.bind_sockets(options.port, reuse_port=True)
+
+    # load the signer after fork, every worker owns its key objects
     config = load_config(options.config)
+    dedup = None
+    if options.dedup_size:
+        shared = SQLiteDedup(options.dedup_path, ttl=options.dedup_ttl) if options.dedup_path else None
+        dedup = NotifyDedup(options.dedup_size, options.dedup_ttl, shared=shared)
+    journal = None
+    if options.journal_path:
+        # every worker owns a journal, a restarted worker recovers its own
+        journal = NotifyJournal(
+            os.path.join(options.journal_path, 'worker-%d' % (tornado.process.task_id() or 0)),
+            workers=options.journal_workers)
+    capture = None
+    if options.capture_path:
+        path = options.capture_path
+        if options.processes != 1:
+            path = '%s.worker-%d' % (path, tornado.process.task_id() or 0)
+        capture = NotifyCapture(path, redact=options.capture_redact, max_queue=options.capture_queue)
     application = Application(
         config,
-        notify_url=options.notify_url
+        notify_url=options.notify_url,
+        metrics_url=options.metrics_url,
+        executor=options.executor,
+        executor_workers=options.executor_workers,
+        max_pending=options.max_pending,
+        offload_notify=options.offload_notify,
+        debug=options.debug and options.processes == 1,
+        dedup=dedup,
+        journal=journal,
+        capture=capture
     )
     http_server = tornado.httpserver.HTTPServer(application)
-    http_server.listen(options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    http_server.add_sockets(sockets)
+    io_loop = tornado.ioloop.IOLoop.current()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        io_loop.asyncio_loop.add_signal_handler(
+            signum, io_loop.add_callback, shutdown, http_server, application, options.drain_timeout)
+    io_loop.start()
 
 
 if __name__ == '__main__':
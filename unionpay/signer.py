@@ -10,27 +10,31 @@ and an X509 format cert for validate signature
 
 import logging
 import base64
+import collections
+import io
+import multiprocessing
 import os.path
+import threading
 try:
     from urlparse import parse_qs
 except ImportError:
     from urllib.parse import parse_qs
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from hashlib import sha1
-from OpenSSL import crypto
-from OpenSSL.crypto import FILETYPE_PEM
 from datetime import datetime
 from zipfile import ZipFile
-from .util.helper import LineObject
+from . import trace
+from .backends import get_backend
+from .error import SignatureValidateError
+from .response import RAW_FIELDS, GatewayResponse, parse_response
+from .util.helper import LineObject, ObjectDict, settle_year
+from .util.record import ErrorRecord, NormalRecord
 
 
 logger = logging.getLogger(__name__)
 
 
-class SignatureValidateError(Exception):
-    pass
-
-
 class TradeFlowType:
     # 全渠道商户一般交易明细流水文件
     Normal = 'ZM_'
@@ -42,18 +46,169 @@ class TradeFlowType:
     PeriodicError = 'PEDERR_'
 
 
+# longer prefixes first, PEDERR_ must win over PED_
+RECORD_TYPES = (
+    (TradeFlowType.PeriodicError, ErrorRecord),
+    (TradeFlowType.Periodic, NormalRecord),
+    (TradeFlowType.Error, ErrorRecord),
+    (TradeFlowType.Normal, NormalRecord),
+)
+
+
+def get_record_type(filename):
+    '''
+    @filename: settlement file name like INN15121688ZM_777290058110836
+    '''
+    for prefix, record_type in RECORD_TYPES:
+        if prefix in filename:
+            return record_type
+    return LineObject
+
+
+# bytes of a settlement file parsed per worker task
+PARSE_CHUNK = 4 * 1024 * 1024
+
+# inputs smaller than this are parsed serially
+PARSE_MIN_SIZE = 1024 * 1024
+
+
+def split_file(filepath, chunk_size=PARSE_CHUNK):
+    '''
+    Return [(start, end)] byte ranges of about chunk_size covering the
+    file, every range ends after a newline or at the end of the file
+    '''
+    size = os.path.getsize(filepath)
+    ranges = []
+    start = 0
+    with open(filepath, 'rb') as f:
+        while start < size:
+            end = start + chunk_size
+            if end < size:
+                f.seek(end)
+                end += len(f.readline())
+            end = min(end, size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def pool_context():
+    '''
+    Pool workers start from a clean process, forking a process running
+    IOLoop or executor threads could copy a lock held by another thread.
+    Like spawn, forkserver imports __main__ again in the workers, a script
+    starting a pool at import level needs a if __name__ == '__main__' guard
+    '''
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def iter_window(pool, func, tasks, window, ordered=True):
+    '''
+    @window:    tasks in flight, bounds the results buffered
+    @ordered:   yield in task order, otherwise in completion order
+    Yield (task, result) of func run on the pool, the tasks not started
+    yet are cancelled when the caller stops early
+    '''
+    pending = collections.OrderedDict()
+
+    def pop():
+        if ordered:
+            future = next(iter(pending))
+        else:
+            future = next(iter(wait(pending, return_when=FIRST_COMPLETED)[0]))
+        return pending.pop(future), future.result()
+
+    try:
+        for task in tasks:
+            pending[pool.submit(func, task)] = task
+            if len(pending) >= window:
+                yield pop()
+        while pending:
+            yield pop()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+# characters of a value hashed per update, bounds the copies made while
+# hashing a large fileContent
+DIGEST_CHUNK = 64 * 1024
+
+
+def canonical_items(data):
+    '''
+    Return the sorted (name, value) of the non-empty fields like
+    Signer.simple_urlencode uses them, large values are not copied
+    '''
+    items = data.raw_items() if isinstance(data, GatewayResponse) else data.items()
+    result = []
+    for name, value in items:
+        if value is None:
+            continue
+        if not isinstance(value, (str, bytes, memoryview)):
+            value = str(value)
+        if len(value):
+            result.append((name, value))
+    result.sort(key=lambda item: item[0])
+    return result
+
+
+def update_digest(digest, data, chunk_size=DIGEST_CHUNK):
+    '''
+    @digest: hash object like hashlib.sha1()
+    Feed the "name=value&..." signing string of data into digest chunk by
+    chunk, the spaces of RAW_FIELDS are turned back into "+" on the way
+    '''
+    separator = ''
+    for name, value in canonical_items(data):
+        digest.update(('%s%s=' % (separator, name)).encode('utf-8'))
+        separator = '&'
+        fix = name in RAW_FIELDS
+        for start in range(0, len(value), chunk_size):
+            chunk = value[start:start + chunk_size]
+            if isinstance(chunk, str):
+                if fix:
+                    chunk = chunk.replace(' ', '+')
+                chunk = chunk.encode('utf-8')
+            elif fix:
+                chunk = bytes(chunk).replace(b' ', b'+')
+            digest.update(chunk)
+    return digest
+
+
 class Signer(object):
 
-    def __init__(self, pfx_filepath, password, x509_filepath, digest_method='sha1', **kwargs):
+    def __init__(self, pfx_filepath, password, x509_filepath, digest_method='sha1', backend='auto', **kwargs):
         '''
         @pfx_filepath:      pfx file path
         @password:          pfx pem password
         @x509_filepath:     x509 file path
         @digest_method:     default digest method is sha1
+        @backend:           sign backend: pyopenssl, cryptography or auto
         '''
+        with open(pfx_filepath, 'rb') as f:
+            pfx_data = f.read()
+        with open(x509_filepath, 'rb') as f:
+            x509_data = f.read()
+        self.load(pfx_data, password, x509_data, digest_method, backend)
+
+    def load(self, pfx_data, password, x509_data, digest_method='sha1', backend='auto'):
         self.digest_method = digest_method
-        self.PKCS12 = self.loadPKCS12(pfx_filepath, password)
-        self.X509 = self.loadX509(x509_filepath)
+        self.backend = get_backend(backend)(
+            pfx_data, password, x509_data, digest_method)
+        self.cert_id = self.backend.cert_id
+        # kept for rebuilding the signer inside pool workers
+        self.material = (pfx_data, password, x509_data, digest_method, self.backend.name)
+        self._pools = {}
+        self._parse_pools = {}
+        self._pool_lock = threading.Lock()
+
+    @classmethod
+    def from_material(cls, pfx_data, password, x509_data, digest_method='sha1', backend='auto'):
+        signer = cls.__new__(cls)
+        signer.load(pfx_data, password, x509_data, digest_method, backend)
+        return signer
 
     @classmethod
     def getSigner(cls, config):
@@ -64,28 +219,11 @@ class Signer(object):
             config.pfx_filepath,
             config.password,
             config.x509_filepath,
-            config.digest_method
+            config.digest_method,
+            backend=getattr(config, 'sign_backend', 'auto')
         )
         return signer
 
-    @staticmethod
-    def loadPKCS12(filepath, password):
-        '''
-        @filepath: the pfx file path
-        @password: the password of pfx file
-        '''
-        f = open(filepath, 'rb').read()
-        return crypto.load_pkcs12(f, password)
-
-    @staticmethod
-    def loadX509(filepath, filetype=FILETYPE_PEM):
-        '''
-        @filepath: the cert file path
-        @password: the cert type
-        '''
-        f = open(filepath, 'rb').read()
-        return crypto.load_certificate(filetype, f)
-
     @staticmethod
     def simple_urlencode(params, sort=True):
         '''
@@ -113,6 +251,14 @@ class Signer(object):
             data[name] = qs_params.get(name)[-1]
         return data
 
+    @staticmethod
+    def parse_response(raw):
+        '''
+        @raw: gateway response body, bytes
+        Return a GatewayResponse, see unionpay.response
+        '''
+        return parse_response(raw)
+
     @staticmethod
     def filter_params(params):
         '''
@@ -128,31 +274,37 @@ class Signer(object):
                 cp_params.pop(key)
         return cp_params
 
-    @staticmethod
-    def sign_by_soft(private_key, sign_digest, digest_method='sha1'):
-        '''
-        @private_key: the private_key get from PKCS12 pem
-        @sign_digest: the hash value of urlencoded string
-        @digest_method: the unionpay using sha1 digest string
-        '''
-        return crypto.sign(private_key, sign_digest, digest_method)
-
     def sign(self, data):
         '''
         @data: a dict ready for sign, should not contain "signature" key name
         Return base64 encoded signature and set signature to data argument
         '''
-        cert_id = self.PKCS12.get_certificate().get_serial_number()
-        data['certId'] = str(cert_id)
-        string_data = self.simple_urlencode(data)
-        sign_digest = sha1(string_data).hexdigest()
-        private_key = self.PKCS12.get_privatekey()
-        soft_sign = self.sign_by_soft(
-            private_key, sign_digest, self.digest_method)
-        base64sign = base64.b64encode(soft_sign)
+        data['certId'] = self.cert_id
+        with trace.span('digest', data):
+            sign_digest = update_digest(sha1(), data).hexdigest()
+        base64sign = self.sign_hexdigest(sign_digest, data)
         data['signature'] = base64sign
         return base64sign
 
+    def sign_string(self, string_data, data=None):
+        '''
+        @string_data:   the sorted "name=value&..." bytes of a request
+        @data:          the request, only read by tracing hooks
+        Return base64 encoded signature
+        '''
+        with trace.span('digest', data):
+            sign_digest = sha1(string_data).hexdigest()
+        return self.sign_hexdigest(sign_digest, data)
+
+    def sign_hexdigest(self, sign_digest, data=None):
+        '''
+        @sign_digest:   sha1 hexdigest of the signing string
+        Return base64 encoded signature
+        '''
+        with trace.span('rsa_sign', data):
+            soft_sign = self.backend.sign(sign_digest.encode('utf-8'))
+        return base64.b64encode(soft_sign)
+
     def validate(self, data):
         '''
         @data: a dict ready for validate, must contain "signature" key name
@@ -160,12 +312,106 @@ class Signer(object):
         signature = data.pop('signature')
         signature = signature.replace(' ', '+')
         signature = base64.b64decode(signature)
-        if 'fileContent' in data and data['fileContent']:
-            file_content = data['fileContent'].replace(' ', '+')
-            data.update(fileContent=file_content)
-        stringData = self.simple_urlencode(data)
-        digest = sha1(stringData).hexdigest()
-        crypto.verify(self.X509, signature, digest, self.digest_method)
+        with trace.span('digest', data):
+            digest = update_digest(sha1(), data).hexdigest()
+        with trace.span('verify', data):
+            self.backend.verify(signature, digest.encode('utf-8'))
+        # callers read fileContent with "+" restored, lazy values have it
+        file_content = dict.get(data, 'fileContent')
+        if isinstance(file_content, str) and ' ' in file_content:
+            data['fileContent'] = file_content.replace(' ', '+')
+
+    def validate_response(self, response):
+        '''
+        @response: GatewayResponse, its signature is popped like validate
+        When the body was canonical its slices are hashed as they are,
+        otherwise the values are validated like a dict
+        '''
+        parts = response.signing_parts() if isinstance(response, GatewayResponse) else None
+        if parts is None:
+            return self.validate(response)
+        signature = response.pop('signature')
+        signature = base64.b64decode(signature.replace(' ', '+'))
+        with trace.span('digest', response):
+            digest = sha1()
+            for part in parts:
+                digest.update(part)
+            digest = digest.hexdigest()
+        with trace.span('verify', response):
+            self.backend.verify(signature, digest.encode('utf-8'))
+
+    def get_pool(self, processes=None):
+        '''
+        @processes: worker count, default is the cpu count
+        Every worker starts from pool_context and loads the PKCS12/X509
+        material once. One pool is kept per worker count, a pool handed
+        out is never shut down before close
+        '''
+        processes = processes or multiprocessing.cpu_count()
+        with self._pool_lock:
+            pool = self._pools.get(processes)
+            if pool is None:
+                pool = self._pools[processes] = self.make_pool(processes)
+        return pool
+
+    def make_pool(self, processes=None):
+        '''
+        @processes: worker count, default is the cpu count
+        Build a new pool of signer workers, the caller owns and closes it
+        '''
+        return ProcessPoolExecutor(
+            processes or multiprocessing.cpu_count(), mp_context=pool_context(),
+            initializer=_init_worker, initargs=self.material)
+
+    def get_parse_pool(self, processes=None):
+        '''
+        @processes: worker count, default is the cpu count
+        Pool of iter_file_data_parallel, kept apart from get_pool so
+        parsing never queues behind signing, its workers load no key
+        '''
+        processes = processes or multiprocessing.cpu_count()
+        with self._pool_lock:
+            pool = self._parse_pools.get(processes)
+            if pool is None:
+                pool = self._parse_pools[processes] = ProcessPoolExecutor(processes, mp_context=pool_context())
+        return pool
+
+    def close(self):
+        with self._pool_lock:
+            pools = list(self._pools.values()) + list(self._parse_pools.values())
+            self._pools, self._parse_pools = {}, {}
+        for pool in pools:
+            pool.shutdown()
+
+    def map_many(self, func, items, processes=None, chunksize=None, min_batch=64):
+        items = list(items)
+        if len(items) < min_batch:
+            return [func(item, self) for item in items]
+        processes = processes or multiprocessing.cpu_count()
+        chunksize = chunksize or max(1, len(items) // (processes * 4))
+        pool = self.get_pool(processes)
+        return list(pool.map(func, items, chunksize=chunksize))
+
+    def sign_many(self, items, processes=None, chunksize=None, min_batch=64):
+        '''
+        @items:     dicts ready for sign, left untouched
+        @processes: pool worker count
+        @chunksize: items sent to a worker per IPC round trip
+        @min_batch: batches smaller than this are signed serially
+
+        Return ObjectDict(result, error) in input order, result is a signed
+        copy of the item. Runs on get_pool, see pool_context for the
+        __main__ guard scripts need
+        '''
+        return self.map_many(sign_one, items, processes, chunksize, min_batch)
+
+    def validate_many(self, items, processes=None, chunksize=None, min_batch=64):
+        '''
+        @items: dicts ready for validate, left untouched
+        Return ObjectDict(result, error) in input order, result is True
+        when the signature is valid
+        '''
+        return self.map_many(validate_one, items, processes, chunksize, min_batch)
 
     @staticmethod
     def accept_filetype(f, merchant_id):
@@ -182,32 +428,36 @@ class Signer(object):
         return res
 
     @staticmethod
-    def save_file_data(settle_date, data, temp_path, merchant_id, temp_prefix='unionpay_'):
+    def save_file_data(settle_date, data, temp_path, merchant_id, temp_prefix='unionpay_', year=None):
         '''
         @settle_date:   like 1216 for generate filename
-        @data:          fileContent from request
+        @data:          unzipped fileContent bytes or a seekable file object
         @temp_path:     save data to a temp path
+        @year:          settle year, default is inferred from settle_date
 
         '''
         timeRandomString = datetime.now().strftime("%Y%m%d%H%M%S")
         path = os.path.join(
-            temp_path, "%s%s%s" % (temp_prefix, datetime.now().year, settle_date))
+            temp_path, "%s%s%s" % (temp_prefix, year or settle_year(settle_date), settle_date))
 
         if not os.path.exists(path):
             os.mkdir(path)
 
-        fileWholePath = "%s/SMT_%s.zip" % (path, timeRandomString)
-        with open(fileWholePath, 'wb') as f:
-            f.write(data)
-        logger.debug("temp file <%s> created！" % fileWholePath)
-        zfile = ZipFile(fileWholePath, 'r')
+        fileWholePath = None
+        if isinstance(data, bytes):
+            fileWholePath = "%s/SMT_%s.zip" % (path, timeRandomString)
+            with open(fileWholePath, 'wb') as f:
+                f.write(data)
+            logger.debug("temp file <%s> created！" % fileWholePath)
+        zfile = ZipFile(fileWholePath or data, 'r')
         zfile.extractall(path)
         files_list = zfile.infolist()
         logger.debug("file <%s> unziped！" % ','.join(zfile.namelist()))
         zfile.close()
         logger.debug("balance file <%s> saved!" % path)
-        os.unlink(fileWholePath)
-        logger.debug("temp file deleted")
+        if fileWholePath is not None:
+            os.unlink(fileWholePath)
+            logger.debug("temp file deleted")
 
         balance_files = []
 
@@ -224,18 +474,171 @@ class Signer(object):
 
         return insert_params
 
-    @staticmethod
-    def parse_line(settle_date, item, params_list):
-        with open(item, 'rb') as f:
-            for field in f.readlines():
-                line = LineObject(field)
-                params = {
+    def iter_file_data_parallel(self, files_list, settle_date, processes=None, ordered=True, chunk_size=PARSE_CHUNK,
+                                min_size=PARSE_MIN_SIZE, window=None):
+        '''
+        @files_list:    extracted settlement files
+        @processes:     pool worker count, default is the cpu count
+        @ordered:       yield in file and line order like
+                        reader_file_data, otherwise in completion order
+        @chunk_size:    large files are split on line boundaries into
+                        ranges of about this many bytes
+        @min_size:      inputs smaller than this are parsed serially
+        @window:        ranges in flight, default is twice processes
+
+        Yield the records of reader_file_data, byte ranges are parsed on
+        get_parse_pool. Workers only send the parsed fields back, the raw
+        lines are read again here. The workers start from pool_context,
+        a script calling this at import level needs a
+        if __name__ == '__main__' guard
+        '''
+        tasks = []
+        for item in files_list:
+            for start, end in split_file(item, chunk_size):
+                tasks.append((item, start, end))
+        if not tasks:
+            return
+        processes = processes or multiprocessing.cpu_count()
+        if processes == 1 or sum(end - start for _, start, end in tasks) < min_size:
+            for record in Signer.reader_file_data(files_list, settle_date):
+                yield record
+            return
+        pool = self.get_parse_pool(processes)
+        for task, values in iter_window(pool, _parse_range, tasks, window or processes * 2, ordered):
+            filepath, start, end = task
+            with open(filepath, 'rb') as f:
+                f.seek(start)
+                data = io.BytesIO(f.read(end - start))
+            for field, (txn_type, order_id, query_id, txn_amt, mer_id) in zip(data, values):
+                yield {
                     'settle_date': settle_date,
-                    'txnType': line.txnType,
-                    'orderId': line.orderId,
-                    'queryId': line.queryId,
-                    'txnAmt': line.txnAmt,
-                    'merId': line.merId,
+                    'txnType': txn_type,
+                    'orderId': order_id,
+                    'queryId': query_id,
+                    'txnAmt': txn_amt,
+                    'merId': mer_id,
                     'data': field
                 }
-                params_list.append(params)
+
+    def reader_file_data_parallel(self, files_list, settle_date, processes=None, chunk_size=PARSE_CHUNK,
+                                  min_size=PARSE_MIN_SIZE):
+        '''
+        Parallel reader_file_data, the same records in the same order
+        '''
+        return list(self.iter_file_data_parallel(
+            files_list, settle_date, processes, True, chunk_size, min_size))
+
+    @staticmethod
+    def reader_file_columns(files_list, settle_date, year=None, fields=None):
+        '''
+        Columnar variant of reader_file_data, needs numpy
+        Return {filename: numpy structured array}
+        '''
+        from . import columnar
+        return columnar.load_files(files_list, settle_date, year, fields)
+
+    @staticmethod
+    def parse_line(settle_date, item, params_list):
+        record_type = get_record_type(os.path.basename(item))
+        with open(item, 'rb') as f:
+            for field in f:
+                params_list.append(Signer.make_params(settle_date, field, record_type))
+
+    @staticmethod
+    def make_params(settle_date, field, record_type=LineObject):
+        line = record_type(field)
+        return {
+            'settle_date': settle_date,
+            'txnType': line.get('txnType'),
+            'orderId': line.get('orderId'),
+            'queryId': line.get('queryId'),
+            'txnAmt': line.txnAmt,
+            'merId': line.merId,
+            'data': field
+        }
+
+    @staticmethod
+    def iter_file_data(settle_date, data, merchant_id, sink=None):
+        '''
+        @settle_date:   like 1216
+        @data:          unzipped fileContent bytes or a seekable file object
+        @merchant_id:   merchant id
+        @sink:          optional directory to also write accepted files to
+
+        Yield records member by member and line by line instead of
+        collecting them into a list. Bytes data keep the whole archive in
+        memory, pass the file object of util.stream.decode_file_content to
+        bound it by its max_memory
+        '''
+        fileobj = io.BytesIO(data) if isinstance(data, bytes) else data
+        with ZipFile(fileobj, 'r') as zfile:
+            for item in zfile.infolist():
+                if not Signer.accept_filetype(item.filename, merchant_id):
+                    continue
+                logger.debug("balance file <%s> streaming" % item.filename)
+                record_type = get_record_type(os.path.basename(item.filename))
+                with zfile.open(item) as member:
+                    if sink is None:
+                        for field in member:
+                            yield Signer.make_params(settle_date, field, record_type)
+                        continue
+                    if not os.path.exists(sink):
+                        os.makedirs(sink)
+                    filename = os.path.join(sink, os.path.basename(item.filename))
+                    with open(filename, 'wb') as out:
+                        for field in member:
+                            out.write(field)
+                            yield Signer.make_params(settle_date, field, record_type)
+
+
+_worker_signer = None
+
+
+def _init_worker(*material):
+    global _worker_signer
+    _worker_signer = Signer.from_material(*material)
+
+
+def sign_one(item, signer=None):
+    '''
+    @item:      dict ready for sign, left untouched
+    @signer:    default is the signer of the pool worker
+    Pool worker entry point, return ObjectDict(result, error)
+    '''
+    try:
+        data = dict(item)
+        (signer or _worker_signer).sign(data)
+    except Exception as e:
+        return ObjectDict(result=None, error=e)
+    return ObjectDict(result=data, error=None)
+
+
+def _parse_range(task):
+    '''
+    Return the make_params fields of every line as compact tuples, the
+    raw lines are not pickled back
+    '''
+    filepath, start, end = task
+    record_type = get_record_type(os.path.basename(filepath))
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        data = io.BytesIO(f.read(end - start))
+    values = []
+    for field in data:
+        line = record_type(field)
+        values.append((line.get('txnType'), line.get('orderId'), line.get('queryId'), line.txnAmt, line.merId))
+    return values
+
+
+def validate_one(item, signer=None):
+    '''
+    @item:      dict carrying the signature, left untouched
+    @signer:    default is the signer of the pool worker
+    Pool worker entry point, run it on Signer.get_pool, return
+    ObjectDict(result, error)
+    '''
+    try:
+        (signer or _worker_signer).validate(dict(item))
+    except Exception as e:
+        return ObjectDict(result=False, error=e)
+    return ObjectDict(result=True, error=None)
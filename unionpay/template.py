@@ -0,0 +1,160 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Precompiled request templates
+
+Most fields of a transaction request are the same on every call. A
+RequestTemplate filters, stringifies and sorts them once, then a call
+only merges the few dynamic fields into the precomputed layout, building
+the signing string and the POST body in one pass:
+
+    template = RequestTemplate(constants, ('orderId', 'txnTime', 'txnAmt'))
+    data = template.bind(orderId='TEST1', txnTime='20151216103000', txnAmt=1)
+    data.sign(signer)
+    body = data.encode()
+'''
+
+from .error import UnionpayError
+from .signer import Signer
+try:
+    from urllib import quote_plus
+except ImportError:
+    from urllib.parse import quote_plus
+
+
+class RequestTemplate(object):
+
+    def __init__(self, constants, dynamic):
+        '''
+        @constants: {field: value} sent with every request, None and empty
+                    values are dropped like Signer.filter_params does
+        @dynamic:   names of the fields given to bind()
+        '''
+        self.dynamic = frozenset(dynamic)
+        self.constants = {}
+        for name, value in constants.items():
+            if value is None or len(str(value)) == 0:
+                continue
+            if name in self.dynamic:
+                raise UnionpayError('field %s is both constant and dynamic' % name)
+            self.constants[name] = str(value)
+
+        # (rendered part or None, dynamic field name or None)
+        self.before = []
+        self.after = []
+        layout = self.before
+        for name in sorted(set(self.constants) | self.dynamic | set(['signature'])):
+            if name == 'signature':
+                layout = self.after
+            elif name in self.constants:
+                layout.append(('%s=%s' % (name, self.constants[name]), None))
+            else:
+                layout.append((name + '=', name))
+
+    def bind(self, **values):
+        '''
+        Return a TemplateRequest with the constant and the non-empty
+        dynamic fields
+        '''
+        unknown = set(values) - self.dynamic
+        if unknown:
+            raise UnionpayError('unknown fields %s' % ', '.join(sorted(unknown)))
+        request = TemplateRequest(self.constants)
+        for name, value in values.items():
+            if value is not None and value != '':
+                request[name] = value
+        request.template = self
+        return request
+
+    @staticmethod
+    def render_layout(layout, data, parts):
+        '''
+        Append "name=value" of every field of layout present in data to
+        parts, return the count of dynamic fields appended
+        '''
+        count = 0
+        for part, name in layout:
+            if name is None:
+                parts.append(part)
+                continue
+            value = data.get(name)
+            if value is None:
+                continue
+            value = value if type(value) is str else str(value)
+            if value:
+                parts.append(part + value)
+                count += 1
+        return count
+
+    def constants_changed(self, data):
+        '''
+        @data: a TemplateRequest of this template
+        bind() shares the constant values, so an unchanged one is found
+        by identity
+        '''
+        for name, value in self.constants.items():
+            current = data.get(name)
+            if current is not value and str(current) != value:
+                return True
+        return False
+
+    def render(self, data):
+        '''
+        @data: a TemplateRequest of this template
+        Return (parts before signature, parts after signature), or None
+        when fields were added, removed or constants changed since bind()
+        '''
+        if self.constants_changed(data):
+            return None
+        before = []
+        after = []
+        count = self.render_layout(self.before, data, before) + self.render_layout(self.after, data, after)
+        expected = len(self.constants) + count + (1 if 'signature' in data else 0)
+        if len(data) != expected:
+            return None
+        return before, after
+
+
+class TemplateRequest(dict):
+
+    '''
+    A request dict built by RequestTemplate.bind, usable wherever a plain
+    request dict is. Adding or removing fields or changing a constant one
+    falls back to the generic signing path
+    '''
+
+    __slots__ = ('template',)
+
+    def sign(self, signer):
+        '''
+        @signer: Signer, the template should hold its cert_id as certId
+        Return base64 encoded signature and set it to the request
+        '''
+        self.pop('signature', None)
+        parts = None
+        if self.get('certId') == signer.cert_id:
+            parts = self.template.render(self)
+        if parts is None:
+            return signer.sign(self)
+        before, after = parts
+        signature = signer.sign_string('&'.join(before + after).encode('utf-8'), self)
+        self['signature'] = signature
+        return signature
+
+    def encode(self):
+        '''
+        Return the POST body, only the signature is urlencoded like the
+        gateway expects. The layout is rendered again, fields changed
+        after signing are sent as they are
+        '''
+        signature = self['signature']
+        if isinstance(signature, bytes):
+            signature = signature.decode('utf-8')
+        self['signature'] = quote_plus(signature)
+        parts = self.template.render(self)
+        if parts is None:
+            return Signer.simple_urlencode(self)
+        before, after = parts
+        return '&'.join(before + ['signature=' + self['signature']] + after).encode('utf-8')
@@ -0,0 +1,72 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Factories shared by the tests and benchmarks
+'''
+
+import os
+import tempfile
+from unionpay.gateway import export_cert, iter_settlement_lines, make_file_content, make_settlement_zip  # noqa
+from unionpay.loadgen import point_config
+from unionpay.signer import Signer
+from unionpay.util.helper import ObjectDict
+
+
+PEM_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'pem')
+PFX_FILEPATH = os.path.join(PEM_PATH, 'PM_700000000000001_acp.pfx')
+X509_FILEPATH = os.path.join(PEM_PATH, 'verify_sign_acp.cer')
+PASSWORD = '000000'
+
+
+def make_self_x509(pfx_filepath=PFX_FILEPATH, password=PASSWORD):
+    '''
+    The bundled verify cert belongs to unionpay, export the cert of the
+    test pfx so our own signatures can be validated
+    '''
+    fd, path = tempfile.mkstemp(suffix='.cer')
+    os.close(fd)
+    return export_cert(pfx_filepath, password, path)
+
+
+def make_signer(backend='auto'):
+    x509_filepath = make_self_x509()
+    try:
+        return Signer(PFX_FILEPATH, PASSWORD, x509_filepath, backend=backend)
+    finally:
+        os.unlink(x509_filepath)
+
+
+def make_request():
+    return {
+        'version': '5.0.0',
+        'encoding': 'UTF-8',
+        'signMethod': '01',
+        'txnType': '01',
+        'txnSubType': '01',
+        'bizType': '000201',
+        'merId': '700000000000001',
+        'orderId': 'TESTPAY20151112160025',
+        'txnTime': '20151112160025',
+        'txnAmt': 25,
+        'currencyCode': '156',
+        'orderDesc': None
+    }
+
+
+def make_client_config(gateway):
+    '''
+    @gateway: url of a unionpay.gateway.Gateway, every trans url points at it
+    '''
+    return point_config(ObjectDict(
+        pfx_filepath=PFX_FILEPATH,
+        password=PASSWORD,
+        digest_method='sha1',
+        merchant_id='777290058110836',
+        backend_url='http://127.0.0.1/notify',
+        app_trans_url='https://101.231.204.80:5000/gateway/api/appTransReq.do',
+        back_trans_url='https://101.231.204.80:5000/gateway/api/backTransReq.do',
+        single_query_url='https://101.231.204.80:5000/gateway/api/queryTrans.do',
+        file_trans_url='https://101.231.204.80:9080/',
+    ), gateway)
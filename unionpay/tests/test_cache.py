@@ -0,0 +1,66 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+import io
+import os
+import shutil
+import tempfile
+from datetime import date, datetime
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from unionpay.util.cache import SettlementCache
+from unionpay.util.helper import in_settle_window, iter_dates, settle_year, to_date
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_store(self):
+        cache = SettlementCache(self.path)
+        key = cache.key('777290058110836', '00', date(2015, 12, 16))
+        self.assertEqual(key, '777290058110836/00/20151216')
+        self.assertIsNone(cache.get(key))
+        entry = cache.store(key, io.BytesIO(b'archive'), chunk_size=3, fileName='INN15121688ZM_777290058110836')
+        self.assertEqual(entry['size'], 7)
+        with open(cache.object_path(entry), 'rb') as f:
+            self.assertEqual(f.read(), b'archive')
+
+        # same content, same object
+        other = cache.store(cache.key('777290058110836', '00', date(2015, 12, 17)), io.BytesIO(b'archive'))
+        self.assertEqual(other['sha256'], entry['sha256'])
+        self.assertEqual(os.listdir(cache.objects), ['%s.zip' % entry['sha256']])
+
+        reopened = SettlementCache(self.path)
+        self.assertEqual(reopened.get(key)['fileName'], 'INN15121688ZM_777290058110836')
+        # truncated by a crash
+        with open(cache.object_path(entry), 'r+b') as f:
+            f.truncate(3)
+        self.assertIsNone(reopened.get(key))
+        os.unlink(cache.object_path(entry))
+        self.assertIsNone(reopened.get(key))
+
+    def test_dates(self):
+        self.assertEqual(settle_year('1231', date(2016, 1, 2)), 2015)
+        self.assertEqual(settle_year('0101', date(2016, 1, 2)), 2016)
+        self.assertEqual(settle_year('0102', date(2016, 1, 2)), 2016)
+        self.assertEqual(to_date('2015-12-16'), date(2015, 12, 16))
+        self.assertEqual(to_date(datetime(2015, 12, 16, 10)), date(2015, 12, 16))
+        self.assertTrue(in_settle_window(date(2016, 1, 2), date(2016, 1, 2)))
+        self.assertTrue(in_settle_window(date(2015, 1, 3), date(2016, 1, 2)))
+        self.assertFalse(in_settle_window(date(2015, 1, 2), date(2016, 1, 2)))
+        self.assertFalse(in_settle_window(date(2016, 1, 3), date(2016, 1, 2)))
+        days = list(iter_dates('20151230', date(2016, 1, 2)))
+        self.assertEqual([day.strftime('%m%d') for day in days], ['1230', '1231', '0101', '0102'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+try:
+    import numpy as np
+    from unionpay import columnar
+except ImportError:
+    np = None
+
+from unionpay.util.record import ErrorRecord, NormalRecord
+
+
+def make_lines(count):
+    lines = []
+    for i in range(count):
+        lines.append(NormalRecord.pack({
+            'txnTime': '1231235959',
+            'txnAmt': '%012d' % (i * 100),
+            'txnType': ('01', '04', '31')[i % 3],
+            'merId': 'M%d' % (i % 2),
+            'orderId': 'ORDER%d' % i,
+            'merFee': 'D%012d' % i,
+        }))
+    return lines
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class ColumnarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.records = columnar.load_bytes(
+            b''.join(make_lines(7)), settle_date='0101', year=2016)
+
+    def test_load(self):
+        records = self.records
+        self.assertEqual(len(records), 7)
+        self.assertEqual(records['orderId'][1], b'ORDER1')
+        self.assertEqual(records['txnAmt'][3], 300)
+        self.assertEqual(records['merFee'][2], -2)
+        self.assertEqual(records['txnTime'][0], np.datetime64('2015-12-31T23:59:59'))
+        self.assertEqual(records['settleDate'][0], np.datetime64('2016-01-01'))
+
+    def test_ragged_lines(self):
+        data = b''.join(line.rstrip() + b'\n' for line in make_lines(7))
+        records = columnar.load_bytes(data, settle_date='0101', year=2016)
+        self.assertTrue((records == self.records).all())
+
+    def test_error_layout(self):
+        records = columnar.load_bytes(
+            ErrorRecord.pack({'txnAmt': '5', 'merFee': 'C000000000003'}), ErrorRecord)
+        self.assertEqual(records['merFee'][0], 3)
+        self.assertTrue(np.isnat(records['txnTime'][0]))
+        self.assertNotIn('orderId', records.dtype.names)
+
+    def test_totals(self):
+        totals = columnar.totals_by_txn_type(self.records)
+        self.assertEqual(totals.tolist(), [(b'01', 3, 900), (b'04', 2, 500), (b'31', 2, 700)])
+        totals = columnar.group_totals(self.records, ('merId', 'txnType'))
+        self.assertEqual(totals['count'].sum(), 7)
+
+    def test_netting(self):
+        net = columnar.netting(self.records)
+        self.assertEqual(net.tolist(), [(b'M0', 600, 600, 0), (b'M1', 300, 600, -300)])
+
+
+if __name__ == '__main__':
+    unittest.main()
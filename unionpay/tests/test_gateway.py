@@ -0,0 +1,261 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import requests
+from tornado.ioloop import IOLoop
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from unionpay.client import UnionpayClient
+from unionpay.error import UnionpayError
+from unionpay.gateway import Gateway
+from unionpay.loadgen import LoadGenerator, percentile
+from unionpay.metrics import Registry
+from unionpay.signer import Signer
+from unionpay.tests.support import make_client_config, make_self_x509, make_signer
+from unionpay.util.pool import SessionPool
+
+
+class GatewayTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.app = Gateway(make_signer(), file_lines=20)
+        return self.app
+
+    def setUp(self):
+        super(GatewayTest, self).setUp()
+        config = make_client_config(self.get_url('/'))
+        config.x509_filepath = make_self_x509()
+        try:
+            self.client = UnionpayClient(config, registry=Registry())
+        finally:
+            os.unlink(config.x509_filepath)
+
+    def tearDown(self):
+        self.client.close()
+        self.app.close()
+        super(GatewayTest, self).tearDown()
+
+    def test_point_config(self):
+        self.assertEqual(self.client.config.file_trans_url, self.get_url('/'))
+        self.assertEqual(self.client.config.single_query_url, self.get_url('/gateway/api/queryTrans.do'))
+
+    @gen_test
+    def test_query(self):
+        resp = yield self.client.async_query('ORDER1', '20151216103000')
+        self.assertEqual(resp['respCode'], '00')
+        self.assertEqual(resp['orderId'], 'ORDER1')
+        self.assertEqual(resp['origRespCode'], '00')
+        stages = self.client.metrics.stage_seconds.snapshot()
+        self.assertEqual(stages[('parse', '00')]['count'], 1)
+        self.assertNotIn(('parse', ''), stages)
+
+    @gen_test
+    def test_pay(self):
+        resp = yield self.client.async_pay(100, 'ORDER2')
+        self.assertEqual(len(resp['tn']), 21)
+
+    @gen_test
+    def test_file_transfer(self):
+        records = yield self.client.async_file_transfer('00', '1216', stream=True)
+        records = list(records)
+        self.assertEqual(len(records), 20)
+        self.assertEqual(records[0]['merId'], '777290058110836')
+
+    @gen_test
+    def test_bad_signature(self):
+        sign_data = self.client.sign_data
+
+        def tampered(data):
+            data = sign_data(data)
+            data['orderId'] = 'ORDER4'
+            return data
+        self.client.sign_data = tampered
+        with self.assertRaises(UnionpayError) as context:
+            yield self.client.async_query('ORDER3', '20151216103000')
+        self.assertEqual(context.exception.resp_code, '11')
+
+    @gen_test
+    def test_errors(self):
+        self.app.fail_rate = 1
+        with self.assertRaises(UnionpayError) as context:
+            yield self.client.async_query('ORDER4', '20151216103000')
+        self.assertEqual(context.exception.resp_code, '03')
+        self.app.fail_rate = 0
+        self.app.error_rate = 1
+        with self.assertRaises(UnionpayError):
+            yield self.client.async_query('ORDER4', '20151216103000')
+
+    @gen_test
+    def test_query_many(self):
+        pack = self.app.pack
+        post = self.client.session_pool.post
+
+        def failed_pack(response):
+            if response.get('orderId') == 'ORDER1' and 'origRespCode' in response:
+                response['origRespCode'] = '03'
+            return pack(response)
+
+        def broken_post(addr, data, **kwargs):
+            if b'ORDER2' in data:
+                raise requests.ConnectionError('connection reset')
+            return post(addr, data, **kwargs)
+
+        orders = [('ORDER%d' % i, '20151216103000') for i in range(5)]
+        with mock.patch.object(self.app, 'pack', failed_pack), \
+                mock.patch.object(self.client.session_pool, 'post', broken_post):
+            results = yield IOLoop.current().run_in_executor(
+                None, lambda: list(self.client.query_many(orders, concurrency=2)))
+        results = dict((item.order[0], item) for item in results)
+        self.assertEqual(sorted(results), ['ORDER%d' % i for i in range(5)])
+        self.assertIsInstance(results['ORDER1'].error, UnionpayError)
+        self.assertIsNotNone(results['ORDER2'].error)
+        for order_id in ('ORDER0', 'ORDER3', 'ORDER4'):
+            self.assertIsNone(results[order_id].error)
+            self.assertEqual(results[order_id].result['orderId'], order_id)
+
+    def test_query_many_concurrency(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def query(order_id, txn_time):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.3 if order_id == 'SLOW' else 0.02)
+            with lock:
+                state['running'] -= 1
+            return order_id
+
+        orders = [('SLOW', '')] + [('ORDER%d' % i, '') for i in range(6)]
+        with mock.patch.object(self.client, 'query', query):
+            results = list(self.client.query_many(orders, concurrency=3))
+        self.assertEqual(state['peak'], 3)
+        # yielded as completed, the slow first order comes last
+        self.assertEqual(results[-1].result, 'SLOW')
+        self.assertEqual(sorted(item.result for item in results[:-1]), ['ORDER%d' % i for i in range(6)])
+
+    def test_query_many_break(self):
+        running = threading.Event()
+        release = threading.Event()
+        called = []
+
+        def query(order_id, txn_time):
+            called.append(order_id)
+            if order_id == 'ORDER0':
+                running.wait(5)
+            else:
+                running.set()
+                release.wait(5)
+            return order_id
+
+        orders = [('ORDER%d' % i, '') for i in range(5)]
+        try:
+            with mock.patch.object(self.client, 'query', query):
+                results = self.client.query_many(orders, concurrency=2)
+                self.assertEqual(next(results).result, 'ORDER0')
+                started = time.time()
+                # ORDER1 is still running, closing does not wait for it
+                results.close()
+                self.assertLess(time.time() - started, 1)
+        finally:
+            release.set()
+        self.assertEqual(sorted(called), ['ORDER0', 'ORDER1'])
+
+    @gen_test
+    def test_file_transfer_range(self):
+        cache_dir = tempfile.mkdtemp()
+        merchants = ['777290058110836', '777290058110837']
+
+        def run(start, end, today=date(2016, 1, 2)):
+            return IOLoop.current().run_in_executor(None, lambda: self.client.file_transfer_range(
+                start, end, merchants=merchants, cache_dir=cache_dir, concurrency=3, today=today))
+        try:
+            # MMDD of another year or of the future
+            for start, end in (('20141231', '20150102'), ('20160102', '20160103')):
+                with self.assertRaises(UnionpayError):
+                    yield run(start, end)
+            with self.assertRaises(UnionpayError):
+                yield run(date.today(), date.today() + timedelta(days=1), None)
+
+            # partial failure, nothing is cached
+            self.app.fail_rate = 1
+            results = yield run('20151230', '20151231')
+            self.assertTrue(all(result.error is not None for result in results))
+            self.app.fail_rate = 0
+
+            results = yield run('20151230', '20151231')
+            self.assertEqual([result.cached for result in results], [False] * 4)
+
+            # resumed, the year boundary is crossed
+            results = yield run(date(2015, 12, 30), date(2016, 1, 2))
+            self.assertEqual(len(results), 8)
+            self.assertEqual([result.cached for result in results], [True] * 4 + [False] * 4)
+            self.assertEqual([result.year for result in results[::2]], [2015, 2015, 2016, 2016])
+            self.assertEqual(results[4].settle_date, '0101')
+            self.assertTrue(all(result.error is None for result in results))
+
+            result = results[5]
+            self.assertEqual(result.merchant_id, '777290058110837')
+            with open(result.path, 'rb') as f:
+                records = list(Signer.iter_file_data(result.settle_date, f, result.merchant_id))
+            self.assertEqual(len(records), 20)
+            self.assertEqual(records[0]['merId'], '777290058110837')
+            self.assertEqual(len(os.listdir(os.path.join(cache_dir, 'objects'))), 8)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    @gen_test
+    def test_load_generator(self):
+        self.app.latency = 0.01
+        generator = LoadGenerator(self.client, 'query', qps=100, duration=0.2)
+        report = yield generator.run()
+        self.assertEqual(report['scheduled'], 20)
+        self.assertEqual(report['completed'], 20)
+        self.assertEqual(report['errors'], {})
+        self.assertGreaterEqual(report['latency']['p50'], 0.01)
+
+    @gen_test
+    def test_load_generator_back_trans(self):
+        for txn in ('refund', 'revoke'):
+            generator = LoadGenerator(self.client, txn, qps=100, duration=0.05)
+            report = yield generator.run()
+            self.assertEqual(report['completed'], 5)
+            self.assertEqual(report['errors'], {})
+
+    def test_load_generator_arguments(self):
+        with mock.patch('unionpay.loadgen.make_args', return_value=((1, 2, 3, 4), {})):
+            with self.assertRaises(TypeError):
+                LoadGenerator(self.client, 'revoke')
+
+    def test_shared_session_pool(self):
+        pool = SessionPool()
+        config = make_client_config(self.get_url('/'))
+        config.x509_filepath = make_self_x509()
+        try:
+            shared = UnionpayClient(config, session_pool=pool, registry=Registry())
+        finally:
+            os.unlink(config.x509_filepath)
+        shared.close()
+        self.assertFalse(pool.closed)
+        self.client.close()
+        self.assertTrue(self.client.session_pool.closed)
+        pool.close()
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 99.9), 100)
+        self.assertIsNone(percentile([], 50))
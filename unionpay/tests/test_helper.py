@@ -0,0 +1,52 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from unionpay.util import helper
+from unionpay.util.helper import make_submit_fields, make_submit_form, write_submit_form
+
+
+class RecordHandler(object):
+
+    def __init__(self):
+        self.headers = {}
+        self.parts = []
+
+    def set_header(self, name, value):
+        self.headers[name] = value
+
+    def write(self, part):
+        self.parts.append(part)
+
+
+class SubmitFormTest(unittest.TestCase):
+
+    def test_submit_form(self):
+        data = {'orderId': 'A"B<C>&D', 'txnAmt': 1, 'empty': '', 'orderDesc': u'测试'}
+        form = make_submit_form(data, 'http://127.0.0.1/front?a=1&b=2')
+        self.assertIn('action="http://127.0.0.1/front?a=1&amp;b=2"', form)
+        self.assertIn('value="A&quot;B&lt;C&gt;&amp;D"', form)
+        self.assertIn('name="txnAmt" id="txnAmt" value="1"', form)
+        self.assertIn(u'value="测试"', form)
+        self.assertNotIn('empty', form)
+
+        fields = make_submit_fields(data, 'http://127.0.0.1/front')
+        handler = RecordHandler()
+        write_submit_form(handler, fields['fields'], fields['action'])
+        self.assertEqual(''.join(handler.parts), make_submit_form(data, 'http://127.0.0.1/front'))
+        self.assertTrue(handler.headers['Content-Type'].startswith('text/html'))
+
+    def test_bounded_caches(self):
+        for i in range(1000):
+            make_submit_form({'field%d' % i: 'value'}, 'http://127.0.0.1/front/%d' % i)
+        self.assertLessEqual(helper._form_head.cache_info().currsize, 16)
+        self.assertLessEqual(helper._input_prefix.cache_info().currsize, 256)
+
+
+if __name__ == '__main__':
+    unittest.main()
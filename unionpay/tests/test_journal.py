@@ -0,0 +1,107 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from unionpay.journal import NotifyJournal
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.handled = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def handler(self, data):
+        with self.lock:
+            self.handled.append(data['orderId'])
+
+    def test_append(self):
+        journal = NotifyJournal(self.path, segment_size=200, fsync=False)
+        journal.start(self.handler)
+        futures = [journal.append({'orderId': str(i)}) for i in range(20)]
+        self.assertEqual(sorted(f.result(5) for f in futures), list(range(1, 21)))
+        self.assertTrue(wait_for(lambda: len(self.handled) == 20))
+        journal.close()
+        # every rotated segment is fully acked and removed
+        self.assertEqual(len([name for name in os.listdir(self.path) if name.endswith('.log')]), 1)
+
+    def test_retry(self):
+        failures = []
+
+        def handler(data):
+            if not failures:
+                failures.append(data)
+                raise ValueError('downstream down')
+            self.handler(data)
+
+        journal = NotifyJournal(self.path, fsync=False, retry_delay=0.01)
+        journal.start(handler)
+        journal.append({'orderId': 'A'}).result(5)
+        self.assertTrue(wait_for(lambda: self.handled == ['A']))
+        journal.close()
+
+    def test_recover(self):
+        journal = NotifyJournal(self.path, fsync=False)
+        journal.start(lambda data: time.sleep(10))
+        journal.append({'orderId': 'A'}).result(5)
+        journal.append({'orderId': 'B'}).result(5)
+        journal.close(timeout=0.1)
+
+        journal = NotifyJournal(self.path, fsync=False)
+        journal.start(self.handler)
+        self.assertTrue(wait_for(lambda: len(self.handled) == 2))
+        self.assertEqual(journal.append({'orderId': 'C'}).result(5), 3)
+        self.assertTrue(wait_for(lambda: len(self.handled) == 3))
+        journal.close()
+
+    def test_torn_ack(self):
+        journal = NotifyJournal(self.path, fsync=False)
+        journal.start(lambda data: time.sleep(10))
+        journal.append({'orderId': 'A'}).result(5)
+        journal.append({'orderId': 'B'}).result(5)
+        journal.close(timeout=0.1)
+        # the ack of entry 12 cut after its first digit
+        ack_path = journal.segment_path(1, 'ack')
+        with open(ack_path, 'wb') as f:
+            f.write(b'1\n1')
+
+        release = threading.Event()
+
+        def handler(data):
+            release.wait(5)
+            self.handler(data)
+
+        journal = NotifyJournal(self.path, fsync=False)
+        journal.start(handler)
+        with open(ack_path, 'rb') as f:
+            self.assertEqual(f.read(), b'1\n')
+        release.set()
+        self.assertTrue(wait_for(lambda: self.handled == ['B']))
+        # the segment is fully acked again
+        self.assertTrue(wait_for(lambda: not os.path.exists(ack_path)))
+        journal.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from unionpay.metrics import ClientMetrics, Registry, parse, unescape
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter('notifies_total', 'Notifies', ('status',))
+        counter.inc(status='ok')
+        counter.inc(2, status='ok')
+        counter.inc(status='invalid')
+        self.assertEqual(counter.snapshot(), {('ok',): 3, ('invalid',): 1})
+        self.assertIs(self.registry.counter('notifies_total', 'Notifies', ('status',)), counter)
+        self.assertIn('notifies_total{status="ok"} 3', self.registry.render())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('latency_seconds', 'Latency', ('stage',), buckets=(0.1, 1, float('inf')))
+        histogram.observe(0.05, stage='sign')
+        histogram.observe(0.5, stage='sign')
+        histogram.observe(5, stage='sign')
+        series = histogram.snapshot()[('sign',)]
+        self.assertEqual(series['count'], 3)
+        self.assertAlmostEqual(series['sum'], 5.55)
+        text = self.registry.render()
+        self.assertIn('# TYPE latency_seconds histogram', text)
+        self.assertIn('latency_seconds_bucket{stage="sign",le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{stage="sign",le="1"} 2', text)
+        self.assertIn('latency_seconds_bucket{stage="sign",le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_count{stage="sign"} 3', text)
+
+    def test_time(self):
+        metrics = ClientMetrics(self.registry)
+        with self.assertRaises(ValueError):
+            with metrics.stage_seconds.time(stage='http', txnType='01'):
+                raise ValueError
+        self.assertEqual(metrics.stage_seconds.snapshot()[('http', '01')]['count'], 1)
+
+    def test_escape(self):
+        counter = self.registry.counter('errors_total', 'Errors', ('message',))
+        counter.inc(message='a "b"\n')
+        self.assertIn(r'errors_total{message="a \"b\"\n"} 1', self.registry.render())
+
+    def test_unescape(self):
+        self.assertEqual(unescape(r'a\\nb'), 'a\\nb')
+        self.assertEqual(unescape(r'a\nb\"c\\'), 'a\nb"c\\')
+        counter = self.registry.counter('errors_total', 'Errors', ('message',))
+        for message in ('C:\\new', 'a "b"\n', '\\"'):
+            counter.inc(message=message)
+        samples = parse(self.registry.render())
+        self.assertEqual(
+            sorted(dict(labels)['message'] for _, labels in samples), sorted(['C:\\new', 'a "b"\n', '\\"']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from unionpay.reconcile import Reconciler, ReconcileStatus, reconcile
+from unionpay.util.record import NormalRecord
+
+
+def make_record(order_id, amount, query_id=''):
+    return NormalRecord(NormalRecord.pack({
+        'orderId': order_id,
+        'queryId': query_id,
+        'txnAmt': '%012d' % amount,
+    }))
+
+
+class ReconcileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [
+            make_record('A', 100, 'QA'),
+            make_record('B', 200),
+            make_record('C', 300),
+            {'orderId': 'D', 'queryId': 'QD', 'txnAmt': '000000000400'},
+        ]
+
+    def test_reconcile(self):
+        ledger = iter([
+            ('A', 100),
+            ('B', 250),
+            ('E', 500),
+            ('X', 400, 'QD'),
+        ])
+        reconciler = Reconciler(
+            self.records, ledger_fields={'orderId': 0, 'txnAmt': 1, 'queryId': 2})
+        results = dict((item.key, item.status) for item in reconciler.reconcile(ledger))
+        self.assertEqual(results, {
+            'A': ReconcileStatus.matched,
+            'B': ReconcileStatus.amount_mismatch,
+            'E': ReconcileStatus.missing_unionpay,
+            'X': ReconcileStatus.matched,
+            'C': ReconcileStatus.missing_local,
+        })
+        self.assertEqual(reconciler.summary[ReconcileStatus.matched], 2)
+        self.assertEqual(reconciler.amounts[ReconcileStatus.missing_local], 300)
+
+    def test_statuses(self):
+        ledger = [{'orderId': 'A', 'txnAmt': 100}, {'orderId': 'B', 'txnAmt': 200}]
+        results = list(reconcile(
+            self.records, ledger, statuses=(ReconcileStatus.missing_local,)))
+        self.assertEqual(sorted(item.key for item in results), ['C', 'D'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+import os
+import shutil
+import tempfile
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from unionpay.signer import Signer, get_record_type, split_file
+from unionpay.tests.support import iter_settlement_lines, make_settlement_zip, make_signer
+from unionpay.util.helper import LineObject
+from unionpay.util.record import ErrorRecord, NormalRecord
+
+
+class RecordTest(unittest.TestCase):
+
+    def test_schema_offsets(self):
+        spec = dict((field.name, field) for field in NormalRecord.schema)
+        self.assertEqual((spec['txnTime'].start, spec['txnTime'].stop), (35, 45))
+        self.assertEqual((spec['orderId'].start, spec['orderId'].stop), (112, 144))
+        self.assertEqual(NormalRecord.schema[-1].stop, 607)
+        self.assertEqual(ErrorRecord.schema[-1].stop, 339)
+
+    def test_line_object_break(self):
+        line = NormalRecord.pack({
+            'traceNo': '123456',
+            'txnTime': '1216103000',
+            'accNo': '6216261000000000018',
+            'txnAmt': '000000001000',
+            'merCatCode': '5811',
+            'termType': '07',
+            'queryId': '201512161030001234567',
+            'payTypeOld': '01',
+            'orderId': 'TESTPAY20151216103000',
+            'merId': '777290058110836',
+        })
+        # the slices of the old LineObject, one to six bytes off the ZM_ layout
+        self.assertEqual(line[36:46], b'216103000 ')
+        self.assertEqual(line[65:77], b' 00000000100')
+        self.assertEqual(line[106:138], b'67 01 TESTPAY20151216103000     ')
+        self.assertEqual(line[245:260], b' ' * 15)
+        record = LineObject(line)
+        self.assertEqual(
+            (record.txnTime, record.txnAmt, record.orderId, record.merId),
+            ('1216103000', '000000001000', 'TESTPAY20151216103000', '777290058110836'))
+
+    def test_parse(self):
+        line = NormalRecord.pack({
+            'txnTime': '1216103000',
+            'txnAmt': '000000001000',
+            'queryId': '201512161030001234567',
+            'orderId': 'TESTPAY20151216103000',
+            'txnType': '01',
+            'merId': '777290058110836',
+            'subMerAbbr': u'测试商户',
+        })
+        record = LineObject(line)
+        self.assertEqual(record.orderId, 'TESTPAY20151216103000')
+        self.assertEqual(record.txnAmt, '000000001000')
+        self.assertEqual(record.queryId, '201512161030001234567')
+        self.assertEqual(record.txnType, '01')
+        self.assertEqual(record.merId, '777290058110836')
+        self.assertEqual(record.subMerAbbr, u'测试商户')
+        self.assertEqual(record.billNo, '')
+        self.assertFalse(hasattr(record, '__dict__'))
+
+    def test_error_record(self):
+        record = ErrorRecord(ErrorRecord.pack({'merId': '777290058110836', 'txnAmt': '1'}))
+        self.assertEqual(record.merId, '777290058110836')
+        self.assertIsNone(record.get('orderId'))
+        params = Signer.make_params('1216', record.line, ErrorRecord)
+        self.assertEqual(params['txnAmt'], '1')
+        self.assertIsNone(params['queryId'])
+
+    def test_record_type(self):
+        self.assertIs(get_record_type('INN15121688ZM_777290058110836'), NormalRecord)
+        self.assertIs(get_record_type('INN15121688ZME_777290058110836'), ErrorRecord)
+        self.assertIs(get_record_type('INN15121688PED_777290058110836'), NormalRecord)
+        self.assertIs(get_record_type('INN15121688PEDERR_777290058110836'), ErrorRecord)
+
+    def test_fixtures(self):
+        lines = list(iter_settlement_lines(6, '777290058110836', '1216'))
+        self.assertEqual(len(set(lines)), 6)
+        record = NormalRecord(lines[5])
+        self.assertEqual(record.orderId, 'ORDER000000000000000000000000005')
+        self.assertEqual(record.queryId, '000000000000000000005')
+        self.assertEqual(record.txnTime, '1216103000')
+        archive = make_settlement_zip(10, '777290058110836', error_count=2)
+        records = list(Signer.iter_file_data('1216', archive, '777290058110836'))
+        self.assertEqual(len(records), 12)
+        self.assertEqual(records[3]['txnType'], '04')
+
+    def test_parallel(self):
+        path = tempfile.mkdtemp()
+        try:
+            archive = make_settlement_zip(3000, '777290058110836', error_count=500)
+            files = Signer.save_file_data('1216', archive, path, '777290058110836', year=2015)
+            self.assertTrue(os.path.basename(os.path.dirname(files[0])).endswith('20151216'))
+            expected = Signer.reader_file_data(files, '1216')
+
+            ranges = split_file(files[0], 10000)
+            self.assertGreater(len(ranges), 1)
+            self.assertEqual(ranges[-1][1], os.path.getsize(files[0]))
+            with open(files[0], 'rb') as f:
+                for start, end in ranges:
+                    f.seek(end - 1)
+                    self.assertEqual(f.read(1), b'\n')
+
+            signer = make_signer()
+            try:
+                self.assertEqual(signer.reader_file_data_parallel(files, '1216', 2, chunk_size=10000, min_size=0),
+                                 expected)
+                pool = signer.get_parse_pool(2)
+                unordered = list(signer.iter_file_data_parallel(
+                    files, '1216', 2, ordered=False, chunk_size=10000, min_size=0, window=1))
+                self.assertIs(signer.get_parse_pool(2), pool)
+                self.assertIsNot(signer.get_pool(2), pool)
+                self.assertEqual(
+                    sorted(item['data'] for item in unordered), sorted(item['data'] for item in expected))
+                self.assertEqual(list(signer.iter_file_data_parallel(
+                    files, '1216', 2, chunk_size=10000, min_size=0, window=3)), expected)
+                # stopping early leaves the pool usable
+                records = signer.iter_file_data_parallel(files, '1216', 2, chunk_size=10000, min_size=0)
+                self.assertEqual(next(records), expected[0])
+                records.close()
+                self.assertEqual(pool.submit(sum, [1, 2]).result(), 3)
+            finally:
+                signer.close()
+            # serial fallback
+            self.assertEqual(signer.reader_file_data_parallel(files, '1216'), expected)
+            self.assertEqual(signer.reader_file_data_parallel([], '1216', 2, min_size=0), [])
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+import base64
+import copy
+import json
+import pickle
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from unionpay.error import SignatureValidateError
+from unionpay.response import LAZY_SIZE, parse_response
+from unionpay.signer import Signer
+from unionpay.tests.support import make_file_content, make_settlement_zip, make_signer
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+
+def make_body(signer, data):
+    '''
+    Signed body like the gateway sends, only the signature is urlencoded
+    '''
+    data = dict(data)
+    signature = signer.sign(data).decode('utf-8')
+    data['signature'] = urlencode({'signature': signature})[10:]
+    return Signer.simple_urlencode(data)
+
+
+class ResponseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.signer = make_signer()
+        self.file_content = make_file_content(make_settlement_zip(50, '777290058110836'))
+        self.data = {
+            'version': '5.0.0',
+            'respCode': '00',
+            'respMsg': 'success',
+            'txnType': '76',
+            'merId': '777290058110836',
+            'fileContent': self.file_content,
+        }
+
+    def test_parse(self):
+        bodies = [
+            b'a=1&b=2&signature=x%2By',
+            b'b=2&a=1&a=3',
+            b'a=&b=1+2&c=%41&&d',
+            b'fileContent=ab+c%2Bd&signature=s&',
+            u'orderDesc=测试&a=1'.encode('utf-8'),
+            b'',
+        ]
+        for body in bodies:
+            expected = Signer.parse_arguments(body.decode('utf-8'))
+            if 'fileContent' in expected:
+                expected['fileContent'] = expected['fileContent'].replace(' ', '+')
+            self.assertEqual(dict(parse_response(body, lazy_size=4).load()), expected)
+
+    def test_lazy(self):
+        body = make_body(self.signer, self.data)
+        response = parse_response(body, lazy_size=64)
+        self.assertIsInstance(response.raw_value('fileContent'), memoryview)
+        self.assertIn('fileContent', response)
+        self.assertEqual(len(response), len(self.data) + 2)
+        self.assertEqual(base64.b64decode(response.raw_value('fileContent')), base64.b64decode(self.file_content))
+        self.assertEqual(response['fileContent'], self.file_content)
+        self.assertEqual(response.get('fileContent'), self.file_content)
+        self.assertEqual(response.get('missing', 'default'), 'default')
+
+    def test_whole_dict(self):
+        body = make_body(self.signer, self.data)
+        expected = parse_response(body, lazy_size=64).load()
+        views = [
+            lambda response: dict(response),
+            lambda response: response.copy(),
+            lambda response: dict(response.items()),
+            lambda response: dict((name, response[name]) for name in response.keys()),
+            lambda response: dict((name, response[name]) for name in response),
+            lambda response: json.loads(json.dumps(response)),
+            lambda response: copy.copy(response),
+            lambda response: pickle.loads(pickle.dumps(response)),
+        ]
+        for view in views:
+            response = parse_response(body, lazy_size=64)
+            self.assertIn('fileContent', response.lazy)
+            self.assertEqual(view(response), expected)
+        response = parse_response(body, lazy_size=64)
+        self.assertEqual(response, expected)
+        self.assertIn(self.file_content[:64], repr(parse_response(body, lazy_size=64)))
+
+        response = parse_response(body, lazy_size=64)
+        response['fileContent'] = 'replaced'
+        self.assertEqual(response.raw_value('fileContent'), b'replaced')
+        response = parse_response(body, lazy_size=64)
+        self.assertEqual(response.pop('fileContent'), self.file_content)
+        self.assertNotIn('fileContent', response)
+        response = parse_response(body, lazy_size=64)
+        del response['fileContent']
+        self.assertNotIn('fileContent', response)
+
+    def test_mutators(self):
+        body = make_body(self.signer, self.data)
+        response = parse_response(body, lazy_size=64)
+        response.update(fileContent='replaced')
+        self.assertEqual(response.load()['fileContent'], 'replaced')
+        response = parse_response(body, lazy_size=64)
+        response.update([('fileContent', 'replaced')], respCode='99')
+        self.assertEqual((response['fileContent'], response['respCode']), ('replaced', '99'))
+        response = parse_response(body, lazy_size=64)
+        self.assertEqual(response.setdefault('fileContent', 'default'), self.file_content)
+        self.assertEqual(response.setdefault('missing', 'default'), 'default')
+        self.assertEqual(response['missing'], 'default')
+        response = parse_response(body, lazy_size=64)
+        response.clear()
+        self.assertEqual((len(response), response.get('fileContent')), (0, None))
+        response = parse_response(body, lazy_size=64)
+        items = dict(response.popitem() for _ in range(len(response)))
+        self.assertEqual(items['fileContent'], self.file_content)
+        self.assertEqual(len(response), 0)
+
+    def test_small_body(self):
+        body = make_body(self.signer, dict(self.data, fileContent='ab+c'))
+        self.assertLess(len(body), LAZY_SIZE)
+        response = parse_response(body)
+        self.assertEqual(response.lazy, {})
+        self.assertIsNone(response.signing_parts())
+        self.assertEqual(response['fileContent'], 'ab+c')
+        self.signer.validate_response(response)
+
+    def test_signing_parts(self):
+        body = make_body(self.signer, self.data)
+        response = parse_response(body, lazy_size=64)
+        signing_string = b''.join(bytes(part) for part in response.signing_parts())
+        self.assertEqual(signing_string, Signer.simple_urlencode(dict(self.data, certId=self.signer.cert_id)))
+
+        self.assertIsNone(parse_response(b'b=1&a=2&signature=s', lazy_size=4).signing_parts())
+        self.assertIsNone(parse_response(b'a=1&b=&signature=s', lazy_size=4).signing_parts())
+        self.assertIsNone(parse_response(b'a=1+2&signature=s', lazy_size=4).signing_parts())
+        self.assertIsNone(parse_response(b'a=1&b=2', lazy_size=4).signing_parts())
+        self.assertEqual(
+            [bytes(part) for part in parse_response(b'signature=s&a=1&b=2', lazy_size=4).signing_parts()],
+            [b'a=1&b=2'])
+
+    def test_validate(self):
+        body = make_body(self.signer, self.data)
+        response = parse_response(body, lazy_size=64)
+        self.signer.validate_response(response)
+        self.assertNotIn('signature', response)
+        self.assertIn('fileContent', response.lazy)
+
+        # not canonical, validated from the values
+        pairs = body.split(b'&')
+        response = parse_response(b'&'.join(reversed(pairs)))
+        self.assertIsNone(response.signing_parts())
+        self.signer.validate_response(response)
+
+        tampered = body.replace(b'respMsg=success', b'respMsg=tampered')
+        with self.assertRaises(SignatureValidateError):
+            self.signer.validate_response(parse_response(tampered))
+
+
+if __name__ == '__main__':
+    unittest.main()
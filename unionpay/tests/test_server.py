@@ -0,0 +1,310 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+from tornado.testing import AsyncHTTPTestCase
+
+from unionpay.capture import NotifyCapture, read_capture
+from unionpay.dedup import NotifyDedup, SQLiteDedup, dedup_key
+from unionpay.journal import NotifyJournal
+from unionpay.metrics import Registry
+from unionpay.replay import Replayer, Resigner
+from unionpay.server import Application, NotifyHandler
+from unionpay.signer import Signer
+from unionpay.tests.support import PASSWORD, PFX_FILEPATH, make_request, make_self_x509, make_signer
+from unionpay.util.helper import ObjectDict
+
+
+def make_config(x509_filepath):
+    return ObjectDict(
+        pfx_filepath=PFX_FILEPATH,
+        password=PASSWORD,
+        x509_filepath=x509_filepath,
+        digest_method='sha1',
+        notify_url='/notify'
+    )
+
+
+def make_notify(signer=None, **kwargs):
+    data = Signer.filter_params(make_request())
+    data.update(respCode='00', queryId='201511121600253932498', **kwargs)
+    (signer or make_signer()).sign(data)
+    data['signature'] = data['signature'].decode('utf-8')
+    return data
+
+
+class NotifyHandlerTest(AsyncHTTPTestCase):
+
+    app_kwargs = {}
+
+    def get_app(self):
+        x509_filepath = make_self_x509()
+        try:
+            self.app = Application(make_config(x509_filepath), registry=Registry(), **self.app_kwargs)
+        finally:
+            os.unlink(x509_filepath)
+        return self.app
+
+    def tearDown(self):
+        self.app.close()
+        super(NotifyHandlerTest, self).tearDown()
+
+    def notify(self, data):
+        return self.fetch('/notify', method='POST', body=urlencode(data))
+
+    def test_notify(self):
+        response = self.notify(make_notify(self.app.settings['signer']))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['status'], 'ok')
+        self.assertEqual(self.app.pending, 0)
+
+    def test_bad_signature(self):
+        data = make_notify(self.app.settings['signer'])
+        data['txnAmt'] = 1
+        self.assertEqual(self.notify(data).code, 500)
+        self.assertEqual(self.app.pending, 0)
+        self.assertEqual(self.app.metrics.validate_failures.snapshot(), {('01',): 1})
+
+    def test_metrics(self):
+        self.notify(make_notify(self.app.settings['signer']))
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.body.decode('utf-8')
+        self.assertIn('unionpay_notify_requests_total{status="ok",txnType="01"} 1', body)
+        self.assertIn('unionpay_notify_stage_seconds_count{stage="validate",txnType="01"} 1', body)
+
+    def test_unknown_txn_type(self):
+        signer = self.app.settings['signer']
+        for i in range(3):
+            data = make_notify(signer, orderId='ORDER%d' % i, txnType='X%d' % i)
+            data['txnAmt'] = 1
+            self.notify(data)
+        requests = self.app.metrics.requests.snapshot()
+        self.assertEqual([txn_type for _, txn_type in requests], ['other'])
+        self.assertEqual(sum(requests.values()), 3)
+
+
+class ProcessNotifyHandlerTest(NotifyHandlerTest):
+
+    app_kwargs = {'executor': 'process', 'executor_workers': 1, 'offload_notify': True}
+
+    def test_signer_pool(self):
+        signer = self.app.settings['signer']
+        self.assertEqual(self.notify(make_notify(signer)).code, 200)
+        try:
+            self.assertIsNot(signer.get_pool(1), self.app.validate_executor)
+            signer.sign_many([make_request() for _ in range(2)], processes=2, min_batch=0)
+        finally:
+            signer.close()
+        self.assertEqual(self.notify(make_notify(signer, orderId='ORDER2')).code, 200)
+
+
+class FullNotifyHandlerTest(NotifyHandlerTest):
+
+    app_kwargs = {'max_pending': 0}
+
+    def test_notify(self):
+        self.assertEqual(self.notify(make_notify(self.app.settings['signer'])).code, 503)
+        self.assertEqual(self.app.metrics.requests.snapshot(), {('rejected', '01'): 1})
+
+    def test_metrics(self):
+        self.notify(make_notify(self.app.settings['signer']))
+        body = self.fetch('/metrics').body.decode('utf-8')
+        self.assertIn('unionpay_notify_requests_total{status="rejected",txnType="01"} 1', body)
+        self.assertIn('unionpay_notify_request_seconds_count{status="rejected"} 1', body)
+        self.assertNotIn('stage="validate"', body)
+
+    def test_bad_signature(self):
+        # rejected before validation, unionpay retries it later
+        data = make_notify(self.app.settings['signer'])
+        data['txnAmt'] = 1
+        self.assertEqual(self.notify(data).code, 503)
+        self.assertEqual(self.app.pending, 0)
+        self.assertEqual(self.app.metrics.validate_failures.snapshot(), {})
+        self.assertEqual(self.app.metrics.requests.snapshot(), {('rejected', '01'): 1})
+
+
+class DedupNotifyHandlerTest(NotifyHandlerTest):
+
+    def get_app(self):
+        self.dedup_dir = tempfile.mkdtemp()
+        self.dedup_path = os.path.join(self.dedup_dir, 'dedup.db')
+        self.app_kwargs = {'dedup': NotifyDedup(10, 60, shared=SQLiteDedup(self.dedup_path))}
+        return super(DedupNotifyHandlerTest, self).get_app()
+
+    def tearDown(self):
+        super(DedupNotifyHandlerTest, self).tearDown()
+        shutil.rmtree(self.dedup_dir)
+
+    def test_retry(self):
+        data = make_notify(self.app.settings['signer'])
+        with mock.patch.object(NotifyHandler, 'handle_notify', return_value='ok') as handle_notify:
+            self.assertEqual(self.notify(data).body, b'ok')
+            self.assertEqual(self.notify(data).body, b'ok')
+            self.app.dedup.local.items.clear()
+            self.assertEqual(self.notify(data).body, b'ok')
+        self.assertEqual(handle_notify.call_count, 1)
+        self.assertEqual(self.app.dedup.shared.get(dedup_key(data)), 'ok')
+
+    def test_retry_json(self):
+        data = make_notify(self.app.settings['signer'])
+        with mock.patch.object(NotifyHandler, 'handle_notify', return_value={'status': 'ok'}):
+            self.assertEqual(json.loads(self.notify(data).body), {'status': 'ok'})
+            self.app.dedup.local.items.clear()
+            self.assertEqual(json.loads(self.notify(data).body), {'status': 'ok'})
+
+    def test_shared_types(self):
+        shared = self.app.dedup.shared
+        shared.set('str', 'ok')
+        shared.set('bytes', b'\x00ok')
+        shared.set('dict', {'status': 'ok'})
+        self.assertEqual(shared.get('str'), 'ok')
+        self.assertEqual(shared.get('bytes'), b'\x00ok')
+        self.assertEqual(json.loads(shared.get('dict')), {'status': 'ok'})
+        with self.assertRaises(TypeError):
+            shared.set('list', ['ok'])
+
+
+class JournalNotifyHandlerTest(NotifyHandlerTest):
+
+    def get_app(self):
+        self.journal_path = tempfile.mkdtemp()
+        self.app_kwargs = {'journal': NotifyJournal(self.journal_path, fsync=False)}
+        return super(JournalNotifyHandlerTest, self).get_app()
+
+    def tearDown(self):
+        super(JournalNotifyHandlerTest, self).tearDown()
+        shutil.rmtree(self.journal_path)
+
+    def test_journaled(self):
+        handled = threading.Event()
+        with mock.patch.object(NotifyHandler, 'handle_notify', side_effect=lambda data: handled.set()):
+            response = self.notify(make_notify(self.app.settings['signer']))
+            self.assertEqual(json.loads(response.body)['status'], 'ok')
+            self.assertTrue(handled.wait(5))
+
+    def test_replay_handler(self):
+        data = make_notify(self.app.settings['signer'])
+        handler = NotifyHandler.make_replay_handler(self.app, data)
+        self.assertEqual(handler.get_argument('orderId'), data['orderId'])
+        self.assertEqual(handler.get_all_arguments(), dict((name, str(value)) for name, value in data.items()))
+        self.assertIs(handler.settings['signer'], self.app.settings['signer'])
+        self.assertEqual(json.loads(NotifyHandler.replay_notify(self.app, data))['status'], 'ok')
+
+
+class CaptureNotifyHandlerTest(NotifyHandlerTest):
+
+    def get_app(self):
+        self.capture_dir = tempfile.mkdtemp()
+        self.capture_path = os.path.join(self.capture_dir, 'capture.gz')
+        self.app_kwargs = {'capture': NotifyCapture(self.capture_path, redact=True)}
+        return super(CaptureNotifyHandlerTest, self).get_app()
+
+    def tearDown(self):
+        super(CaptureNotifyHandlerTest, self).tearDown()
+        shutil.rmtree(self.capture_dir)
+
+    def capture(self, *notifies):
+        for data in notifies:
+            self.notify(data)
+        self.app.capture.close()
+        return list(read_capture(self.capture_path))
+
+    def test_capture(self):
+        data = make_notify(self.app.settings['signer'], accNo='6216261000000000018')
+        (offset, body), = self.capture(data)
+        self.assertGreaterEqual(offset, 0)
+        self.assertIn('accNo=%2A%2A%2A%2A%2A%2A%2A%2A%2A%2A%2A%2A%2A%2A%2A0018', body)
+        self.assertIn('orderId=TESTPAY20151112160025', body)
+
+    def test_replay(self):
+        signer = self.app.settings['signer']
+        notifies = self.capture(
+            make_notify(signer, accNo='6216261000000000018'),
+            make_notify(signer, orderId='TESTPAY2'))
+        replayer = Replayer(self.get_url('/notify'), notifies, speed=10, metrics_url=self.get_url('/metrics'))
+        report = self.io_loop.run_sync(replayer.run)
+        # the masked accNo breaks the signature of the first one
+        self.assertEqual(report['statuses'], {'200': 1, '500': 1})
+        self.assertEqual(report['server']['validate_failures'], 1)
+
+        replayer = Replayer(
+            self.get_url('/notify'), notifies, concurrency=2, transform=Resigner(make_signer(), unique=True),
+            metrics_url=self.get_url('/metrics'))
+        report = self.io_loop.run_sync(replayer.run)
+        self.assertEqual(report['statuses'], {'200': 2})
+        self.assertEqual(report['server']['outcomes'], {'ok': 2})
+        self.assertEqual(report['server']['stages']['validate[01]']['count'], 2)
+
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.capture_dir = tempfile.mkdtemp()
+        self.capture_path = os.path.join(self.capture_dir, 'capture.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.capture_dir)
+
+    def test_dropped(self):
+        capture = NotifyCapture(self.capture_path, max_queue=1)
+        entered, release = threading.Event(), threading.Event()
+        write = capture.file.write
+
+        def slow_write(line):
+            entered.set()
+            release.wait(5)
+            return write(line)
+        capture.file.write = slow_write
+        capture.record(b'a=1')
+        self.assertTrue(entered.wait(5))
+        capture.record(b'a=2')
+        capture.record(b'a=3')
+        self.assertEqual(capture.dropped, 1)
+        release.set()
+        capture.close()
+        self.assertEqual([body for _, body in read_capture(self.capture_path)], ['a=1', 'a=2'])
+
+
+FORWARD_SCRIPT = '''
+import os, signal
+from unionpay.server import forward_signals
+forward_signals()
+pid = os.fork()
+if pid == 0:
+    os.kill(os.getpid(), signal.SIGTERM)
+    os._exit(0)
+_, status = os.waitpid(pid, 0)
+print(os.WTERMSIG(status) if os.WIFSIGNALED(status) else -1, signal.getsignal(signal.SIGTERM) is not signal.SIG_IGN)
+'''
+
+
+class ForwardSignalsTest(unittest.TestCase):
+
+    def test_worker_before_reset(self):
+        # a worker signaled before reset_signals dies alone
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        output = subprocess.check_output([sys.executable, '-c', FORWARD_SCRIPT], cwd=root, timeout=30)
+        self.assertEqual(output.split(), [str(int(signal.SIGTERM)).encode(), b'True'])
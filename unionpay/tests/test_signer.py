@@ -2,24 +2,130 @@
 # encoding: utf-8
 # @author: ZhouYang
 
-import unittest2 as unittest
-from signer import Signer
+from hashlib import sha1
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from unionpay.backends import BACKENDS
+from unionpay.error import SignatureValidateError
+from unionpay.response import parse_response
+from unionpay.signer import Signer, update_digest
+from unionpay.tests.support import PFX_FILEPATH, PASSWORD, X509_FILEPATH, make_request, make_signer
 
 
 class SignerTest(unittest.TestCase):
 
-    def setup(self):
-        pfx_filepath = '../pem/PM_700000000000001_acp.pfx'
-        x509_filepath = '../pem/verify_sign_acp.cer'
-        password = '111111'
-        self.signer = Signer(
-            pfx_filepath,
-            password,
-            x509_filepath,
-        )
+    def setUp(self):
+        self.signer = make_signer()
 
     def test_sign(self):
-        pass
+        data = make_request()
+        signature = self.signer.sign(data)
+        self.assertEqual(data['signature'], signature)
+        self.assertEqual(data['certId'], self.signer.cert_id)
+        self.assertEqual(self.signer.cert_id, '40220995861346480087409489142384722381')
 
     def test_validate(self):
-        pass
+        data = make_request()
+        self.signer.sign(data)
+        data['signature'] = data['signature'].decode('utf-8')
+        self.signer.validate(data)
+
+    def test_validate_tampered(self):
+        data = make_request()
+        self.signer.sign(data)
+        data['signature'] = data['signature'].decode('utf-8')
+        data['txnAmt'] = 2500
+        self.assertRaises(SignatureValidateError, self.signer.validate, data)
+
+    def test_update_digest(self):
+        data = make_request()
+        data.update(empty='', none=None, fileContent='ab+cd' * 1000)
+        expected = sha1(Signer.simple_urlencode(data)).hexdigest()
+        self.assertEqual(update_digest(sha1(), data, chunk_size=7).hexdigest(), expected)
+
+        # spaces parse_qs made of "+" are restored chunk by chunk
+        spaced = dict(data, fileContent=data['fileContent'].replace('+', ' '))
+        self.assertEqual(update_digest(sha1(), spaced, chunk_size=7).hexdigest(), expected)
+
+        # lazy values are hashed from the body
+        response = parse_response(Signer.simple_urlencode(data), lazy_size=16)
+        self.assertIn('fileContent', response.lazy)
+        self.assertEqual(update_digest(sha1(), response, chunk_size=7).hexdigest(), expected)
+
+    def test_validate_file_content(self):
+        data = make_request()
+        data['fileContent'] = 'ab+cd' * 1000
+        self.signer.sign(data)
+        data['signature'] = data['signature'].decode('utf-8')
+        data['fileContent'] = data['fileContent'].replace('+', ' ')
+        self.signer.validate(data)
+        self.assertEqual(data['fileContent'], 'ab+cd' * 1000)
+
+    def test_unionpay_cert(self):
+        signer = Signer(PFX_FILEPATH, PASSWORD, X509_FILEPATH)
+        data = make_request()
+        signer.sign(data)
+        data['signature'] = data['signature'].decode('utf-8')
+        self.assertRaises(SignatureValidateError, signer.validate, data)
+
+    def test_sign_many(self):
+        items = [make_request() for _ in range(8)]
+        items[3] = None
+        for min_batch in (0, 100):
+            results = self.signer.sign_many(items, processes=2, min_batch=min_batch)
+            self.assertEqual(len(results), len(items))
+            self.assertIsNotNone(results[3].error)
+            expected = make_request()
+            self.signer.sign(expected)
+            self.assertEqual(results[0].result['signature'], expected['signature'])
+            self.assertNotIn('signature', items[0])
+        self.signer.close()
+
+    def test_validate_many(self):
+        items = []
+        for amount in range(8):
+            data = make_request()
+            data['txnAmt'] = amount
+            self.signer.sign(data)
+            data['signature'] = data['signature'].decode('utf-8')
+            items.append(data)
+        items[5] = dict(items[5], txnAmt=1000)
+        for min_batch in (0, 100):
+            results = self.signer.validate_many(items, processes=2, min_batch=min_batch)
+            self.assertEqual([item.result for item in results], [True] * 5 + [False] + [True] * 2)
+            self.assertIsInstance(results[5].error, SignatureValidateError)
+            self.assertIn('signature', items[0])
+        self.signer.close()
+
+    def test_get_pool(self):
+        try:
+            pool = self.signer.get_pool(1)
+            self.assertIs(self.signer.get_pool(1), pool)
+            future = pool.submit(sum, [1, 2])
+            resized = self.signer.get_pool(2)
+            self.assertIsNot(resized, pool)
+            self.assertEqual(resized._max_workers, 2)
+            self.assertEqual(future.result(), 3)
+            # a held pool survives another worker count
+            items = [make_request() for _ in range(4)]
+            self.assertTrue(all(item.result for item in self.signer.sign_many(items, processes=3, min_batch=0)))
+            self.assertEqual(pool.submit(sum, [3, 4]).result(), 7)
+            self.assertIs(self.signer.get_pool(1), pool)
+        finally:
+            self.signer.close()
+
+    def test_backends_identical(self):
+        available = [name for name, backend in BACKENDS.items() if backend.available()]
+        if len(available) < 2:
+            self.skipTest('only %s backend available' % ','.join(available))
+        signatures = set()
+        for name in available:
+            signatures.add(make_signer(name).sign(make_request()))
+        self.assertEqual(len(signatures), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
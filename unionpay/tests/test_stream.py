@@ -0,0 +1,66 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+import base64
+import zlib
+from zipfile import ZipFile
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from unionpay.error import UnionpayError
+from unionpay.signer import Signer
+from unionpay.tests.support import make_file_content, make_settlement_zip
+from unionpay.util.stream import ArchiveRecords, decode_file_content, iter_base64
+
+MERCHANT_ID = '777290058110836'
+
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.archive = make_settlement_zip(2000, MERCHANT_ID)
+        self.file_content = make_file_content(self.archive)
+
+    def test_base64(self):
+        data = base64.b64decode(self.file_content)
+        for content in (self.file_content, self.file_content.encode('ascii'),
+                        memoryview(self.file_content.encode('ascii')), self.file_content.replace('+', ' ')):
+            self.assertEqual(b''.join(iter_base64(content, chunk_size=1001)), data)
+
+    def test_decode(self):
+        with decode_file_content(self.file_content, chunk_size=999) as archive:
+            self.assertEqual(archive.read(), self.archive)
+            self.assertFalse(archive._rolled)
+
+    def test_spool(self):
+        with decode_file_content(self.file_content, max_memory=1024, chunk_size=999) as archive:
+            self.assertTrue(archive._rolled)
+            records = list(Signer.iter_file_data('1216', archive, MERCHANT_ID))
+            self.assertEqual(len(records), 2000)
+            archive.seek(0)
+            self.assertEqual(len(ZipFile(archive).namelist()), 1)
+
+    def test_records(self):
+        archive = decode_file_content(self.file_content, max_memory=1024)
+        records = ArchiveRecords(archive, Signer.iter_file_data('1216', archive, MERCHANT_ID))
+        self.assertEqual(len(list(records)), 2000)
+        self.assertTrue(archive.closed)
+
+        # stopped early
+        archive = decode_file_content(self.file_content, max_memory=1024)
+        with ArchiveRecords(archive, Signer.iter_file_data('1216', archive, MERCHANT_ID)) as records:
+            self.assertEqual(next(records)['merId'], MERCHANT_ID)
+        self.assertTrue(archive.closed)
+
+    def test_truncated(self):
+        compressed = zlib.compress(self.archive)
+        content = base64.b64encode(compressed[:len(compressed) // 2]).decode('ascii')
+        with self.assertRaises(UnionpayError):
+            decode_file_content(content)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+import copy
+import json
+import os
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from tornado.ioloop import IOLoop
+from unionpay.client import UnionpayClient, UnionpayWapClient
+from unionpay.error import UnionpayError
+from unionpay.metrics import Registry
+from unionpay.signer import Signer
+from unionpay.template import RequestTemplate
+from unionpay.tests.support import make_client_config, make_self_x509
+
+
+def legacy_sign(signer, data):
+    '''
+    Sign and encode a plain dict copy of data the way the client did
+    before templates
+    '''
+    data = signer.filter_params(dict(data))
+    data.pop('signature', None)
+    signer.sign(data)
+    return dict(data), UnionpayClient.encode_request(data)
+
+
+class TemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        config = make_client_config('http://127.0.0.1:8090')
+        config.front_trans_url = 'http://127.0.0.1:8090/gateway/api/frontTransReq.do'
+        config.x509_filepath = make_self_x509()
+        try:
+            self.client = UnionpayClient(config, registry=Registry())
+            self.wap_client = UnionpayWapClient(config, registry=Registry())
+        finally:
+            os.unlink(config.x509_filepath)
+        self.signer = self.client.signer
+
+    def assert_legacy(self, data):
+        expected, expected_body = legacy_sign(self.signer, data)
+        self.client.sign_data(data)
+        self.assertEqual(dict(data), expected)
+        self.signer.validate(dict(data, signature=data['signature'].decode('utf-8')))
+        self.assertEqual(self.client.encode_request(data), expected_body)
+
+    def test_packets(self):
+        packets = [
+            self.client.pay_packet(100, 'ORDER1', customer_ip='127.0.0.1'),
+            self.client.pay_packet(100, 'ORDER1', currency_code='840', order_desc=u'测试'),
+            self.client.query_packet('ORDER1', '20151216103000'),
+            self.client.query_packet('ORDER1', '20151216103000', '201512161030001234567'),
+            self.client.refund_packet('REFUND1', '201512161030001234567', '20151216103000', 1),
+            self.client.revoke_packet('REVOKE1', '201512161030001234567', 1, channel_type='08'),
+            self.client.auth_packet(100, 'AUTH1'),
+            self.client.auth_revoke_packet(1, 'REVOKE2', '201512161030001234567'),
+            self.client.auth_complete_packet(1, 'COMPLETE1', '201512161030001234567'),
+            self.client.auth_complete_revoke_packet(1, 'REVOKE3', '201512161030001234567'),
+            self.client.file_transfer_packet('00', '1216'),
+        ]
+        for _, data, _ in packets:
+            self.assertTrue(data.template.render(data))
+            self.assert_legacy(data)
+
+    def test_cached(self):
+        self.client.query_packet('ORDER1', '20151216103000')
+        self.client.query_packet('ORDER2', '20151216103000')
+        self.client.pay_packet(1, 'ORDER3')
+        self.client.pay_packet(1, 'ORDER4', currency_code='840')
+        self.assertEqual(len(self.client.templates), 3)
+
+    def test_fallback(self):
+        _, data, _ = self.client.query_packet('ORDER1', '20151216103000')
+        data['reqReserved'] = 'extra'
+        self.assert_legacy(data)
+        self.assertIn('reqReserved=extra', self.client.encode_request(copy.copy(data)).decode('utf-8'))
+
+        _, data, _ = self.client.pay_packet(1, 'ORDER2', customer_ip='127.0.0.1')
+        del data['customerIp']
+        self.assert_legacy(data)
+
+    def test_changed_constant(self):
+        _, data, _ = self.client.query_packet('ORDER1', '20151216103000')
+        self.assertIsNotNone(data.template.render(data))
+        data['merId'] = '777290058110837'
+        self.assertIsNone(data.template.render(data))
+        self.assert_legacy(data)
+        self.assertIn(b'merId=777290058110837', self.client.encode_request(data))
+
+        # the same value given as another type is not a change
+        _, data, _ = self.client.query_packet('ORDER2', '20151216103000')
+        data['accessType'] = 0
+        self.assertIsNotNone(data.template.render(data))
+
+    def test_changed_after_signing(self):
+        _, data, _ = self.client.query_packet('ORDER1', '20151216103000')
+        self.client.sign_data(data)
+        data['orderId'] = 'ORDER2'
+        self.assertIn(b'orderId=ORDER2', self.client.encode_request(data))
+
+    def test_template(self):
+        template = RequestTemplate({'version': '5.0.0', 'empty': '', 'none': None, 'count': 1}, ('orderId',))
+        self.assertEqual(template.constants, {'version': '5.0.0', 'count': '1'})
+        self.assertEqual(template.bind(orderId=None), {'version': '5.0.0', 'count': '1'})
+        with self.assertRaises(UnionpayError):
+            template.bind(txnAmt=1)
+        with self.assertRaises(UnionpayError):
+            RequestTemplate({'orderId': '1'}, ('orderId',))
+
+    def test_wap(self):
+        form = self.wap_client.pay(100, 'ORDER1', front_url='http://127.0.0.1/front')
+        self.assertIn('frontUrl', form)
+        self.assertIn('signature', form)
+        form = self.wap_client.auth(100, 'ORDER2', front_url='http://127.0.0.1/front')
+        self.assertIn('frontUrl', form)
+        with self.assertRaises(UnionpayError):
+            self.wap_client.pay(100, 'ORDER3')
+
+        fields = self.wap_client.pay(100, 'ORDER4', front_url='http://127.0.0.1/front', form_format='fields')
+        self.assertEqual(fields['action'], self.wap_client.config.front_trans_url)
+        self.assertEqual(dict(fields['fields'])['orderId'], 'ORDER4')
+        self.assertEqual(json.loads(json.dumps(fields))['fields'], [list(item) for item in fields['fields']])
+        form = self.wap_client.auth(100, 'ORDER5', front_url='http://127.0.0.1/front', form_format='json')
+        self.assertEqual(dict(json.loads(form)['fields'])['frontUrl'], 'http://127.0.0.1/front')
+
+    def test_async_wap(self):
+        # nothing listens on the gateway address, a post would fail
+        io_loop = IOLoop()
+        try:
+            form = io_loop.run_sync(
+                lambda: self.wap_client.async_pay(100, 'ORDER1', front_url='http://127.0.0.1/front'))
+            self.assertIn('frontUrl', form)
+            self.assertIn('signature', form)
+            fields = io_loop.run_sync(
+                lambda: self.wap_client.async_auth(100, 'ORDER2', 'http://127.0.0.1/front', 'fields'))
+            self.assertEqual(dict(fields['fields'])['orderId'], 'ORDER2')
+            with self.assertRaises(UnionpayError):
+                io_loop.run_sync(lambda: self.wap_client.async_pay(100, 'ORDER3'))
+        finally:
+            io_loop.close()
+            self.wap_client.close()
+
+    def test_sign_string(self):
+        _, data, _ = self.client.query_packet('ORDER1', '20151216103000')
+        data['certId'] = self.signer.cert_id
+        signing_string = Signer.simple_urlencode(data)
+        self.assertEqual(self.signer.sign_string(signing_string), self.signer.sign(dict(data)))
+
+
+if __name__ == '__main__':
+    unittest.main()
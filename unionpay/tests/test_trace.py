@@ -0,0 +1,153 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+import time
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from unionpay import trace
+from unionpay.tests.support import make_request, make_signer
+
+
+class RecordHook(trace.Hook):
+
+    def __init__(self):
+        self.events = []
+
+    def start(self, span):
+        self.events.append(('start', span.stage))
+
+    def end(self, span):
+        self.events.append(('end', span.stage))
+
+
+class TraceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hooks = []
+
+    def tearDown(self):
+        for hook in self.hooks:
+            trace.remove_hook(hook)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        trace.add_hook(hook)
+        return hook
+
+    def test_no_hooks(self):
+        self.assertIs(trace.span('sign', {}), trace.NULL_SPAN)
+        func = len
+        self.assertIs(trace.wrap(func), func)
+
+    def test_nested(self):
+        hook = self.add_hook(RecordHook())
+        with trace.span('transaction', {'txnType': '01', 'orderId': 'A1'}) as outer:
+            with trace.span('sign') as inner:
+                self.assertIs(trace.current_span(), inner)
+        self.assertIsNone(trace.current_span())
+        self.assertIs(inner.parent, outer)
+        self.assertEqual((inner.txnType, inner.orderId), ('01', 'A1'))
+        self.assertGreaterEqual(outer.duration, inner.duration)
+        self.assertEqual(hook.events, [
+            ('start', 'transaction'), ('start', 'sign'), ('end', 'sign'), ('end', 'transaction')])
+
+    def test_error(self):
+        self.add_hook(trace.Hook())
+        with self.assertRaises(ValueError):
+            with trace.span('http') as span:
+                raise ValueError('timeout')
+        self.assertIsInstance(span.error, ValueError)
+
+    def test_broken_hook(self):
+        hook = self.add_hook(RecordHook())
+        hook.start = None
+        with trace.span('sign'):
+            pass
+        self.assertEqual(hook.events, [('end', 'sign')])
+
+    def test_signer_stages(self):
+        hook = self.add_hook(RecordHook())
+        signer = make_signer()
+        data = make_request()
+        signer.sign(data)
+        data['signature'] = data['signature'].decode('utf-8')
+        signer.validate(data)
+        stages = [stage for event, stage in hook.events if event == 'end']
+        self.assertEqual(stages, ['digest', 'rsa_sign', 'digest', 'verify'])
+
+    def test_context_tracer(self):
+        finished = []
+        tracer = self.add_hook(trace.ContextTracer(on_finish=lambda span, ids: finished.append(ids)))
+        with trace.span('transaction'):
+            with trace.span('sign'):
+                pass
+        sign, transaction = finished
+        self.assertEqual(sign['trace_id'], transaction['trace_id'])
+        self.assertEqual(sign['parent_id'], transaction['span_id'])
+        self.assertIsNone(transaction['parent_id'])
+
+        token = tracer.activate('remote-trace', 'remote-span')
+        try:
+            with trace.span('transaction'):
+                pass
+        finally:
+            tracer.deactivate(token)
+        self.assertEqual(finished[-1]['trace_id'], 'remote-trace')
+        self.assertEqual(finished[-1]['parent_id'], 'remote-span')
+
+    def test_executor_propagation(self):
+        tracer = self.add_hook(trace.ContextTracer())
+        executor = ThreadPoolExecutor(1)
+
+        def sign():
+            with trace.span('sign'):
+                pass
+
+        @gen.coroutine
+        def transaction():
+            with trace.span('transaction') as span:
+                yield IOLoop.current().run_in_executor(executor, trace.wrap(sign))
+                yield gen.sleep(0)
+            raise gen.Return(span)
+
+        try:
+            outer = IOLoop.current().run_sync(transaction)
+        finally:
+            executor.shutdown()
+        inner = tracer.finished[0]
+        self.assertEqual(inner.stage, 'sign')
+        self.assertIs(inner.parent, outer)
+
+    def test_profile_hook(self):
+        hook = self.add_hook(trace.ProfileHook(stages=['sign']))
+        with trace.span('sign'):
+            sorted(range(1000))
+        with trace.span('http'):
+            pass
+        stats = hook.stats()
+        self.assertIsNotNone(stats)
+        self.assertTrue(any(name[2] == "<built-in method builtins.sorted>" for name in stats.stats))
+
+    def test_sampling_hook(self):
+        hook = self.add_hook(trace.SamplingHook(interval=0.001))
+        try:
+            with trace.span('sign'):
+                deadline = time.time() + 0.1
+                while time.time() < deadline:
+                    pass
+        finally:
+            hook.stop()
+        self.assertTrue(hook.samples)
+        self.assertTrue(hook.collapsed().startswith('sign;'))
+
+
+if __name__ == '__main__':
+    unittest.main()
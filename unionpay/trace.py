@@ -0,0 +1,371 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Tracing and profiling hooks around transaction stages
+
+UnionpayClient and Signer wrap every stage (transaction, sign, digest,
+rsa_sign, urlencode, http, parse, validate, verify) in span(), registered
+hooks get start(span) and end(span) calls:
+
+    trace.add_hook(ContextTracer(on_finish=report))
+
+Without hooks span() returns a shared no-op object, the cost is one
+function call and a list check.
+'''
+
+import collections
+import cProfile
+import logging
+import pstats
+import sys
+import threading
+import time
+import uuid
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+
+logger = logging.getLogger(__name__)
+
+
+HOOKS = []
+
+
+class _ThreadLocalVar(object):
+
+    '''
+    Stands in for ContextVar where contextvars is not available
+    '''
+
+    def __init__(self, name, default=None):
+        self.local = threading.local()
+        self.default = default
+
+    def get(self):
+        return getattr(self.local, 'value', self.default)
+
+    def set(self, value):
+        token = self.get()
+        self.local.value = value
+        return token
+
+    def reset(self, token):
+        self.local.value = token
+
+
+def make_var(name):
+    if contextvars is None:
+        return _ThreadLocalVar(name)
+    return contextvars.ContextVar(name, default=None)
+
+
+_current_span = make_var('unionpay_current_span')
+
+
+def add_hook(hook):
+    '''
+    @hook: an object with start(span) and end(span)
+    '''
+    HOOKS.append(hook)
+
+
+def remove_hook(hook):
+    if hook in HOOKS:
+        HOOKS.remove(hook)
+
+
+def current_span():
+    return _current_span.get()
+
+
+class Hook(object):
+
+    def start(self, span):
+        pass
+
+    def end(self, span):
+        pass
+
+
+class Span(object):
+
+    __slots__ = ('stage', 'txnType', 'orderId', 'start', 'duration', 'parent',
+                 'error', 'context', 'hooks', 'token')
+
+    def __init__(self, stage, txnType=None, orderId=None, hooks=()):
+        self.stage = stage
+        self.txnType = txnType
+        self.orderId = orderId
+        self.start = None
+        self.duration = None
+        self.parent = None
+        self.error = None
+        # free for hooks to keep ids, profiler state and so on
+        self.context = {}
+        self.hooks = hooks
+        self.token = None
+
+    def __enter__(self):
+        self.parent = _current_span.get()
+        if self.parent is not None:
+            self.txnType = self.txnType or self.parent.txnType
+            self.orderId = self.orderId or self.parent.orderId
+        self.token = _current_span.set(self)
+        self.start = time.time()
+        for hook in self.hooks:
+            try:
+                hook.start(self)
+            except Exception:
+                logger.exception('[TRACE]hook %r failed on start' % hook)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.duration = time.time() - self.start
+        self.error = exc_value
+        for hook in reversed(self.hooks):
+            try:
+                hook.end(self)
+            except Exception:
+                logger.exception('[TRACE]hook %r failed on end' % hook)
+        _current_span.reset(self.token)
+        return False
+
+    def __repr__(self):
+        return '<Span %s txnType=%s orderId=%s duration=%s>' % (
+            self.stage, self.txnType, self.orderId, self.duration)
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+def span(stage, data=None):
+    '''
+    @stage: stage name
+    @data:  request or response dict carrying txnType and orderId, a
+            missing one is inherited from the parent span
+    '''
+    if not HOOKS:
+        return NULL_SPAN
+    if data is None:
+        return Span(stage, hooks=tuple(HOOKS))
+    return Span(stage, data.get('txnType'), data.get('orderId'), tuple(HOOKS))
+
+
+def wrap(func):
+    '''
+    Carry the current span into an executor thread, so spans started
+    there get the right parent
+    '''
+    if not HOOKS or contextvars is None:
+        return func
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.run(func, *args, **kwargs)
+    return run
+
+
+class ContextTracer(Hook):
+
+    '''
+    Give every span a trace id and a span id, children share the trace id
+    of their parent. Bridge it to another tracing system with on_finish,
+    or continue an incoming trace with activate()
+    '''
+
+    def __init__(self, on_finish=None):
+        '''
+        @on_finish: called with a finished span and its ids dict
+        '''
+        self.on_finish = on_finish
+        self.finished = collections.deque(maxlen=10000)
+        self.remote = make_var('unionpay_remote_trace')
+
+    @staticmethod
+    def new_id():
+        return uuid.uuid4().hex[:16]
+
+    def activate(self, trace_id, parent_id=None):
+        '''
+        Spans started afterwards in this context join an external trace
+        Return a token for deactivate()
+        '''
+        return self.remote.set((trace_id, parent_id))
+
+    def deactivate(self, token):
+        self.remote.reset(token)
+
+    @staticmethod
+    def ids(span):
+        '''
+        Return {trace_id, span_id, parent_id} of a span, to inject into
+        outgoing headers or logs
+        '''
+        return span.context.get('ids') if span is not None else None
+
+    def start(self, span):
+        parent_ids = self.ids(span.parent)
+        if parent_ids:
+            trace_id, parent_id = parent_ids['trace_id'], parent_ids['span_id']
+        else:
+            trace_id, parent_id = self.remote.get() or (self.new_id() + self.new_id(), None)
+        span.context['ids'] = {'trace_id': trace_id, 'span_id': self.new_id(), 'parent_id': parent_id}
+
+    def end(self, span):
+        self.finished.append(span)
+        if self.on_finish is not None:
+            self.on_finish(span, self.ids(span))
+
+
+class ProfileHook(Hook):
+
+    '''
+    Run cProfile while a stage is running, one profiler per thread,
+    nested stages are profiled by the outermost one
+    '''
+
+    def __init__(self, stages=None):
+        '''
+        @stages: stage names to profile, default is every stage
+        '''
+        self.stages = set(stages) if stages else None
+        self.local = threading.local()
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def profile(self):
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+            self.local.depth = 0
+            with self.lock:
+                self.profiles.append(profile)
+        return profile
+
+    def start(self, span):
+        if self.stages is not None and span.stage not in self.stages:
+            return
+        profile = self.profile()
+        if not self.local.depth:
+            try:
+                profile.enable()
+            except ValueError:
+                # python 3.12+ allows one active profiler per process
+                return
+        self.local.depth += 1
+        span.context['profiled'] = True
+
+    def end(self, span):
+        if not span.context.pop('profiled', False):
+            return
+        self.local.depth -= 1
+        if not self.local.depth:
+            self.local.profile.disable()
+
+    def stats(self, stream=None):
+        '''
+        Return pstats.Stats merged over all threads
+        '''
+        with self.lock:
+            profiles = list(self.profiles)
+        stats = None
+        for profile in profiles:
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile, stream=stream or sys.stdout)
+            else:
+                stats.add(profile)
+        return stats
+
+
+class SamplingHook(Hook):
+
+    '''
+    A sampling profiler: a background thread takes the stack of every
+    thread currently inside a stage each interval seconds. Much cheaper
+    than cProfile under production load
+    '''
+
+    def __init__(self, interval=0.005, stages=None, max_depth=64):
+        '''
+        @interval:  seconds between two samples
+        @stages:    stage names to sample, default is every stage
+        @max_depth: frames kept per stack
+        '''
+        self.interval = interval
+        self.stages = set(stages) if stages else None
+        self.max_depth = max_depth
+        self.active = {}
+        self.samples = collections.Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='unionpay-sampler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def start(self, span):
+        if self.stages is not None and span.stage not in self.stages:
+            return
+        ident = threading.current_thread().ident
+        with self.lock:
+            self.active.setdefault(ident, []).append(span.stage)
+        span.context['sampled'] = ident
+
+    def end(self, span):
+        ident = span.context.pop('sampled', None)
+        if ident is None:
+            return
+        with self.lock:
+            stages = self.active.get(ident)
+            if stages:
+                stages.pop()
+            if not stages:
+                self.active.pop(ident, None)
+
+    def stack(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append('%s (%s:%d)' % (code.co_name, code.co_filename, frame.f_lineno))
+            frame = frame.f_back
+        return tuple(reversed(names))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                active = dict((ident, stages[-1]) for ident, stages in self.active.items() if stages)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for ident, stage in active.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.samples[(stage,) + self.stack(frame)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def collapsed(self):
+        '''
+        Return the samples in the collapsed stack format read by
+        flamegraph.pl and speedscope
+        '''
+        return '\n'.join(
+            '%s %d' % (';'.join(stack), count)
+            for stack, count in sorted(self.samples.items()))
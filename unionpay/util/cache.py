@@ -0,0 +1,127 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Local cache of settlement archives
+
+    <path>/objects/<sha256>.zip     archives by content hash
+    <path>/manifest.json            {merchant/fileType/YYYYMMDD: entry}
+
+An entry is only written once its archive is complete and synced to
+disk, so an interrupted download is fetched again and every completed
+one is skipped. An entry whose archive is missing or of another size is
+fetched again too.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def fsync_dir(path):
+    '''
+    Persist the renames done in directory path, a no-op where directories
+    can not be opened
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class SettlementCache(object):
+
+    def __init__(self, path):
+        '''
+        @path: cache directory, created if missing
+        '''
+        self.path = path
+        self.objects = os.path.join(path, 'objects')
+        self.manifest_path = os.path.join(path, 'manifest.json')
+        self.lock = threading.Lock()
+        if not os.path.exists(self.objects):
+            os.makedirs(self.objects)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+
+    @staticmethod
+    def key(merchant_id, file_type, day):
+        '''
+        @day: settle date as a date
+        '''
+        return '%s/%s/%s' % (merchant_id, file_type, day.strftime('%Y%m%d'))
+
+    def object_path(self, entry):
+        return os.path.join(self.objects, '%s.zip' % entry['sha256'])
+
+    def get(self, key):
+        '''
+        Return the manifest entry of key, None when it was not fetched or
+        its archive is gone or truncated
+        '''
+        entry = self.manifest.get(key)
+        if entry is None:
+            return None
+        try:
+            size = os.path.getsize(self.object_path(entry))
+        except OSError:
+            return None
+        return entry if size == entry['size'] else None
+
+    def store(self, key, archive, chunk_size=1024 * 1024, **info):
+        '''
+        @archive:   file object of the archive, read to the end
+        @info:      saved in the entry, like fileName
+        Copy the archive under its hash and record it, return the entry
+        '''
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.objects, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = archive.read(chunk_size)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            entry = dict(info, sha256=digest.hexdigest(), size=size, fetched=time.time())
+            os.rename(temp_path, self.object_path(entry))
+        except Exception:
+            os.unlink(temp_path)
+            raise
+        fsync_dir(self.objects)
+        with self.lock:
+            self.manifest[key] = entry
+            self.save()
+        logger.debug('[CACHE]%s stored as %s' % (key, entry['sha256']))
+        return entry
+
+    def save(self):
+        '''
+        Replace the manifest atomically, call it with the lock held
+        '''
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self.manifest_path)
+        fsync_dir(self.path)
@@ -3,7 +3,21 @@
 # @author: ZhouYang
 
 
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from .record import NormalRecord
+try:
+    from functools import lru_cache
+except ImportError:
+    # python 2 has no lru_cache, the form parts are built every time
+    def lru_cache(maxsize=128):
+        return lambda func: func
+try:
+    from html import escape
+except ImportError:
+    from cgi import escape as cgi_escape
+
+    def escape(s, quote=True):
+        return cgi_escape(s, quote)
 
 
 class ObjectDict(dict):
@@ -22,67 +36,136 @@ class ObjectDict(dict):
         self[name] = value
 
 
-def make_submit_form(data, front_trans_url):
-    item_template = """<input type="hidden" name="{key}" id="{key}" value="{value}" />"""
-    input_fields = ""
-    for k, v in data.items():
-        if v:
-            input_fields += item_template.format(key=k, value=v, name=k)
-
-    submit_form_template = """
+SUBMIT_FORM_HEAD = """
         <html><head><meta http-equiv="Content-Type" content="text/html; charset=UTF-8"/></head><body>
-        <form id="form" action="{action}" method="{method}">{input_fields}</form></body>
+        <form id="form" action="%s" method="POST">"""
+SUBMIT_FORM_TAIL = """</form></body>
         <script type="text/javascript">
             document.getElementById("form").submit();
         </script>
         </html>"""
+INPUT_PREFIX = '<input type="hidden" name="%s" id="%s" value="'
+INPUT_SUFFIX = '" />'
+
+
+@lru_cache(maxsize=16)
+def _form_head(front_trans_url):
+    return SUBMIT_FORM_HEAD % escape(front_trans_url)
+
+
+@lru_cache(maxsize=256)
+def _input_prefix(name):
+    return INPUT_PREFIX % (escape(name), escape(name))
+
+
+def form_fields(data):
+    '''
+    Return [(name, value)] of the non-empty fields, values as str
+    '''
+    return [(k, v if isinstance(v, str) else str(v)) for k, v in data.items() if v]
 
-    form_kwargs = {
+
+def iter_submit_form(data, front_trans_url):
+    '''
+    @data: {name: value} or [(name, value)]
+    Yield the parts of the auto-submit page, names and values html
+    escaped
+    '''
+    yield _form_head(front_trans_url)
+    for k, v in (data.items() if hasattr(data, 'items') else data):
+        if not v:
+            continue
+        yield _input_prefix(k)
+        yield escape(v if isinstance(v, str) else str(v))
+        yield INPUT_SUFFIX
+    yield SUBMIT_FORM_TAIL
+
+
+def make_submit_form(data, front_trans_url):
+    return ''.join(iter_submit_form(data, front_trans_url))
+
+
+def make_submit_fields(data, front_trans_url):
+    '''
+    The form as data for front ends rendering it themselves, json
+    serializable
+    '''
+    return {
         'action': front_trans_url,
         'method': 'POST',
-        'input_fields': input_fields
+        'fields': form_fields(data),
     }
-    return submit_form_template.format(**form_kwargs)
+
+
+def write_submit_form(handler, data, front_trans_url):
+    '''
+    @handler: tornado.web.RequestHandler
+    @data:    {name: value} or the fields of make_submit_fields
+    Write the page part by part into the response buffer, the caller
+    finishes the response
+    '''
+    handler.set_header('Content-Type', 'text/html; charset=UTF-8')
+    for part in iter_submit_form(data, front_trans_url):
+        handler.write(part)
 
 
 def load_config(filepath):
     import yaml
     try:
-        yaml_map = yaml.load(open(filepath, 'r'))
+        yaml_map = yaml.safe_load(open(filepath, 'r'))
     except Exception as e:
         exit("[Config] yaml format error: {}".format(e))
     return ObjectDict(yaml_map)
 
 
-def make_order_id(prefix):
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    return "{prefix}{timestamp}".format(prefix=prefix, timestamp=timestamp)
+def settle_year(settle_date, today=None):
+    '''
+    @settle_date:   like 1216
+    Settle dates are in the past, one after today belongs to last year
+    '''
+    today = today or date.today()
+    year = today.year
+    if (int(settle_date[:2]), int(settle_date[2:4])) > (today.month, today.day):
+        year -= 1
+    return year
 
 
-class LineObject(object):
+def in_settle_window(day, today=None):
+    '''
+    @day:   settle date as a date
+    A MMDD settle date only names the days after the same day of last
+    year up to today, the way settle_year reads it
+    '''
+    today = today or date.today()
+    return day <= today and settle_year(day.strftime('%m%d'), today) == day.year
 
-    """
-    using for upacp file
-    """
 
-    def __init__(self, line):
-        self.line = line
-        self._parse_line()
+def to_date(value):
+    '''
+    @value: date, datetime or a str like 20151216 or 2015-12-16
+    '''
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value.replace('-', ''), '%Y%m%d').date()
 
-    def _parse_line(self):
-        self.txnTime = self._get_txn_time()
-        self.txnAmt = self._get_txn_amt()
-        self.orderId = self._get_order_id()
-        self.merId = self._get_merchant_id()
 
-    def _get_txn_time(self):
-        return self.line[36: 46]
+def iter_dates(start, end):
+    '''
+    Yield every date from start to end, both included
+    '''
+    day, end = to_date(start), to_date(end)
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
 
-    def _get_txn_amt(self):
-        return self.line[65: 77]
 
-    def _get_order_id(self):
-        return self.line[106: 138]
+def make_order_id(prefix):
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    return "{prefix}{timestamp}".format(prefix=prefix, timestamp=timestamp)
+
 
-    def _get_merchant_id(self):
-        return self.line[245: 260]
+# using for upacp file, the fields are decoded str at the offsets of the
+# ZM_ layout and no longer the bytes slices of the old class, see README
+LineObject = NormalRecord
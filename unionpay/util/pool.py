@@ -0,0 +1,109 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Keep-alive HTTP connection pool shared by all gateway requests
+'''
+
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from .. import error
+
+
+class SessionPool(object):
+
+    '''
+    A thread-safe wrapper of requests.Session, connections to the same
+    gateway host are kept alive and reused, so the TCP connect and TLS
+    handshake is paid once per pooled connection instead of per request.
+    '''
+
+    content_type = 'application/x-www-form-urlencoded'
+
+    def __init__(self, pool_size=10, pool_connections=4, timeout=30, timeouts=None,
+                 verify=False, max_retries=0, pool_block=False, **kwargs):
+        '''
+        @pool_size:         max keep-alive connections per gateway host
+        @pool_connections:  number of gateway hosts to cache pools for
+        @timeout:           default request timeout seconds
+        @timeouts:          per-endpoint timeout map, {url: seconds}
+        @verify:            should verify ssl certification pem
+        @max_retries:       retries on connection errors only
+        @pool_block:        block when pool is exhausted instead of opening
+                            a throwaway connection
+        '''
+        self.pool_size = pool_size
+        self.pool_connections = pool_connections
+        self.timeout = timeout
+        self.timeouts = dict(timeouts or {})
+        self.verify = verify
+        self.max_retries = max_retries
+        self.pool_block = pool_block
+        self._session = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self.make_session()
+        return self._session
+
+    def make_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_size,
+            max_retries=self.max_retries,
+            pool_block=self.pool_block
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.verify = self.verify
+        session.headers.update({
+            'content-type': self.content_type,
+            'connection': 'keep-alive'
+        })
+        return session
+
+    def get_timeout(self, addr):
+        '''
+        @addr: gateway address, falls back to the default timeout
+        '''
+        return self.timeouts.get(addr, self.timeout)
+
+    def post(self, addr, data, timeout=None, **kwargs):
+        '''
+        @addr:      gateway address
+        @data:      urlencoded request body
+        @timeout:   override the endpoint timeout
+        '''
+        if self.closed:
+            raise error.UnionpayError('[UPACP]session pool is closed')
+        return self.session.post(
+            addr,
+            data=data,
+            timeout=timeout or self.get_timeout(addr),
+            **kwargs
+        )
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,181 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Fixed-width records of upacp settlement files
+
+Every line is a run of fixed-width fields separated by one byte, the
+layouts follow the length tables of the unionpay acp sdk. Fields are
+decoded lazily from a memoryview, reading orderId never touches the
+other fields.
+'''
+
+from collections import namedtuple
+
+
+FieldSpec = namedtuple('FieldSpec', ['name', 'start', 'stop'])
+
+
+# 全渠道商户一般交易明细流水文件 ZM_, also used by PED_
+NORMAL_FIELDS = (
+    ('tradeCode', 3),           # 交易代码
+    ('acqInsCode', 11),         # 代理机构标识码
+    ('sendInsCode', 11),        # 发送机构标识码
+    ('traceNo', 6),             # 系统跟踪号
+    ('txnTime', 10),            # 交易传输时间 MMDDhhmmss
+    ('accNo', 19),              # 帐号
+    ('txnAmt', 12),             # 交易金额
+    ('merCatCode', 4),          # 商户类别
+    ('termType', 2),            # 终端类型
+    ('queryId', 21),            # 查询流水号
+    ('payTypeOld', 2),          # 支付方式（旧）
+    ('orderId', 32),            # 商户订单号
+    ('payCardType', 2),         # 支付卡类型
+    ('origTraceNo', 6),         # 原始交易的系统跟踪号
+    ('origTxnTime', 10),        # 原始交易日期时间
+    ('merFee', 13),             # 商户手续费
+    ('settleAmt', 13),          # 结算金额
+    ('payType', 4),             # 支付方式
+    ('groupMerId', 15),         # 集团商户代码
+    ('txnType', 2),             # 交易类型
+    ('txnSubType', 2),          # 交易子类
+    ('bizType', 6),             # 业务类型
+    ('accType', 2),             # 帐号类型
+    ('billType', 4),            # 账单类型
+    ('billNo', 32),             # 账单号码
+    ('interactMode', 1),        # 交互方式
+    ('origQryId', 21),          # 原交易查询流水号
+    ('merId', 15),              # 商户代码
+    ('divideType', 1),          # 分账入账方式
+    ('subMerId', 15),           # 二级商户代码
+    ('subMerAbbr', 32),         # 二级商户简称
+    ('subMerAmt', 13),          # 二级商户分账入账金额
+    ('netAmt', 13),             # 清算净额
+    ('termId', 8),              # 终端号
+    ('merReserved', 32),        # 商户自定义域
+    ('discountAmt', 13),        # 优惠金额
+    ('invoiceAmt', 13),         # 发票金额
+    ('installmentFee', 12),     # 分期付款附加手续费
+    ('installmentNum', 2),      # 分期付款期数
+    ('txnMedium', 1),           # 交易介质
+    ('origOrderId', 32),        # 原始交易订单号
+    ('reserved', 98),           # 保留使用
+)
+
+
+# 全渠道商户差错交易明细流水文件 ZME_, also used by PEDERR_
+ERROR_FIELDS = (
+    ('tradeCode', 3),           # 交易代码
+    ('acqInsCode', 11),         # 代理机构标识码
+    ('sendInsCode', 11),        # 发送机构标识码
+    ('traceNo', 6),             # 系统跟踪号
+    ('txnTime', 10),            # 交易传输时间 MMDDhhmmss
+    ('accNo', 19),              # 帐号
+    ('txnAmt', 12),             # 交易金额
+    ('merCatCode', 4),          # 商户类别
+    ('termType', 2),            # 终端类型
+    ('respCode', 2),            # 应答码
+    ('origTraceNo', 6),         # 原始交易的系统跟踪号
+    ('origTxnTime', 10),        # 原始交易日期时间
+    ('errorReason', 4),         # 差错原因
+    ('origTxnAmt', 12),         # 原始交易金额
+    ('merFee', 13),             # 商户手续费
+    ('settleAmt', 13),          # 结算金额
+    ('merId', 15),              # 商户代码
+    ('subMerId', 15),           # 二级商户代码
+    ('divideType', 1),          # 分账入账方式
+    ('installmentFee', 12),     # 分期付款附加手续费
+    ('installmentNum', 2),      # 分期付款期数
+    ('reserved', 135),          # 保留使用
+)
+
+
+def make_schema(fields, separator=1):
+    '''
+    @fields:    ((name, width), ...)
+    @separator: bytes between two fields
+    Return FieldSpec tuple with absolute offsets
+    '''
+    schema = []
+    start = 0
+    for name, width in fields:
+        schema.append(FieldSpec(name, start, start + width))
+        start += width + separator
+    return tuple(schema)
+
+
+class FieldDescriptor(object):
+
+    __slots__ = ('name', 'start', 'stop')
+
+    def __init__(self, spec):
+        self.name, self.start, self.stop = spec
+
+    def __get__(self, record, owner):
+        if record is None:
+            return self
+        return record.decode(self.start, self.stop)
+
+
+class Record(object):
+
+    '''
+    A settlement line, only the raw line and its memoryview are stored
+    '''
+
+    __slots__ = ('line', 'view')
+
+    schema = ()
+    fields = ()
+    encoding = 'gbk'
+
+    def __init__(self, line):
+        self.line = line
+        self.view = memoryview(line)
+
+    def decode(self, start, stop):
+        return str(self.view[start:stop], self.encoding, 'replace').strip()
+
+    def get(self, name, default=None):
+        if name not in self.fields:
+            return default
+        return getattr(self, name)
+
+    def to_dict(self, names=None):
+        return dict((name, getattr(self, name)) for name in (names or self.fields))
+
+    @classmethod
+    def pack(cls, values, separator=b' ', newline=b'\r\n'):
+        '''
+        @values: {field name: value}, build a raw line for fixtures
+        '''
+        parts = []
+        for spec in cls.schema:
+            width = spec.stop - spec.start
+            value = u'%s' % values.get(spec.name, '')
+            parts.append(value.encode(cls.encoding)[:width].ljust(width))
+        return separator.join(parts) + newline
+
+    def __repr__(self):
+        return '<%s orderId=%s txnAmt=%s>' % (
+            self.__class__.__name__, self.get('orderId'), self.get('txnAmt'))
+
+
+def make_record_type(name, fields, separator=1):
+    '''
+    @name:      class name
+    @fields:    ((name, width), ...)
+    '''
+    schema = make_schema(fields, separator)
+    attrs = dict((spec.name, FieldDescriptor(spec)) for spec in schema)
+    attrs.update(
+        __slots__=(),
+        schema=schema,
+        fields=tuple(spec.name for spec in schema)
+    )
+    return type(name, (Record,), attrs)
+
+
+NormalRecord = make_record_type('NormalRecord', NORMAL_FIELDS)
+ErrorRecord = make_record_type('ErrorRecord', ERROR_FIELDS)
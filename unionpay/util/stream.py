@@ -0,0 +1,128 @@
+# !/usr/bin/env python
+# encoding: utf-8
+# @author: ZhouYang
+
+'''
+Streaming decode of the fileContent of a file transfer
+
+fileContent is base64(zlib(zip archive)). decode_file_content turns it
+into a seekable archive chunk by chunk, the archive stays in memory up to
+max_memory bytes and is spooled to a temp file beyond, so only the
+response body and a few chunks are alive however large the file is.
+'''
+
+import base64
+import tempfile
+import zlib
+from ..error import UnionpayError
+
+
+# base64 characters decoded per step
+CHUNK_SIZE = 64 * 1024
+
+# archive bytes kept in memory before spooling to disk
+MAX_MEMORY = 32 * 1024 * 1024
+
+
+def iter_base64(content, chunk_size=CHUNK_SIZE):
+    '''
+    @content: base64 str, bytes or memoryview, spaces are read as "+"
+    Yield the decoded bytes chunk by chunk
+    '''
+    rest = b''
+    for start in range(0, len(content), chunk_size):
+        chunk = content[start:start + chunk_size]
+        if isinstance(chunk, str):
+            chunk = chunk.encode('ascii')
+        elif not isinstance(chunk, bytes):
+            chunk = bytes(chunk)
+        chunk = rest + chunk.replace(b' ', b'+').translate(None, b'\r\n')
+        cut = len(chunk) - len(chunk) % 4
+        rest = chunk[cut:]
+        if cut:
+            yield base64.b64decode(chunk[:cut])
+    if rest:
+        yield base64.b64decode(rest)
+
+
+def iter_decompress(chunks, chunk_size=CHUNK_SIZE * 4):
+    '''
+    @chunks:        zlib stream chunks
+    @chunk_size:    max bytes yielded at once, bounds a highly compressed
+                    chunk too
+    '''
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk, chunk_size)
+            if data:
+                yield data
+            chunk = decompressor.unconsumed_tail
+    data = decompressor.flush()
+    if data:
+        yield data
+    if not decompressor.eof:
+        raise UnionpayError('fileContent is truncated')
+
+
+def decode_file_content(content, max_memory=MAX_MEMORY, chunk_size=CHUNK_SIZE, dir=None):
+    '''
+    @content:       fileContent, str, bytes or memoryview
+    @max_memory:    archive bytes kept in memory before spooling to disk
+    @dir:           directory of the spooled temp file
+
+    Return the zip archive as a seekable file object at offset 0, the
+    caller closes it
+    '''
+    archive = tempfile.SpooledTemporaryFile(max_size=max_memory, dir=dir)
+    try:
+        for data in iter_decompress(iter_base64(content, chunk_size), chunk_size * 4):
+            archive.write(data)
+    except Exception:
+        archive.close()
+        raise
+    archive.seek(0)
+    return archive
+
+
+class ArchiveRecords(object):
+
+    '''
+    Records parsed from a decoded archive, iterated once. The archive is
+    closed when the records run out, a caller stopping early closes it by
+    close() or by using the records as a context manager:
+
+        with client.file_transfer('00', '1216', stream=True) as records:
+            for record in records:
+                ...
+    '''
+
+    def __init__(self, archive, records):
+        '''
+        @archive:   file object of decode_file_content
+        @records:   generator of records read from archive
+        '''
+        self.archive = archive
+        self.records = records
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.records)
+        except BaseException:
+            self.close()
+            raise
+
+    next = __next__
+
+    def close(self):
+        self.records.close()
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()